@@ -9,6 +9,8 @@
 #   GOOGLE_SERVICE_ACCOUNT_FILE=C:\path\to\service_account.json
 # Optional:
 #   PORT=8080
+#   ADMIN_NOTIFY_MODE=immediate|digest|critical
+#   ADMIN_DIGEST_SEC=300
 #
 # MVP:
 # - Старт -> выбор города (Asan/Dunpo/Sinchang), но работает только Dunpo
@@ -29,21 +31,42 @@ import re
 import json
 import asyncio
 import logging
-import requests
-from dataclasses import dataclass, asdict
+import math
+import time
+import sqlite3
+import importlib.util
+import csv
+import hashlib
+import unicodedata
+import difflib
+import random
+import bisect
+import heapq
+import pickle
+import httpx
+try:
+    import numpy as np   # опционально: батчевые расстояния (без него - чистый Python)
+except ImportError:
+    np = None
+from collections import Counter, OrderedDict, deque
+from dataclasses import dataclass, asdict, field
 from datetime import datetime, timedelta
 from typing import Dict, Any, Optional, List
 from urllib.parse import quote
 from telegram.error import Conflict
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.error import RetryAfter, TimedOut, NetworkError, BadRequest
 from telegram.ext import (
     Application,
+    BasePersistence,
+    PersistenceInput,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
     MessageHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
     filters,
 )
 
@@ -172,6 +195,13 @@ def now_ts() -> str:
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
+def _parse_float(s: str) -> float:
+    try:
+        return float(str(s).strip() or "0")
+    except Exception:
+        return 0.0
+
+
 def parse_ts(s: str) -> Optional[datetime]:
     if not s:
         return None
@@ -204,52 +234,419 @@ async def tg_retry(call, tries: int = 6, base_sleep: float = 0.7):
             return await call()
         except RetryAfter as e:
             await asyncio.sleep(float(e.retry_after) + 0.2)
+        except BadRequest:
+            # в PTB 20 BadRequest - подкласс NetworkError: ловим раньше, повтор не поможет
+            raise
         except (TimedOut, NetworkError) as e:
             last_exc = e
             await asyncio.sleep(base_sleep * (2 ** attempt))
-        except BadRequest:
-            raise
     if last_exc:
         raise last_exc
 
+
+class RateLimiter:
+    """
+    Глобальный лимитер: не чаще rate_per_sec вызовов в секунду.
+    Нужен для пакетных edit'ов, чтобы не ловить RetryAfter от Telegram.
+    """
+
+    def __init__(self, rate_per_sec: float):
+        self.interval = 1.0 / rate_per_sec if rate_per_sec > 0 else 0.0
+        self._next_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            if self._next_at > now:
+                await asyncio.sleep(self._next_at - now)
+                now = loop.time()
+            self._next_at = max(now, self._next_at) + self.interval
+
+
+TG_EDIT_PER_SEC = float(os.getenv("TG_EDIT_PER_SEC", "20"))
+TG_EDIT_LIMITER = RateLimiter(TG_EDIT_PER_SEC)
+
+
+# =========================
+# BACKGROUND TASKS (supervisor)
+# =========================
+TASKS_MAX_CONCURRENCY = int(os.getenv("TASKS_MAX_CONCURRENCY", "50"))
+TASKS_SHUTDOWN_TIMEOUT_SEC = float(os.getenv("TASKS_SHUTDOWN_TIMEOUT_SEC", "10"))
+
+
+@dataclass
+class TaskKindStats:
+    started: int = 0
+    ok: int = 0
+    failed: int = 0
+    canceled: int = 0
+    in_flight: int = 0
+    total_sec: float = 0.0
+    max_sec: float = 0.0
+
+
+class TaskSupervisor:
+    """
+    Фоновые задачи (рассылки, правки офферов, циклы):
+    - держим сильные ссылки, чтобы задачи не собрал GC посреди отправки;
+    - ограничиваем число одновременно работающих (bounded);
+    - считаем исход и время выполнения по видам задач;
+    - при остановке бота дожидаемся задач с таймаутом, остальное отменяем.
+    daemon=True - бесконечные циклы: без лимита, при остановке отменяются сразу.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self._tasks: set = set()
+        self._daemons: set = set()
+        self._closing = False
+        self.stats: Dict[str, TaskKindStats] = {}
+
+    def spawn(self, kind: str, coro, bounded: bool = True, daemon: bool = False) -> Optional[asyncio.Task]:
+        if self._closing:
+            coro.close()
+            log.warning("TASK DROPPED (shutdown) | kind=%s", kind)
+            return None
+
+        st = self.stats.setdefault(kind, TaskKindStats())
+        st.started += 1
+        st.in_flight += 1
+
+        task = asyncio.create_task(self._run(kind, coro, bounded and not daemon), name=f"easygo:{kind}")
+        bucket = self._daemons if daemon else self._tasks
+        bucket.add(task)
+        task.add_done_callback(bucket.discard)
+        return task
+
+    async def _run(self, kind: str, coro, bounded: bool):
+        st = self.stats[kind]
+        started = False
+        t0 = time.monotonic()
+        try:
+            if bounded:
+                await self._sem.acquire()
+            try:
+                started = True
+                t0 = time.monotonic()
+                await coro
+            finally:
+                if bounded:
+                    self._sem.release()
+            st.ok += 1
+        except asyncio.CancelledError:
+            st.canceled += 1
+            raise
+        except Exception:
+            st.failed += 1
+            log.exception("TASK FAILED | kind=%s", kind)
+        finally:
+            st.in_flight -= 1
+            if started:
+                dt = time.monotonic() - t0
+                st.total_sec += dt
+                st.max_sec = max(st.max_sec, dt)
+            else:
+                coro.close()
+
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def shutdown(self, timeout: float):
+        self._closing = True
+
+        for t in list(self._daemons):
+            t.cancel()
+
+        pending = set(self._tasks)
+        if pending:
+            log.info("TASKS DRAIN | pending=%s | timeout=%.1fs", len(pending), timeout)
+            _, pending = await asyncio.wait(pending, timeout=timeout)
+            for t in pending:
+                t.cancel()
+
+        rest = list(pending) + list(self._daemons)
+        if rest:
+            await asyncio.gather(*rest, return_exceptions=True)
+        log.info("TASKS STOPPED | canceled=%s", len(pending))
+
+    def render_text(self) -> str:
+        lines = [
+            "⚙️ Фоновые задачи",
+            f"В работе: {len(self._tasks)} · циклы: {len(self._daemons)}",
+            "",
+        ]
+        if not self.stats:
+            lines.append("Пока задач не было.")
+        for kind in sorted(self.stats):
+            st = self.stats[kind]
+            finished = st.ok + st.failed + st.canceled
+            avg_ms = (st.total_sec / finished * 1000) if finished else 0.0
+            lines.append(
+                f"{kind}: сейчас {st.in_flight} | ok {st.ok} | err {st.failed} | "
+                f"cancel {st.canceled} | avg {avg_ms:.0f} мс | max {st.max_sec * 1000:.0f} мс"
+            )
+        return "\n".join(lines)
+
+
+TASKS = TaskSupervisor(TASKS_MAX_CONCURRENCY)
+
+# =========================
+# CALLBACK ROUTER
+# =========================
+# callback_data -> обработчик по таблице, вместо цепочки if data == ... / startswith.
+# Шаблоны: "role:reset" (точное совпадение), "take:{order_id}", "client:addr:{kind}:{idx:int}"
+# (аргументы - только в конце, типы: str / int).
+# Поиск: dict по точной строке, затем dict по (префикс, число аргументов) - пара lookup'ов.
+# Стадии (в таком порядке их проверяет on_callback):
+#   always      - даже во время /start и сброса UI (смена роли, копирование адреса);
+#   pre_session - кнопки из офферов/истории, FSM не нужен;
+#   session     - остальное, нужен CLIENT_STATE_KEY в user_data.
+# idempotent=True - кнопки, меняющие состояние (взять заказ, подтвердить, ...):
+# повтор с тем же (uid, message_id, callback_data) в течение CB_IDEMPOTENCY_SEC
+# не доходит до обработчика (ни ORDER_LOCK, ни Sheets) - отвечаем из кэша.
+CB_STAGE_ALWAYS = "always"
+CB_STAGE_PRE_SESSION = "pre_session"
+CB_STAGE_SESSION = "session"
+CB_MAX_ARGS = 3
+CB_IDEMPOTENCY_SEC = float(os.getenv("CB_IDEMPOTENCY_SEC", "5"))
+CB_IDEMPOTENCY_MAX_KEYS = 10000
+
+_CB_IN_FLIGHT = "⏳ Уже обрабатываем…"
+_CB_DONE = "✅ Уже выполнено"
+
+_CB_ARG_TYPES = {"str": str, "int": int}
+_re_cb_pattern = re.compile(r"\{[^}]*\}|[^:]+")
+
+
+@dataclass
+class CallbackRouteStats:
+    calls: int = 0
+    errors: int = 0
+    denied: int = 0
+    duplicates: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+
+
+@dataclass
+class CallbackRoute:
+    pattern: str
+    handler: Any
+    stage: str
+    arg_types: tuple
+    guard: Any = None          # guard(uid) -> bool, например is_admin / courier_is_approved
+    answer: bool = True        # False - обработчик сам отвечает на query (alert и т.п.)
+    idempotent: bool = False   # гасить двойные нажатия (см. CB_IDEMPOTENCY_SEC)
+    stats: CallbackRouteStats = field(default_factory=CallbackRouteStats)
+
+
+class CallbackRouter:
+    def __init__(self):
+        self._exact: Dict[str, CallbackRoute] = {}
+        self._prefix: Dict[tuple[str, int], CallbackRoute] = {}
+        self.unrouted = 0
+        self.suppressed = 0
+        # (uid, message_id, data) -> (expires_at, ответ на повтор); пока обработчик
+        # работает, expires_at = inf
+        self._recent: "OrderedDict[tuple, tuple[float, str]]" = OrderedDict()
+
+    def add(self, pattern: str, handler, stage: str = CB_STAGE_SESSION, guard=None, answer: bool = True,
+            idempotent: bool = False) -> CallbackRoute:
+        parts = _re_cb_pattern.findall(pattern)
+        literal = [p for p in parts if not p.startswith("{")]
+        args = [p[1:-1] for p in parts if p.startswith("{")]
+        if parts[:len(literal)] != literal or len(args) > CB_MAX_ARGS:
+            raise ValueError(f"bad callback pattern: {pattern}")
+
+        arg_types = tuple(_CB_ARG_TYPES[a.partition(":")[2] or "str"] for a in args)
+        route = CallbackRoute(pattern, handler, stage, arg_types, guard, answer, idempotent)
+        if args:
+            self._prefix[(":".join(literal), len(args))] = route
+        else:
+            self._exact[pattern] = route
+        return route
+
+    def route(self, pattern: str, stage: str = CB_STAGE_SESSION, guard=None, answer: bool = True,
+              idempotent: bool = False):
+        def deco(fn):
+            self.add(pattern, fn, stage=stage, guard=guard, answer=answer, idempotent=idempotent)
+            return fn
+        return deco
+
+    def match(self, data: str) -> Optional[tuple[CallbackRoute, list]]:
+        route = self._exact.get(data)
+        if route is not None:
+            return route, []
+
+        parts = data.split(":")
+        for n in range(1, min(len(parts) - 1, CB_MAX_ARGS) + 1):
+            route = self._prefix.get((":".join(parts[:-n]), n))
+            if route is None:
+                continue
+            try:
+                return route, [t(v) for t, v in zip(route.arg_types, parts[-n:])]
+            except ValueError:
+                return None
+        return None
+
+    def duplicate(self, route: CallbackRoute, key: tuple) -> Optional[str]:
+        """
+        Повтор в окне идемпотентности -> текст ответа из кэша.
+        Иначе None, а ключ помечается "в работе".
+        """
+        now = time.monotonic()
+        while self._recent:
+            expires_at = next(iter(self._recent.values()))[0]
+            if expires_at > now and len(self._recent) < CB_IDEMPOTENCY_MAX_KEYS:
+                break
+            self._recent.popitem(last=False)
+
+        item = self._recent.get(key)
+        if item is not None and item[0] > now:
+            self.suppressed += 1
+            route.stats.duplicates += 1
+            return item[1]
+
+        self._recent[key] = (math.inf, _CB_IN_FLIGHT)
+        self._recent.move_to_end(key)
+        return None
+
+    def settle(self, key: tuple, ok: bool):
+        if not ok:
+            # упали - повторное нажатие должно дойти до обработчика
+            self._recent.pop(key, None)
+            return
+        self._recent[key] = (time.monotonic() + CB_IDEMPOTENCY_SEC, _CB_DONE)
+        # in-flight ключи стоят не по времени - переставляем в конец очереди
+        self._recent.move_to_end(key)
+
+    async def dispatch(self, route: CallbackRoute, args: list, query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+        st = route.stats
+        if route.guard is not None and not route.guard(uid):
+            st.denied += 1
+            await ui_render(context, uid, "Нет доступа.")
+            return
+
+        t0 = time.perf_counter()
+        try:
+            await route.handler(query, context, uid, *args)
+        except Exception:
+            st.errors += 1
+            raise
+        finally:
+            dt = (time.perf_counter() - t0) * 1000
+            st.calls += 1
+            st.total_ms += dt
+            st.max_ms = max(st.max_ms, dt)
+
+    def render_text(self, limit: int = 25) -> str:
+        routes = [
+            r for r in (*self._exact.values(), *self._prefix.values())
+            if r.stats.calls or r.stats.denied
+        ]
+        routes.sort(key=lambda r: r.stats.total_ms, reverse=True)
+
+        lines = ["🧭 Кнопки (по суммарному времени обработки)", ""]
+        for r in routes[:limit]:
+            st = r.stats
+            avg = st.total_ms / st.calls if st.calls else 0.0
+            line = f"{r.pattern}: {st.calls} | avg {avg:.0f} мс | max {st.max_ms:.0f} мс"
+            if st.errors:
+                line += f" | ошибок {st.errors}"
+            if st.denied:
+                line += f" | отказов {st.denied}"
+            if st.duplicates:
+                line += f" | повторов {st.duplicates}"
+            lines.append(line)
+        if not routes:
+            lines.append("Пока нет нажатий.")
+        if self.unrouted:
+            lines.append(f"\nБез маршрута: {self.unrouted}")
+        if self.suppressed:
+            lines.append(f"Погашено двойных нажатий: {self.suppressed}")
+        return "\n".join(lines)
+
+
+CALLBACKS = CallbackRouter()
+
 # =========================
 # ONE-MESSAGE UI CORE
 # =========================
 UI_MSG_ID_KEY = "ui_msg_id"
 UI_RESET_KEY = "ui_reset_in_progress"
+# (message_id, отпечаток текста+клавиатуры) последнего успешного рендера
+UI_FP_KEY = "ui_fingerprint"
+
+UI_RENDER_STATS: Dict[str, int] = {
+    "edited": 0,
+    "skipped": 0,        # тот же текст и клавиатура - в Telegram не ходили
+    "not_modified": 0,   # Telegram сказал "message is not modified" - тоже успех
+    "sent": 0,
+    "resent": 0,         # edit не удался, отправили новое сообщение
+}
 
 from telegram.error import BadRequest
 
+
+def ui_fingerprint(text: str, reply_markup=None, kwargs: Optional[Dict[str, Any]] = None) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(text.encode("utf-8"))
+    if reply_markup is not None:
+        kb_json = _STATIC_KB_JSON.get(id(reply_markup))
+        if kb_json is None:
+            kb_json = json.dumps(reply_markup.to_dict(), sort_keys=True, ensure_ascii=False).encode("utf-8")
+        h.update(kb_json)
+    if kwargs:
+        h.update(repr(sorted(kwargs.items())).encode("utf-8"))
+    return h.hexdigest()
+
+
 async def ui_render(context, chat_id: int, text: str, reply_markup=None, **kwargs):
     if not text or not str(text).strip():
         log.warning("UI_RENDER SKIP: empty text")
         text = " "
 
     msg_id = context.user_data.get(UI_MSG_ID_KEY)
+    fp = ui_fingerprint(text, reply_markup, kwargs)
 
     if isinstance(msg_id, int):
+        if context.user_data.get(UI_FP_KEY) == (msg_id, fp):
+            UI_RENDER_STATS["skipped"] += 1
+            return
         try:
-            await context.bot.edit_message_text(
+            await tg_retry(lambda: context.bot.edit_message_text(
                 chat_id=chat_id,
                 message_id=msg_id,
                 text=text,
                 reply_markup=reply_markup,
                 **kwargs
-            )
+            ))
+            UI_RENDER_STATS["edited"] += 1
+            context.user_data[UI_FP_KEY] = (msg_id, fp)
             return
-        except BadRequest:
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                UI_RENDER_STATS["not_modified"] += 1
+                context.user_data[UI_FP_KEY] = (msg_id, fp)
+                return
             context.user_data.pop(UI_MSG_ID_KEY, None)
         except Exception:
             log.exception("UI edit error")
             context.user_data.pop(UI_MSG_ID_KEY, None)
 
-    msg = await context.bot.send_message(
+    msg = await tg_retry(lambda: context.bot.send_message(
         chat_id=chat_id,
         text=text,
         reply_markup=reply_markup,
         **kwargs
-    )
+    ))
+    UI_RENDER_STATS["resent" if isinstance(msg_id, int) else "sent"] += 1
     context.user_data[UI_MSG_ID_KEY] = msg.message_id
+    context.user_data[UI_FP_KEY] = (msg.message_id, fp)
 
 
 async def ui_clear_buttons(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
@@ -259,6 +656,7 @@ async def ui_clear_buttons(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     msg_id = context.user_data.get(UI_MSG_ID_KEY)
     if not msg_id:
         return
+    context.user_data.pop(UI_FP_KEY, None)
     try:
         await context.bot.edit_message_reply_markup(
             chat_id=chat_id,
@@ -291,6 +689,92 @@ def is_korean_address(text: str) -> bool:
     return True
 
 
+# =========================
+# ADDRESS NORMALIZATION
+# Канонический вид адреса для ключей кэша / газеттира / истории адресов.
+# "충남 아산시 둔포면 둔포중앙로161번길25 (둔포리) 2층" -> "충청남도 아산시 둔포면 둔포중앙로161번길 25"
+# =========================
+_PROVINCE_ALIASES = {
+    "충남": "충청남도",
+    "충북": "충청북도",
+    "경기": "경기도",
+    "서울": "서울특별시",
+    "서울시": "서울특별시",
+    "세종": "세종특별자치시",
+    "세종시": "세종특별자치시",
+    "대전": "대전광역시",
+    "대전시": "대전광역시",
+}
+_PROVINCES = sorted(set(_PROVINCE_ALIASES.values()) | {"경기도"}, key=len, reverse=True)
+
+# города зоны обслуживания: короткая форма и провинция, если ее не указали
+_CITY_ALIASES = {
+    "아산": "아산시",
+    "천안": "천안시",
+    "평택": "평택시",
+}
+_CITY_PROVINCE = {
+    "아산시": "충청남도",
+    "천안시": "충청남도",
+    "평택시": "경기도",
+}
+
+_re_addr_parens = re.compile(r"\([^)]*\)")
+_re_addr_glued = re.compile(
+    "(" + "|".join(_PROVINCES + sorted(_CITY_PROVINCE, key=len, reverse=True)) + ")(?=[가-힣])"
+)
+_re_addr_road_num = re.compile(r"(로|길)\s*(\d+(?:-\d+)?)(?!\d|-|번)")
+_re_addr_beongil = re.compile(r"(\d)\s+번길")
+_re_addr_beongil_num = re.compile(r"번길\s*(\d)")
+_re_addr_beongil_road = re.compile(r"(로|길)\s+(\d+번길)")
+_re_addr_beonji = re.compile(r"(\d)\s*번지")
+_re_addr_dash = re.compile(r"(\d)\s*-\s*(\d)")
+_re_addr_unit = re.compile(r"^(?:제?\d+(?:-\d+)?(?:동|호|층)|(?:B|지하)\d+층?|\d+(?:동|호|층)\d+(?:호|층))$")
+
+
+def normalize_korean_address(text: str) -> str:
+    """
+    Нормализация для сравнения, не для показа пользователю:
+    NFKC, без скобок и запятых, полные названия провинций/городов,
+    "로/길 + номер" через пробел, без "번지" и хвоста с корпусом/квартирой/этажом.
+    """
+    t = unicodedata.normalize("NFKC", text or "")
+    t = _re_addr_parens.sub(" ", t)
+    t = t.replace(",", " ")
+    t = _re_addr_glued.sub(r"\1 ", t)
+    t = _re_addr_dash.sub(r"\1-\2", t)
+    t = _re_addr_beongil.sub(r"\1번길", t)
+    t = _re_addr_beongil_num.sub(r"번길 \1", t)
+    t = _re_addr_beongil_road.sub(r"\1\2", t)
+    t = _re_addr_road_num.sub(r"\1 \2", t)
+    t = _re_addr_beonji.sub(r"\1", t)
+
+    tokens = t.split()
+    if tokens:
+        tokens[0] = _PROVINCE_ALIASES.get(tokens[0], tokens[0])
+    tokens = [_CITY_ALIASES.get(x, x) for x in tokens]
+    if tokens and tokens[0] in _CITY_PROVINCE:
+        tokens.insert(0, _CITY_PROVINCE[tokens[0]])
+
+    # хвост "101동 1203호" / "2층" / "B1" - не часть адреса здания
+    while len(tokens) > 2 and _re_addr_unit.match(tokens[-1]):
+        tokens.pop()
+
+    return " ".join(tokens)
+
+
+def address_dedup_rate(addresses: List[str]) -> tuple[float, float]:
+    """
+    Доля повторов (= потенциальные попадания в кэш) без нормализации и с ней.
+    """
+    items = [a for a in addresses if a]
+    if not items:
+        return 0.0, 0.0
+    raw = len({" ".join(a.split()) for a in items})
+    norm = len({normalize_korean_address(a) for a in items})
+    return 1 - raw / len(items), 1 - norm / len(items)
+
+
 def parse_price_krw(text: str) -> Optional[int]:
     if not text:
         return None
@@ -368,6 +852,10 @@ COURIERS_HEADERS = [
     "applied_at",
     "approved_at",
     "rejected_at",
+    "home_lat",
+    "home_lon",
+    "on_shift",
+    "shift_changed_at",
 ]
 
 EVENTS_HEADERS = [
@@ -546,6 +1034,10 @@ class SheetsStore:
             courier.get("applied_at", ""),
             courier.get("approved_at", ""),
             courier.get("rejected_at", ""),
+            str(courier.get("home_lat") or ""),
+            str(courier.get("home_lon") or ""),
+            "1" if courier.get("on_shift") else "0",
+            courier.get("shift_changed_at", ""),
         ]
         if cid in self.courier_row:
             self.update_row(COURIERS_SHEET, self.courier_row[cid], row)
@@ -628,10 +1120,10 @@ class SheetsStore:
         self.update_row(ORDERS_SHEET, row_index, row)
 
     def load_all_couriers(self) -> List[Dict[str, str]]:
-        values = self._read_range(f"{COURIERS_SHEET}!A2:I")
+        values = self._read_range(f"{COURIERS_SHEET}!A2:M")
         out: List[Dict[str, str]] = []
         for r in values:
-            rr = r + [""] * (9 - len(r))
+            rr = r + [""] * (13 - len(r))
             cid = rr[0].strip()
             if not cid:
                 continue
@@ -645,6 +1137,10 @@ class SheetsStore:
                 "applied_at": rr[6],
                 "approved_at": rr[7],
                 "rejected_at": rr[8],
+                "home_lat": rr[9],
+                "home_lon": rr[10],
+                "on_shift": rr[11],
+                "shift_changed_at": rr[12],
             })
         return out
 
@@ -700,6 +1196,12 @@ class CourierProfile:
     applied_at: str = ""
     approved_at: str = ""
     rejected_at: str = ""
+    # "домашняя зона" курьера (статичная геопозиция), 0.0 - не задана
+    home_lat: float = 0.0
+    home_lon: float = 0.0
+    # смена: только курьеры на смене получают новые заказы
+    on_shift: bool = True
+    shift_changed_at: str = ""
 
 
 @dataclass
@@ -747,6 +1249,126 @@ SHEETS: Optional[SheetsStore] = None
 ORDER_LOCK = asyncio.Lock()
 
 
+# =========================
+# ORDER INDEX (по статусу, новые первыми)
+# =========================
+# Для админ-браузера: отсортированные списки номеров заказов по статусам,
+# страница - bisect от курсора + слияние нужных статусов, без сортировки всех ORDERS.
+# Ключ = -номер заказа, чтобы по возрастанию шли новые -> старые.
+class OrderIndex:
+    def __init__(self):
+        self._by_status: Dict[str, List[int]] = {}
+        self._status: Dict[str, str] = {}   # order_id -> статус, под которым лежит в индексе
+
+    @staticmethod
+    def _key(order_id: str) -> Optional[int]:
+        try:
+            return -int(order_id)
+        except (TypeError, ValueError):
+            return None
+
+    def update(self, order: "Order"):
+        key = self._key(order.order_id)
+        if key is None:
+            return
+        old = self._status.get(order.order_id)
+        if old == order.status:
+            return
+        if old is not None:
+            self.remove(order.order_id)
+        bisect.insort(self._by_status.setdefault(order.status, []), key)
+        self._status[order.order_id] = order.status
+
+    def remove(self, order_id: str):
+        old = self._status.pop(order_id, None)
+        key = self._key(order_id)
+        keys = self._by_status.get(old)
+        if keys is None or key is None:
+            return
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            keys.pop(i)
+
+    def rebuild(self, orders: Dict[str, "Order"]):
+        self._by_status.clear()
+        self._status.clear()
+        for o in orders.values():
+            key = self._key(o.order_id)
+            if key is None:
+                continue
+            self._by_status.setdefault(o.status, []).append(key)
+            self._status[o.order_id] = o.status
+        for keys in self._by_status.values():
+            keys.sort()
+
+    def count(self, statuses) -> int:
+        if statuses is None:
+            return len(self._status)
+        return sum(len(self._by_status.get(s, ())) for s in statuses)
+
+    def _scan(self, statuses, start_key: Optional[int], older: bool):
+        """
+        Номера заказов нужных статусов (None = всех) от курсора:
+        older=True  - ключи > start_key по возрастанию (старее курсора),
+        older=False - ключи < start_key по убыванию (новее курсора).
+        """
+        its = []
+        for st in (self._by_status if statuses is None else statuses):
+            keys = self._by_status.get(st)
+            if not keys:
+                continue
+            if older:
+                i = 0 if start_key is None else bisect.bisect_right(keys, start_key)
+                its.append(map(keys.__getitem__, range(i, len(keys))))
+            else:
+                i = len(keys) if start_key is None else bisect.bisect_left(keys, start_key)
+                its.append(map(keys.__getitem__, range(i - 1, -1, -1)))
+        for key in heapq.merge(*its, reverse=not older):
+            yield str(-key)
+
+    def page(self, statuses, accept, cursor: str, limit: int) -> tuple[list, bool, bool]:
+        """
+        Страница заказов для курсора:
+        "0" - первая страница, "a<номер>" - следующая после номера, "b<номер>" - предыдущая.
+        accept(order) - доп. фильтр (период). Возвращает (orders, has_prev, has_next).
+        """
+        def take(start_key, older, n):
+            out = []
+            for oid in self._scan(statuses, start_key, older):
+                o = ORDERS.get(oid)
+                if o is not None and accept(o):
+                    out.append(o)
+                    if len(out) >= n:
+                        break
+            return out
+
+        mode, anchor = cursor[:1], self._key(cursor[1:])
+        if mode == "b" and anchor is not None:
+            items = take(anchor, False, limit + 1)
+            has_prev = len(items) > limit
+            items = items[:limit][::-1]
+            if items:
+                has_next = bool(take(self._key(items[-1].order_id), True, 1))
+                return items, has_prev, has_next
+            # страница опустела (статусы сменились) - на начало
+            anchor = None
+
+        start = anchor if mode == "a" else None
+        items = take(start, True, limit + 1)
+        has_next = len(items) > limit
+        items = items[:limit]
+        has_prev = bool(items) and bool(take(self._key(items[0].order_id), False, 1))
+        return items, has_prev, has_next
+
+
+ORDER_INDEX = OrderIndex()
+
+
+def reindex_order(order: "Order"):
+    ORDER_INDEX.update(order)
+    bump_order_version(order.order_id)
+
+
 def courier_is_approved(courier_id: int) -> bool:
     prof = COURIERS.get(courier_id)
     return bool(prof and prof.status == COURIER_APPROVED)
@@ -774,6 +1396,7 @@ def get_active_order_for_courier(courier_id: int) -> Optional["Order"]:
                 courier_id,
             )
             ORDERS.pop(oid, None)
+            ORDER_INDEX.remove(oid)
             continue
 
         return o
@@ -781,15 +1404,319 @@ def get_active_order_for_courier(courier_id: int) -> Optional["Order"]:
     return None
 
 
+# =========================
+# COURIER GEO INDEX
+# =========================
+# Курьер может прислать статичную геопозицию (домашняя зона, хранится в Sheets)
+# или транслировать live location (только в памяти, с TTL).
+# Индекс - простая сетка по градусам: cell -> set(courier_id).
+GEO_CELL_DEG = float(os.getenv("GEO_CELL_DEG", "0.01"))   # ~1.1 км по широте
+COURIER_LIVE_TTL_SEC = int(os.getenv("COURIER_LIVE_TTL_SEC", "900"))
+
+DISPATCH_FIRST_K = int(os.getenv("DISPATCH_FIRST_K", "5"))
+DISPATCH_RADIUS_KM = float(os.getenv("DISPATCH_RADIUS_KM", "3"))
+DISPATCH_RADIUS_GROWTH = float(os.getenv("DISPATCH_RADIUS_GROWTH", "2"))
+DISPATCH_WAVES = int(os.getenv("DISPATCH_WAVES", "3"))
+DISPATCH_WAVE_SEC = int(os.getenv("DISPATCH_WAVE_SEC", "45"))
+
+KM_PER_DEG_LAT = 111.0
+
+
+class GeoGrid:
+    def __init__(self, cell_deg: float):
+        self.cell_deg = cell_deg
+        self.cells: Dict[tuple[int, int], set] = {}
+        self.pos: Dict[int, tuple[float, float]] = {}
+
+    def _cell(self, lat: float, lon: float) -> tuple[int, int]:
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg))
+
+    def __len__(self) -> int:
+        return len(self.pos)
+
+    def clear(self):
+        self.cells.clear()
+        self.pos.clear()
+
+    def update(self, key: int, lat: float, lon: float):
+        self.remove(key)
+        self.pos[key] = (lat, lon)
+        self.cells.setdefault(self._cell(lat, lon), set()).add(key)
+
+    def remove(self, key: int):
+        old = self.pos.pop(key, None)
+        if old is None:
+            return
+        cell = self._cell(*old)
+        bucket = self.cells.get(cell)
+        if bucket is not None:
+            bucket.discard(key)
+            if not bucket:
+                self.cells.pop(cell, None)
+
+    def nearest(
+        self,
+        lat: float,
+        lon: float,
+        k: int,
+        max_km: float,
+        allowed: Optional[set] = None,
+    ) -> List[tuple[float, int]]:
+        """
+        До k ближайших ключей в радиусе max_km: [(km, key)], по возрастанию.
+        Смотрим только клетки в bbox радиуса, а не всех курьеров.
+        """
+        if not self.pos:
+            return []
+        ci, cj = self._cell(lat, lon)
+        di = int(math.ceil(max_km / (self.cell_deg * KM_PER_DEG_LAT)))
+        lon_km = self.cell_deg * KM_PER_DEG_LAT * max(math.cos(math.radians(lat)), 0.01)
+        dj = int(math.ceil(max_km / lon_km))
+
+        keys: List[int] = []
+        for i in range(ci - di, ci + di + 1):
+            for j in range(cj - dj, cj + dj + 1):
+                bucket = self.cells.get((i, j))
+                if not bucket:
+                    continue
+                for key in bucket:
+                    if allowed is not None and key not in allowed:
+                        continue
+                    keys.append(key)
+
+        kms = haversine_one_to_many(lat, lon, [self.pos[key] for key in keys])
+        found = sorted((km, key) for km, key in zip(kms, keys) if km <= max_km)
+        return found[:k]
+
+
+GEO_INDEX = GeoGrid(GEO_CELL_DEG)
+# courier_id -> (lat, lon, monotonic_ts) последней live-точки
+COURIER_LIVE_POS: Dict[int, tuple[float, float, float]] = {}
+
+
+def courier_position(courier_id: int) -> Optional[tuple[float, float]]:
+    live = COURIER_LIVE_POS.get(courier_id)
+    if live and time.monotonic() - live[2] <= COURIER_LIVE_TTL_SEC:
+        return live[0], live[1]
+    prof = COURIERS.get(courier_id)
+    if prof and (prof.home_lat or prof.home_lon):
+        return prof.home_lat, prof.home_lon
+    return None
+
+
+def reindex_courier(courier_id: int):
+    pos = courier_position(courier_id) if courier_is_approved(courier_id) else None
+    if pos:
+        GEO_INDEX.update(courier_id, pos[0], pos[1])
+    else:
+        GEO_INDEX.remove(courier_id)
+
+
+def expire_live_positions():
+    now = time.monotonic()
+    stale = [cid for cid, (_, _, ts) in COURIER_LIVE_POS.items() if now - ts > COURIER_LIVE_TTL_SEC]
+    for cid in stale:
+        COURIER_LIVE_POS.pop(cid, None)
+        reindex_courier(cid)
+
+
+# =========================
+# COURIER SHIFTS
+# =========================
+# Поддерживаемые множества вместо скана COURIERS на каждую рассылку:
+#   ON_SHIFT      - одобренные курьеры на смене
+#   BUSY_COURIERS - курьеры с активным заказом
+SHIFT_IDLE_OFF_SEC = int(os.getenv("SHIFT_IDLE_OFF_SEC", str(4 * 3600)))
+SHIFT_CHECK_EVERY_SEC = 60
+
+ON_SHIFT: set = set()
+BUSY_COURIERS: set = set()
+# courier_id -> monotonic ts последнего действия в боте
+COURIER_LAST_SEEN: Dict[int, float] = {}
+
+
+def dispatch_candidates() -> set:
+    """
+    Курьеры на смене без активного заказа.
+    """
+    return ON_SHIFT - BUSY_COURIERS
+
+
+def courier_on_shift(courier_id: int) -> bool:
+    return courier_id in ON_SHIFT
+
+
+def touch_courier_activity(courier_id: int):
+    if courier_id in ON_SHIFT:
+        COURIER_LAST_SEEN[courier_id] = time.monotonic()
+
+
+def refresh_courier_busy(courier_id: int):
+    if not courier_id:
+        return
+    if get_active_order_for_courier(courier_id):
+        BUSY_COURIERS.add(courier_id)
+    else:
+        BUSY_COURIERS.discard(courier_id)
+
+
+def rebuild_courier_sets():
+    ON_SHIFT.clear()
+    BUSY_COURIERS.clear()
+    now = time.monotonic()
+    for cid, prof in COURIERS.items():
+        if prof.status == COURIER_APPROVED and prof.on_shift:
+            ON_SHIFT.add(cid)
+            COURIER_LAST_SEEN[cid] = now
+    active_statuses = (ORDER_TAKEN, ORDER_EN_ROUTE, ORDER_PICKED_UP, ORDER_DONE_PENDING)
+    for o in ORDERS.values():
+        if o.courier_tg_id and o.status in active_statuses:
+            BUSY_COURIERS.add(o.courier_tg_id)
+
+
+def set_courier_shift(courier_id: int, on: bool, reason: str = "manual"):
+    prof = COURIERS.get(courier_id)
+    if not prof:
+        return
+    on = on and prof.status == COURIER_APPROVED
+
+    prof.on_shift = on
+    prof.shift_changed_at = now_ts()
+    COURIERS[courier_id] = prof
+
+    if on:
+        ON_SHIFT.add(courier_id)
+        COURIER_LAST_SEEN[courier_id] = time.monotonic()
+    else:
+        ON_SHIFT.discard(courier_id)
+        COURIER_LAST_SEEN.pop(courier_id, None)
+
+    if SHEETS:
+        SHEETS.upsert_courier(asdict(prof))
+        SHEETS.log_event(
+            courier_id,
+            ROLE_COURIER,
+            "COURIER_SHIFT_ON" if on else "COURIER_SHIFT_OFF",
+            meta=reason
+        )
+
+
+async def shift_autooff_loop(app: Application):
+    """
+    Автоматически снимаем со смены курьеров без активности SHIFT_IDLE_OFF_SEC
+    (и без активного заказа).
+    """
+    while True:
+        await asyncio.sleep(SHIFT_CHECK_EVERY_SEC)
+        now = time.monotonic()
+        idle = [
+            cid for cid in ON_SHIFT
+            if cid not in BUSY_COURIERS
+            and now - COURIER_LAST_SEEN.get(cid, now) > SHIFT_IDLE_OFF_SEC
+        ]
+        for cid in idle:
+            try:
+                set_courier_shift(cid, False, reason="idle")
+            except Exception:
+                log.exception("Shift auto-off failed | courier=%s", cid)
+                continue
+            log.info("SHIFT AUTO OFF | courier=%s", cid)
+            try:
+                await tg_retry(lambda ccid=cid: app.bot.send_message(
+                    chat_id=ccid,
+                    text="⚪ Смена завершена автоматически (нет активности).\nЧтобы снова получать заказы, начните смену в меню курьера."
+                ))
+            except Exception as e:
+                log.warning("Shift auto-off notify failed: %s", e)
+
+
+# =========================
+# RENDER CACHE (тексты/клавиатуры заказов, статичные клавиатуры)
+# =========================
+# Тексты и клавиатуры заказа зависят только от полей заказа, а поля меняются
+# только на переходах (ORDERS[...] = order + reindex_order). Поэтому кэш -
+# (order_id, вид) -> (версия заказа, результат); версия растет на каждом переходе.
+# InlineKeyboardMarkup в PTB 20 неизменяемый - один объект можно отдавать всем.
+ORDER_VERSIONS: Dict[str, int] = {}
+RENDER_CACHE: Dict[tuple, tuple] = {}
+RENDER_KINDS: List[str] = []
+RENDER_CACHE_STATS: Dict[str, int] = {
+    "hit": 0,
+    "miss": 0,
+    "invalidated": 0,
+}
+
+
+def bump_order_version(order_id: str):
+    order_id = str(order_id)
+    ORDER_VERSIONS[order_id] = ORDER_VERSIONS.get(order_id, 0) + 1
+    for kind in RENDER_KINDS:
+        if RENDER_CACHE.pop((order_id, kind), None) is not None:
+            RENDER_CACHE_STATS["invalidated"] += 1
+
+
+def cached_order_render(kind: str):
+    """
+    Декоратор для render_*/kb_* с единственным аргументом order.
+    """
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(order):
+            key = (str(order.order_id), kind)
+            version = ORDER_VERSIONS.get(key[0], 0)
+            hit = RENDER_CACHE.get(key)
+            if hit is not None and hit[0] == version:
+                RENDER_CACHE_STATS["hit"] += 1
+                return hit[1]
+            RENDER_CACHE_STATS["miss"] += 1
+            value = fn(order)
+            RENDER_CACHE[key] = (version, value)
+            return value
+        RENDER_KINDS.append(kind)
+        return wrapper
+    return deco
+
+
+# id(markup) -> JSON для ui_fingerprint, чтобы не сериализовать статичные клавиатуры на каждый рендер
+_STATIC_KB_JSON: Dict[int, bytes] = {}
+
+
+def static_keyboard(fn):
+    """
+    Клавиатура без параметров: собирается один раз при импорте, дальше - тот же объект.
+    """
+    markup = fn()
+    _STATIC_KB_JSON[id(markup)] = json.dumps(
+        markup.to_dict(), sort_keys=True, ensure_ascii=False
+    ).encode("utf-8")
+
+    @functools.wraps(fn)
+    def get() -> InlineKeyboardMarkup:
+        return markup
+    return get
+
+
+def render_cache_line() -> str:
+    st = RENDER_CACHE_STATS
+    total = st["hit"] + st["miss"]
+    rate = st["hit"] / total * 100 if total else 0.0
+    return (
+        f"Кэш рендера: hit {rate:.0f}% ({st['hit']}/{total}) | сброшено {st['invalidated']} | "
+        f"записей {len(RENDER_CACHE)} | статичных клавиатур {len(_STATIC_KB_JSON)}"
+    )
+
+
 # =========================
 # UI (KEYBOARDS)
 # =========================
 
+@static_keyboard
 def kb_back_home() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("⬅️ Назад", callback_data="home:back")]
     ])
 
+@static_keyboard
 def kb_home_root() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🚀 Старт", callback_data="home:start")],
@@ -806,12 +1733,14 @@ def kb_order_taken_with_copy(order_id: str):
         [InlineKeyboardButton("🚗 Выезжаю", callback_data=f"progress:{order_id}")]
     ])
 
+@static_keyboard
 def kb_back_to_start() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("⬅️ Назад", callback_data="info:back")]
     ])
 
 
+@static_keyboard
 def kb_location() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([[
         InlineKeyboardButton("Асан", callback_data=f"loc:{LOC_ASAN}"),
@@ -820,6 +1749,7 @@ def kb_location() -> InlineKeyboardMarkup:
     ]])
 
 
+@static_keyboard
 def kb_role() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🙋 Я клиент", callback_data="role:client")],
@@ -827,6 +1757,7 @@ def kb_role() -> InlineKeyboardMarkup:
     ])
 
 
+@static_keyboard
 def kb_client_menu() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📝 Создать доставку", callback_data="client:new_order")],
@@ -836,18 +1767,21 @@ def kb_client_menu() -> InlineKeyboardMarkup:
     ])
 
 
+@static_keyboard
 def kb_client_price_choice() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(f"📍 Дунпо ( {DEFAULT_PRICE_KRW} вон )", callback_data="client:price:local")],
         [InlineKeyboardButton("🌐 Другие районы (ввести цену)", callback_data="client:price:custom")],
     ])
 
+@static_keyboard
 def kb_client_price_recommend() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("✅ Принять рекомендованную цену", callback_data="client:price:accept_recommended")],
         [InlineKeyboardButton("✍️ Ввести цену вручную", callback_data="client:price:manual")],
     ])
 
+@static_keyboard
 def kb_courier_menu_not_applied() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("✅ Стать курьером", callback_data="courier:apply")],
@@ -855,6 +1789,7 @@ def kb_courier_menu_not_applied() -> InlineKeyboardMarkup:
     ])
 
 
+@static_keyboard
 def kb_courier_menu_pending() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([[InlineKeyboardButton("🔁 Сменить роль", callback_data="role:reset")]])
 
@@ -870,8 +1805,14 @@ def kb_courier_menu_approved(courier_id: int):
         rows = [
             [InlineKeyboardButton("📋 Текущие заявки", callback_data="courier:orders")],
             [InlineKeyboardButton("📊 Статистика", callback_data="courier:stats")],
+            [InlineKeyboardButton("📍 Моя геопозиция", callback_data="courier:location")],
         ]
 
+    if courier_on_shift(courier_id):
+        rows.append([InlineKeyboardButton("🟢 На смене · Завершить смену", callback_data="courier:shift:off")])
+    else:
+        rows.append([InlineKeyboardButton("⚪ Не на смене · Начать смену", callback_data="courier:shift:on")])
+
     rows.append(
         [InlineKeyboardButton("🔁 Сменить роль", callback_data="role:reset")]
     )
@@ -880,15 +1821,30 @@ def kb_courier_menu_approved(courier_id: int):
     )
     return InlineKeyboardMarkup(rows)
 
+@static_keyboard
 def kb_active_order():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📦 Активный заказ", callback_data="courier:active_order")]
     ])
 
+def kb_recent_addresses(kind: str, addrs: List[str]) -> Optional[InlineKeyboardMarkup]:
+    if not addrs:
+        return None
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(
+            "🕘 " + (a if len(a) <= 40 else a[:39] + "…"),
+            callback_data=f"client:addr:{kind}:{i}"
+        )]
+        for i, a in enumerate(addrs)
+    ])
+
+
+@static_keyboard
 def kb_door_code() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([[InlineKeyboardButton("Нет кода", callback_data="client:door_none")]])
 
 
+@static_keyboard
 def kb_delivery_type() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🍱 Еда", callback_data="client:type:food")],
@@ -898,6 +1854,7 @@ def kb_delivery_type() -> InlineKeyboardMarkup:
     ])
 
 
+@static_keyboard
 def kb_delivery_time() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("⚡ Сейчас", callback_data="client:time:now")],
@@ -906,6 +1863,7 @@ def kb_delivery_time() -> InlineKeyboardMarkup:
     ])
 
 
+@static_keyboard
 def kb_confirm_order() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("✅ Подтвердить заказ", callback_data="client:confirm:yes")],
@@ -913,6 +1871,7 @@ def kb_confirm_order() -> InlineKeyboardMarkup:
     ])
 
 
+@cached_order_render("offer_kb")
 def kb_order_offer(order: "Order") -> InlineKeyboardMarkup:
     # 3 кнопки, как договаривались:
     # - Naver поиск забора
@@ -926,6 +1885,27 @@ def kb_order_offer(order: "Order") -> InlineKeyboardMarkup:
         [InlineKeyboardButton("⏭ Пропустить", callback_data=f"skip:{order.order_id}")],
     ])
 
+def kb_courier_orders_page(items: list, has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+    # карусель: строка на карточку + навигация, все в одном сообщении
+    rows = [
+        [
+            InlineKeyboardButton(f"🤝 Взять #{o.order_id}", callback_data=f"take:{o.order_id}"),
+            InlineKeyboardButton("🧭 Забор", url=naver_map_search_url(o.pickup_address_ko)),
+            InlineKeyboardButton("🧭 Куда", url=naver_map_search_url(o.drop_address_ko)),
+        ]
+        for o in items
+    ]
+    nav = []
+    if has_prev and items:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"courier:orders:b{items[0].order_id}"))
+    nav.append(InlineKeyboardButton("🔄", callback_data="courier:orders:0"))
+    if has_next and items:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"courier:orders:a{items[-1].order_id}"))
+    rows.append(nav)
+    rows.append([InlineKeyboardButton("🏠 Меню", callback_data="courier:dashboard")])
+    return InlineKeyboardMarkup(rows)
+
+
 def kb_order_en_route(order_id):
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📦 Заказ на руках", callback_data=f"picked:{order_id}")]
@@ -943,14 +1923,75 @@ def kb_order_taken(order_id):
     ])
 
 
+@static_keyboard
 def kb_admin_menu() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🆕 Новые заказы", callback_data="admin:new_orders")],
-        [InlineKeyboardButton("🧍 Заявки курьеров", callback_data="admin:apps")],
+        [InlineKeyboardButton("🆕 Новые заказы", callback_data="admin:orders:new:all:0")],
+        [InlineKeyboardButton("📋 Все заказы", callback_data="admin:orders:all:7d:0")],
+        [InlineKeyboardButton("🧍 Заявки курьеров", callback_data="admin:apps:0")],
         [InlineKeyboardButton("✅ Одобренные курьеры", callback_data="admin:approved")],
     ])
 
 
+# админ-браузер заказов: фильтр -> (подпись, статусы; None = все)
+ADMIN_ORDER_FILTERS = {
+    "new": ("🆕 Новые", (ORDER_NEW,)),
+    "active": ("🚚 В работе", (ORDER_TAKEN, ORDER_EN_ROUTE, ORDER_PICKED_UP, ORDER_DONE_PENDING)),
+    "done": ("✅ Доставлены", (ORDER_DONE,)),
+    "closed": ("⚠️ Отмена/проблема", (ORDER_CANCELED, ORDER_PROBLEM)),
+    "all": ("📋 Все", None),
+}
+# период -> (подпись, дней назад включая сегодня; None = без ограничения)
+ADMIN_ORDER_PERIODS = {
+    "today": ("Сегодня", 1),
+    "7d": ("7 дней", 7),
+    "30d": ("30 дней", 30),
+    "all": ("Все время", None),
+}
+
+
+def kb_admin_orders(flt: str, period: str, items: list, has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+    def mark(cur: str, key: str, label: str) -> str:
+        return f"• {label}" if cur == key else label
+
+    filters_row = [
+        InlineKeyboardButton(mark(flt, k, v[0]), callback_data=f"admin:orders:{k}:{period}:0")
+        for k, v in ADMIN_ORDER_FILTERS.items()
+    ]
+    rows = [filters_row[:3], filters_row[3:]]
+    rows.append([
+        InlineKeyboardButton(mark(period, k, v[0]), callback_data=f"admin:orders:{flt}:{k}:0")
+        for k, v in ADMIN_ORDER_PERIODS.items()
+    ])
+
+    nav = []
+    if has_prev and items:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"admin:orders:{flt}:{period}:b{items[0].order_id}"))
+    if has_next and items:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"admin:orders:{flt}:{period}:a{items[-1].order_id}"))
+    if nav:
+        rows.append(nav)
+
+    rows.append([InlineKeyboardButton("🛠 Админ-меню", callback_data="admin:menu")])
+    return InlineKeyboardMarkup(rows)
+
+
+def kb_admin_app_page(courier_id: int, page: int, total: int) -> InlineKeyboardMarkup:
+    rows = [[
+        InlineKeyboardButton("✅ Одобрить", callback_data=f"admin:approve:{courier_id}"),
+        InlineKeyboardButton("❌ Отклонить", callback_data=f"admin:reject:{courier_id}"),
+    ]]
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"admin:apps:{page - 1}"))
+    nav.append(InlineKeyboardButton(f"{page + 1}/{total}", callback_data=f"admin:apps:{page}"))
+    if page + 1 < total:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"admin:apps:{page + 1}"))
+    rows.append(nav)
+    rows.append([InlineKeyboardButton("🛠 Админ-меню", callback_data="admin:menu")])
+    return InlineKeyboardMarkup(rows)
+
+
 def kb_admin_app_decision(courier_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([[
         InlineKeyboardButton("✅ Одобрить", callback_data=f"admin:approve:{courier_id}"),
@@ -977,6 +2018,7 @@ def kb_client_status(order: "Order", can_cancel: bool) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 
+@static_keyboard
 def kb_client_orders_filters() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📅 За сегодня", callback_data="client:orders:today")],
@@ -1129,6 +2171,7 @@ def render_order_summary_for_confirm(d: Dict[str, Any]) -> str:
     )
 
 
+@cached_order_render("offer_text")
 def render_order_offer_text(order: Order) -> str:
     dtype = _dtype_line(order.delivery_type, order.delivery_type_other_text)
     tline = _time_line(order.delivery_time_type, order.delivery_time_text)
@@ -1142,6 +2185,20 @@ def render_order_offer_text(order: Order) -> str:
     )
 
 
+@cached_order_render("card")
+def render_order_card(order: Order) -> str:
+    # компактная карточка для карусели "Текущие заявки"
+    dtype = _dtype_line(order.delivery_type, order.delivery_type_other_text)
+    tline = _time_line(order.delivery_time_type, order.delivery_time_text)
+    return (
+        f"#{order.order_id} · 💰 {order.price_krw} вон · 🕒 {tline}\n"
+        f"📦 {dtype}\n"
+        f"📍 {order.pickup_address_ko}\n"
+        f"🏁 {order.drop_address_ko}"
+    )
+
+
+@cached_order_render("taken_text")
 def render_order_taken_text(order: Order) -> str:
     door = order.door_code or "нет"
     return (
@@ -1157,6 +2214,7 @@ def render_order_taken_text(order: Order) -> str:
     )
 
 
+@cached_order_render("client_status")
 def render_client_status(o: Order) -> str:
     lines = []
     lines.append(f"📦 Статус заказа #{o.order_id}")
@@ -1171,12 +2229,12 @@ def render_client_status(o: Order) -> str:
     lines.append(o.drop_address_ko)
     lines.append("")
 
-    if o.status in (ORDER_TAKEN, ORDER_EN_ROUTE, ORDER_DONE_PENDING, ORDER_DONE):
+    if o.status in (ORDER_TAKEN, ORDER_EN_ROUTE, ORDER_PICKED_UP, ORDER_DONE_PENDING, ORDER_DONE):
         if o.courier_name or o.courier_phone:
             lines.append(f"Курьер: {o.courier_name} {o.courier_phone}".strip())
         if o.taken_at:
             lines.append(f"Курьер назначен: {o.taken_at}")
-    if o.status in (ORDER_EN_ROUTE, ORDER_DONE_PENDING, ORDER_DONE):
+    if o.status in (ORDER_EN_ROUTE, ORDER_PICKED_UP, ORDER_DONE_PENDING, ORDER_DONE):
         if o.in_progress_at:
             lines.append(f"В пути с: {o.in_progress_at}")
     if o.status == ORDER_DONE:
@@ -1189,6 +2247,7 @@ def render_client_status(o: Order) -> str:
     return "\n".join(lines)
 
 
+@cached_order_render("admin_line")
 def render_admin_order_line(o: Order) -> str:
     extra = []
     if o.courier_tg_id:
@@ -1231,6 +2290,7 @@ async def render_home_root(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     context.user_data[USER_ROLE_KEY] = ROLE_UNKNOWN
     context.user_data[CLIENT_STATE_KEY] = C_NONE
     context.user_data[COURIER_STATE_KEY] = K_NONE
+    cancel_speculative_quote(chat_id)
     context.user_data.pop("draft_order", None)
     context.user_data.pop("awaiting_proof_order_id", None)
 
@@ -1272,6 +2332,7 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     chat_id = update.effective_chat.id
 
+    cancel_speculative_quote(update.effective_user.id)
     context.user_data.clear()
     context.user_data.pop(UI_MSG_ID_KEY, None)
     init_user_defaults(context)
@@ -1290,6 +2351,7 @@ async def restart_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
    
     uid = update.effective_user.id
 
+    cancel_speculative_quote(uid)
     context.user_data.clear()
     context.user_data.pop(UI_MSG_ID_KEY, None)
     init_user_defaults(context)
@@ -1365,39 +2427,381 @@ async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-# =========================
-# NOTIFICATIONS
-# =========================
-
-async def handle_courier_orders(query, context: ContextTypes.DEFAULT_TYPE):
-    uid = query.from_user.id
+async def routes_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_user or not is_admin(update.effective_user.id):
+        return
 
+    await ui_render(
+        context,
+        update.effective_chat.id,
+        CALLBACKS.render_text(),
+        reply_markup=kb_admin_menu()
+    )
 
 
-    if not courier_is_approved(uid):
-        await ui_render(context, uid, "Нет доступа.")
+async def funnel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_user or not is_admin(update.effective_user.id):
         return
 
-    # 🔑 если есть активный заказ — ТОЛЬКО ОН
-    active = get_active_order_for_courier(uid)
-    if active:
-        context.user_data.pop(UI_MSG_ID_KEY, None)
-        await render_active_order_screen(query, context, active)
-        return
+    await ui_render(
+        context,
+        update.effective_chat.id,
+        render_funnel_text(),
+        reply_markup=kb_admin_menu()
+    )
 
-    # 🔑 берем ОДИН следующий заказ
-    orders = [o for o in ORDERS.values() if o.status == ORDER_NEW]
 
-    if not orders:
-        await ui_render(
-            context,
-            uid,
-            "📭 Сейчас нет доступных заказов.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔄 Обновить", callback_data="courier_refresh")],
-                [InlineKeyboardButton("🏠 Выйти", callback_data="go_start")]
-            ])
-        )
+async def tasks_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_user or not is_admin(update.effective_user.id):
+        return
+
+    st = ADMIN_NOTIFY_STATS
+    text = (
+        f"{TASKS.render_text()}\n\n"
+        f"📣 Админ-уведомления ({ADMIN_NOTIFY_MODE}): "
+        f"сразу {st['sent']} | в сводку {st['digested']} | сводок {st['digests']} | "
+        f"пропущено {st['dropped']} | ждут сводки {len(ADMIN_DIGEST)}"
+    )
+    await ui_render(
+        context,
+        update.effective_chat.id,
+        text,
+        reply_markup=kb_admin_menu()
+    )
+
+
+def render_metrics_text() -> str:
+    lines = [
+        "📈 Метрики",
+        "",
+        GEOCODE_CACHE.render_line("Геокод-кэш"),
+        DISTANCE_CACHE.render_line("Кэш маршрутов"),
+        "",
+        *(c.render_line() for c in MAP_HTTP.values()),
+        "",
+        *(b.render_line() for b in PROVIDER_BREAKERS.values()),
+        "",
+        GAZETTEER.render_line(),
+        ZONES.render_line(),
+        STATE_STORE.render_line() if STATE_STORE else "Состояние: не сохраняется (STATE_PERSIST_ENABLED=0)",
+        "UI: правок {edited} | пропущено {skipped} | not modified {not_modified} | "
+        "новых {sent} | переотправок {resent}".format(**UI_RENDER_STATS),
+        "Предрасчет цены: готово {ready} | дождались {waited} | мимо {miss} | отменено {canceled}".format(**SPEC_STATS),
+        "Статус клиенту: новых {sent} | правок {edited} | схлопнуто {coalesced} | "
+        "без изменений {skipped} | ошибок {failed}".format(**CLIENT_STATUS_STATS),
+        render_flood_line(),
+        render_cache_line(),
+    ]
+    return "\n".join(lines)
+
+
+async def metrics_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_user or not is_admin(update.effective_user.id):
+        return
+
+    await ui_render(
+        context,
+        update.effective_chat.id,
+        render_metrics_text(),
+        reply_markup=kb_admin_menu()
+    )
+
+
+# вариации одних и тех же адресов (как их пишут клиенты) - для оценки нормализации
+ADDRESS_NORM_CORPUS = [
+    "충청남도 아산시 둔포면 둔포중앙로161번길 25",
+    "충남 아산시 둔포면 둔포중앙로161번길 25",
+    "아산시 둔포면 둔포중앙로 161번길 25",
+    "충남 아산시 둔포면 둔포중앙로161번길25 (둔포리)",
+    "충청남도 아산시 둔포면 둔포중앙로 161 번길 25, 2층",
+    "충청남도 아산시 배방읍 희망로 100",
+    "충남 아산시 배방읍 희망로100",
+    "아산 배방읍 희망로 100 101동 1203호",
+    "충청남도아산시 배방읍 희망로 100",
+    "충청남도 아산시 배방읍 장재리 1000",
+    "충남 아산시 배방읍 장재리 1000번지",
+    "충청남도 천안시 서북구 불당대로 7",
+    "천안시 서북구 불당대로 7 (불당동)",
+    "충남 천안 서북구 불당대로 ７",
+    "충청남도 아산시 둔포면 석곡리 12-3",
+    "충남 아산시 둔포면 석곡리 12 - 3",
+    "충청남도 아산시 신창면 순천향로 22",
+    "아산시 신창면 순천향로22",
+]
+
+
+async def normstats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_user or not is_admin(update.effective_user.id):
+        return
+
+    history = []
+    for o in ORDERS.values():
+        history.extend([o.pickup_address_ko, o.drop_address_ko])
+
+    lines = ["🔤 Нормализация адресов (доля повторов = потенциальные попадания в кэш)"]
+    for title, items in (("Корпус", ADDRESS_NORM_CORPUS), ("История заказов", history)):
+        raw, norm = address_dedup_rate(items)
+        lines.append(f"{title} ({len([a for a in items if a])}): {raw:.0%} → {norm:.0%}")
+
+    await ui_render(
+        context,
+        update.effective_chat.id,
+        "\n".join(lines),
+        reply_markup=kb_admin_menu()
+    )
+
+
+async def zones_rebuild_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_user or not is_admin(update.effective_user.id):
+        return
+
+    if not ZONES.polygons:
+        text = "Зоны не загружены (ZONES_FILE)."
+    else:
+        pairs = await rebuild_zone_matrix()
+        text = f"🗺 Матрица зон пересобрана: {pairs} пар (мин. {ZONE_MATRIX_MIN_SAMPLES} маршрута на пару)."
+
+    await ui_render(
+        context,
+        update.effective_chat.id,
+        text,
+        reply_markup=kb_admin_menu()
+    )
+
+
+async def distbench_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_user or not is_admin(update.effective_user.id):
+        return
+
+    await ui_render(
+        context,
+        update.effective_chat.id,
+        await run_blocking(benchmark_haversine, 1000, 1000),
+        reply_markup=kb_admin_menu()
+    )
+
+
+async def statebench_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_user or not is_admin(update.effective_user.id):
+        return
+
+    await ui_render(
+        context,
+        update.effective_chat.id,
+        await run_blocking(benchmark_state_flush),
+        reply_markup=kb_admin_menu()
+    )
+
+
+async def gazbench_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_user or not is_admin(update.effective_user.id):
+        return
+
+    await ui_render(
+        context,
+        update.effective_chat.id,
+        await run_blocking(GAZETTEER.benchmark),
+        reply_markup=kb_admin_menu()
+    )
+
+
+# =========================
+# ADMIN NOTIFICATIONS (immediate / digest / critical)
+# =========================
+# ADMIN_NOTIFY_MODE:
+#   immediate - каждое событие сразу (в фоне, не в хендлере)
+#   digest    - события копятся и раз в ADMIN_DIGEST_SEC уходят одной сводкой,
+#               критичные (адрес некорректен, заявка курьера) - сразу
+#   critical  - только критичные события
+ADMIN_MODE_IMMEDIATE = "immediate"
+ADMIN_MODE_DIGEST = "digest"
+ADMIN_MODE_CRITICAL = "critical"
+
+ADMIN_NOTIFY_MODE = os.getenv("ADMIN_NOTIFY_MODE", ADMIN_MODE_IMMEDIATE).strip().lower()
+if ADMIN_NOTIFY_MODE not in (ADMIN_MODE_IMMEDIATE, ADMIN_MODE_DIGEST, ADMIN_MODE_CRITICAL):
+    # опечатка в env не должна молча глушить все уведомления
+    log.warning("ADMIN_NOTIFY_MODE=%r unknown, falling back to %s", ADMIN_NOTIFY_MODE, ADMIN_MODE_IMMEDIATE)
+    ADMIN_NOTIFY_MODE = ADMIN_MODE_IMMEDIATE
+ADMIN_DIGEST_SEC = int(os.getenv("ADMIN_DIGEST_SEC", "300"))
+TG_TEXT_LIMIT = 4000
+
+
+@dataclass
+class AdminEvent:
+    order_id: str
+    label: str
+    at: str
+    photo: str = ""
+
+
+# order_id -> события по порядку (dict сохраняет порядок заказов)
+ADMIN_DIGEST: Dict[str, List[AdminEvent]] = {}
+ADMIN_NOTIFY_STATS: Dict[str, int] = {"sent": 0, "digested": 0, "dropped": 0, "digests": 0}
+
+
+async def _admin_send(bot, admin_id: int, text: str, photo: str = "", reply_markup=None):
+    try:
+        if photo:
+            await tg_retry(lambda: bot.send_photo(
+                chat_id=admin_id,
+                photo=photo,
+                caption=text,
+                reply_markup=reply_markup
+            ))
+        else:
+            await tg_retry(lambda: bot.send_message(
+                chat_id=admin_id,
+                text=text,
+                reply_markup=reply_markup
+            ))
+    except Exception as e:
+        log.warning("Admin notify failed: %s", e)
+
+
+def admin_notify(
+    bot,
+    text: str,
+    order_id: str = "",
+    label: str = "",
+    critical: bool = False,
+    photo: str = "",
+    reply_markup=None,
+):
+    """
+    Единая точка уведомлений админам. Никогда не ждет отправки -
+    все уходит в фон через TASKS, хендлер пользователя не тормозит.
+    """
+    mode = ADMIN_NOTIFY_MODE
+
+    if critical or mode == ADMIN_MODE_IMMEDIATE or not order_id:
+        if not critical and mode == ADMIN_MODE_CRITICAL:
+            ADMIN_NOTIFY_STATS["dropped"] += 1
+            return
+        for admin_id in ADMIN_IDS:
+            TASKS.spawn("notify_admin", _admin_send(bot, admin_id, text, photo, reply_markup))
+        ADMIN_NOTIFY_STATS["sent"] += 1
+        return
+
+    if mode == ADMIN_MODE_DIGEST:
+        ADMIN_DIGEST.setdefault(str(order_id), []).append(
+            AdminEvent(order_id=str(order_id), label=label or text, at=now_ts()[11:16], photo=photo)
+        )
+        ADMIN_NOTIFY_STATS["digested"] += 1
+        return
+
+    ADMIN_NOTIFY_STATS["dropped"] += 1
+
+
+def build_admin_digest(events: Dict[str, List[AdminEvent]]) -> List[str]:
+    """
+    События склеиваются по заказу в одну строку:
+    #12 · 14:02 🆕 новый · 4000 вон → 14:05 ✅ взят · Иван → 14:20 🏁 выполнен 📷
+    Возвращает список сообщений (режем по лимиту Telegram).
+    """
+    header = f"🧾 Сводка · заказов: {len(events)}"
+    lines = []
+    for oid, evs in events.items():
+        chain = " → ".join(f"{e.at} {e.label}{' 📷' if e.photo else ''}" for e in evs)
+        line = f"#{oid} · {chain}"
+        # очень длинная цепочка сама по себе не влезет ни в одно сообщение - режем
+        limit = TG_TEXT_LIMIT - len(header) - 20
+        if len(line) > limit:
+            line = line[:limit - 1] + "…"
+        lines.append(line)
+
+    chunks: List[str] = []
+    cur = header
+    has_lines = False
+    for line in lines:
+        if has_lines and len(cur) + len(line) + 2 > TG_TEXT_LIMIT:
+            chunks.append(cur)
+            cur = header + " (продолжение)"
+            has_lines = False
+        cur += "\n\n" + line
+        has_lines = True
+    chunks.append(cur)
+    return chunks
+
+
+async def flush_admin_digest(bot):
+    if not ADMIN_DIGEST:
+        return
+    events = dict(ADMIN_DIGEST)
+    ADMIN_DIGEST.clear()
+
+    texts = build_admin_digest(events)
+    photos = [
+        InputMediaPhoto(media=e.photo, caption=f"#{e.order_id}")
+        for evs in events.values() for e in evs if e.photo
+    ]
+
+    for admin_id in ADMIN_IDS:
+        for t in texts:
+            await _admin_send(bot, admin_id, t)
+        for i in range(0, len(photos), 10):
+            batch = photos[i:i + 10]
+            try:
+                if len(batch) == 1:
+                    # media group принимает только 2-10 элементов
+                    await tg_retry(lambda aid=admin_id, p=batch[0]: bot.send_photo(
+                        chat_id=aid,
+                        photo=p.media,
+                        caption=p.caption
+                    ))
+                else:
+                    await tg_retry(lambda aid=admin_id, b=batch: bot.send_media_group(
+                        chat_id=aid,
+                        media=b
+                    ))
+            except Exception as e:
+                log.warning("Admin digest photos failed: %s", e)
+
+    ADMIN_NOTIFY_STATS["digests"] += 1
+    log.info("ADMIN DIGEST SENT | orders=%s | messages=%s | photos=%s", len(events), len(texts), len(photos))
+
+
+async def admin_digest_loop(app: Application):
+    while True:
+        await asyncio.sleep(ADMIN_DIGEST_SEC)
+        try:
+            await flush_admin_digest(app.bot)
+        except Exception:
+            log.exception("Admin digest flush failed")
+
+
+# =========================
+# NOTIFICATIONS
+# =========================
+
+async def handle_courier_orders(query, context: ContextTypes.DEFAULT_TYPE):
+    uid = query.from_user.id
+
+
+
+    if not courier_is_approved(uid):
+        await ui_render(context, uid, "Нет доступа.")
+        return
+
+    # 🔑 если есть активный заказ — ТОЛЬКО ОН
+    active = get_active_order_for_courier(uid)
+    if active:
+        context.user_data.pop(UI_MSG_ID_KEY, None)
+        await render_active_order_screen(query, context, active)
+        return
+
+    # 🔑 берем ОДИН следующий заказ
+    orders = [o for o in ORDERS.values() if o.status == ORDER_NEW]
+
+    if not orders:
+        await ui_render(
+            context,
+            uid,
+            "📭 Сейчас нет доступных заказов.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔄 Обновить", callback_data="courier_refresh")],
+                [InlineKeyboardButton("🏠 Выйти", callback_data="go_start")]
+            ])
+        )
         return
 
     orders.sort(key=lambda o: int(o.order_id), reverse=True)
@@ -1432,80 +2836,151 @@ async def _send_courier_naver_warning_once(context: ContextTypes.DEFAULT_TYPE, c
         log.warning("Courier warning send failed: %s", e)
 
 
-async def notify_new_order(context: ContextTypes.DEFAULT_TYPE, order: Order):
+# order_id -> [(chat_id, message_id)] всех разосланных офферов с кнопкой "Взять"
+OFFER_MSGS: Dict[str, List[tuple[int, int]]] = {}
+
+
+def remember_offer(order_id: str, msg) -> None:
+    if msg is None:
+        return
+    OFFER_MSGS.setdefault(str(order_id), []).append((msg.chat_id, msg.message_id))
+
+
+async def retire_order_offers(context: ContextTypes.DEFAULT_TYPE, order: Order, note: str,
+                               taker_id: int = 0, taker_note: str = ""):
+    """
+    Заказ больше недоступен: правим все разосланные офферы на месте
+    (текст + пометка, кнопки убираются), вместо новой рассылки всем курьерам.
+    У курьера taker_id (взял заказ) в оффере пишем taker_note, а не note.
+    """
+    targets = OFFER_MSGS.pop(str(order.order_id), [])
+    if not targets:
+        return
+
+    text = f"{render_order_offer_text(order)}\n\n{note}"
+    taker_text = f"{render_order_offer_text(order)}\n\n{taker_note}" if taker_note else text
+    edited = 0
+    failed = 0
+
+    for chat_id, message_id in targets:
+        await TG_EDIT_LIMITER.wait()
+        try:
+            await tg_retry(lambda c=chat_id, m=message_id: context.bot.edit_message_text(
+                chat_id=c,
+                message_id=m,
+                text=taker_text if c == taker_id else text,
+            ))
+            edited += 1
+        except BadRequest as e:
+            # сообщение удалено / уже изменено: tg_retry не повторяет, сразу в failed
+            failed += 1
+            log.info("Offer edit rejected | order_id=%s | chat=%s | %s", order.order_id, chat_id, e)
+        except Exception as e:
+            failed += 1
+            log.warning("Offer edit failed | order_id=%s | chat=%s | %s", order.order_id, chat_id, e)
+
+    log.info(
+        "OFFERS RETIRED | order_id=%s | edited=%s | failed=%s | total=%s",
+        order.order_id, edited, failed, len(targets)
+    )
+
+
+async def send_order_offers(context: ContextTypes.DEFAULT_TYPE, order: Order, courier_ids, sent: set):
+    # текст и клавиатура - один раз на волну, а не на каждого курьера
     text = render_order_offer_text(order)
+    kb = kb_order_offer(order)
 
-    async def safe_send(coro, label: str):
+    async def send_one(cid: int):
+        # предупреждение про Naver - один раз на курьера
+        await _send_courier_naver_warning_once(context, cid)
         try:
-            await tg_retry(coro)
+            msg = await tg_retry(lambda: context.bot.send_message(
+                chat_id=cid,
+                text=text,
+                reply_markup=kb,
+            ))
         except Exception as e:
-            log.warning("%s notify failed: %s", label, e)
+            log.warning("Courier notify failed: %s", e)
+            return
+        remember_offer(order.order_id, msg)
 
-    tasks = []
+    ids = [cid for cid in courier_ids if cid not in sent]
+    sent.update(ids)
+    if ids:
+        await asyncio.gather(*(send_one(cid) for cid in ids))
+    return len(ids)
 
-    # админы
-    for admin_id in ADMIN_IDS:
-        tasks.append(
-            asyncio.create_task(
-                safe_send(
-                    lambda aid=admin_id: context.bot.send_message(
-                        chat_id=aid,
-                        text=f"🆕 Новый заказ\n\n{text}"
-                    ),
-                    "Admin"
-                )
+
+async def dispatch_order_offers(context: ContextTypes.DEFAULT_TYPE, order: Order):
+    """
+    Гео-рассылка оффера:
+    - сначала K ближайших свободных курьеров в радиусе DISPATCH_RADIUS_KM от забора;
+    - если за DISPATCH_WAVE_SEC никто не взял - радиус растет, следующие K;
+    - после последней волны - всем оставшимся свободным курьерам.
+    Если координат забора нет или никто не делился геопозицией - сразу всем.
+    """
+    sent: set = set()
+    coords = None
+
+    expire_live_positions()
+    if len(GEO_INDEX):
+        coords = await geocode_address(order.pickup_address_ko)
+
+    if coords:
+        lat, lon = coords
+        radius = DISPATCH_RADIUS_KM
+        for wave in range(DISPATCH_WAVES):
+            if order.status != ORDER_NEW:
+                return
+            pool = dispatch_candidates() - sent
+            nearest = GEO_INDEX.nearest(lat, lon, DISPATCH_FIRST_K, radius, allowed=pool)
+            n = await send_order_offers(context, order, [cid for _, cid in nearest], sent)
+            log.info(
+                "DISPATCH WAVE | order_id=%s | wave=%s | radius_km=%.1f | sent=%s",
+                order.order_id, wave, radius, n
             )
-        )
+            radius *= DISPATCH_RADIUS_GROWTH
+            if n:
+                await asyncio.sleep(DISPATCH_WAVE_SEC)
 
-    # курьеры
-    for cid, prof in COURIERS.items():
-        if prof.status != COURIER_APPROVED:
-            continue
+    if order.status != ORDER_NEW:
+        return
+    n = await send_order_offers(context, order, dispatch_candidates(), sent)
+    log.info("DISPATCH BROADCAST | order_id=%s | sent=%s | total=%s", order.order_id, n, len(sent))
 
-        # предупреждение про Naver тоже в фоне
-        tasks.append(
-            asyncio.create_task(
-                _send_courier_naver_warning_once(context, cid)
-            )
-        )
 
-        tasks.append(
-            asyncio.create_task(
-                safe_send(
-                    lambda ccid=cid: context.bot.send_message(
-                        chat_id=ccid,
-                        text=text,
-                        reply_markup=kb_order_offer(order),
-                    ),
-                    "Courier"
-                )
-            )
-        )
+async def notify_new_order(context: ContextTypes.DEFAULT_TYPE, order: Order):
+    text = render_order_offer_text(order)
+
+    # админы
+    admin_notify(
+        context.bot,
+        f"🆕 Новый заказ\n\n{text}",
+        order_id=order.order_id,
+        label=f"🆕 новый · {order.price_krw} вон"
+    )
+
+    # курьеры - волнами, от ближайших к дальним.
+    # волны ждут между собой, поэтому слот лимита не держим
+    TASKS.spawn("dispatch", dispatch_order_offers(context, order), bounded=False)
 
     # 🔑 НЕ await !!!
-    # просто даем задачам уйти в фон
+    # задачи уходят в фон под присмотром TASKS
 
 
 async def notify_order_canceled(context: ContextTypes.DEFAULT_TYPE, order: Order):
-    for admin_id in ADMIN_IDS:
-        try:
-            await tg_retry(lambda aid=admin_id: context.bot.send_message(
-                chat_id=aid,
-                text=f"🗑 Заказ #{order.order_id} отозван клиентом."
-            ))
-        except Exception as e:
-            log.warning("Admin cancel notify failed: %s", e)
+    admin_notify(
+        context.bot,
+        f"🗑 Заказ #{order.order_id} отозван клиентом.",
+        order_id=order.order_id,
+        label="🗑 отозван клиентом"
+    )
 
-    for cid, prof in COURIERS.items():
-        if prof.status != COURIER_APPROVED:
-            continue
-        try:
-            await tg_retry(lambda ccid=cid: context.bot.send_message(
-                chat_id=ccid,
-                text=f"🗑 Заказ #{order.order_id} отозван и больше недоступен."
-            ))
-        except Exception as e:
-            log.warning("Courier cancel notify failed: %s", e)
+    # курьерам - правим уже разосланные офферы, без новой рассылки
+    TASKS.spawn(
+        "retire_offers",
+        retire_order_offers(context, order, "🗑 Заказ отозван и больше недоступен.")
+    )
 
 
 async def notify_order_bad_address(context: ContextTypes.DEFAULT_TYPE, order: Order):
@@ -1521,149 +2996,206 @@ async def notify_order_bad_address(context: ContextTypes.DEFAULT_TYPE, order: Or
         ))
     except Exception as e:
         log.warning("Client bad-address notify failed: %s", e)
-
-    # админам
-    for admin_id in ADMIN_IDS:
-        try:
-            await tg_retry(lambda aid=admin_id: context.bot.send_message(
-                chat_id=aid,
-                text=f"⚠️ Заказ #{order.order_id}: курьер отметил адрес некорректным. Заказ скрыт из доступных."
-            ))
-        except Exception as e:
-            log.warning("Admin bad-address notify failed: %s", e)
+    publish_client_status(context.bot, order.order_id)
+
+    # админам - критичное событие, всегда сразу
+    admin_notify(
+        context.bot,
+        f"⚠️ Заказ #{order.order_id}: курьер отметил адрес некорректным. Заказ скрыт из доступных.",
+        order_id=order.order_id,
+        label="⚠️ адрес некорректен",
+        critical=True
+    )
 
 
 # =========================
 # ADMIN CALLBACKS
 # =========================
-async def handle_admin_callbacks(query, context: ContextTypes.DEFAULT_TYPE, data: str):
-    uid = query.from_user.id
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "5"))
 
-    if data == "admin:new_orders":
-        items = list(ORDERS.values())
-        if not items:
-            await ui_render(context, uid, "Пока нет заказов.")
-            return
 
-        items.sort(key=lambda o: int(o.order_id), reverse=True)
-        for o in items[:10]:
-            await ui_render(
-                context,
-                uid,
-                render_admin_order_line(o),
-                reply_markup=kb_admin_menu()
-            )
-        return
+def admin_period_since(period: str) -> Optional[datetime]:
+    days = ADMIN_ORDER_PERIODS.get(period, ("", None))[1]
+    if days is None:
+        return None
+    today = datetime.combine(date.today(), datetime.min.time())
+    return today - timedelta(days=days - 1)
 
-    if data == "admin:apps":
-        pending = [c for c in COURIERS.values() if c.status == COURIER_PENDING]
-        if not pending:
-            await ui_render(context, uid, "Нет заявок.")
-            return
-        for c in pending:
-            text = (
-                "🧍 Заявка курьера\n\n"
-                f"Имя: {c.name}\n"
-                f"Телефон: {c.phone}\n"
-                f"Транспорт: {c.transport}\n"
-                f"ID: {c.courier_tg_id}"
-            )
-            await ui_render(
-                context,
-                uid,
-                text,
-                reply_markup=kb_admin_app_decision(c.courier_tg_id)
-            )
-        return
 
-    if data == "admin:approved":
-        approved = [c for c in COURIERS.values() if c.status == COURIER_APPROVED]
-        if not approved:
-            await ui_render(context, uid, "Нет одобренных курьеров.")
-            return
-        lines = [f"{c.name} - {c.phone} - {c.transport} (ID {c.courier_tg_id})" for c in approved]
-        await ui_render(context, uid, "\n".join(lines))
-        return
+def render_admin_orders_page(flt: str, period: str, cursor: str) -> tuple[str, InlineKeyboardMarkup]:
+    if flt not in ADMIN_ORDER_FILTERS:
+        flt = "new"
+    if period not in ADMIN_ORDER_PERIODS:
+        period = "all"
+    label, statuses = ADMIN_ORDER_FILTERS[flt]
 
-    if data.startswith("admin:approve:"):
-        cid = int(data.split(":")[-1])
-        c = COURIERS.get(cid)
-        if not c:
-            await ui_render(context, uid, "Курьер не найден.")
-            return
+    since = admin_period_since(period)
+    if since is None:
+        accept = lambda o: True
+    else:
+        accept = lambda o: (parse_ts(o.created_at) or datetime.min) >= since
 
-        c.status = COURIER_APPROVED
-        c.approved_at = now_ts()
-        c.rejected_at = ""
-        COURIERS[cid] = c
+    items, has_prev, has_next = ORDER_INDEX.page(statuses, accept, cursor, ADMIN_PAGE_SIZE)
 
-        if SHEETS:
-            SHEETS.upsert_courier(asdict(c))
-            SHEETS.log_event(uid, ROLE_COURIER, "COURIER_APPROVED", meta=str(cid))
+    head = f"{label} · {ADMIN_ORDER_PERIODS[period][0]} (в статусе всего: {ORDER_INDEX.count(statuses)})"
+    body = "\n\n".join(render_admin_order_line(o) for o in items) if items else "Заказов нет."
+    return f"{head}\n\n{body}", kb_admin_orders(flt, period, items, has_prev, has_next)
 
-        await ui_render(context, uid, "✅ Курьер одобрен.")
-        await tg_retry(lambda: context.bot.send_message(
-            chat_id=cid,
-            text="✅ Вы одобрены как курьер. Новые заказы будут приходить автоматически.",
-            reply_markup=kb_courier_menu_approved(cid)
-        ))
-        return
 
-    if data.startswith("admin:reject:"):
-        cid = int(data.split(":")[-1])
-        c = COURIERS.get(cid)
-        if not c:
-            await ui_render(context, uid, "Курьер не найден.")
-            return
+def render_admin_apps_page(page: int) -> tuple[str, InlineKeyboardMarkup]:
+    pending = sorted(
+        (c for c in COURIERS.values() if c.status == COURIER_PENDING),
+        key=lambda c: (c.applied_at, c.courier_tg_id)
+    )
+    if not pending:
+        return "Нет заявок.", kb_admin_menu()
+
+    page = max(0, min(page, len(pending) - 1))
+    c = pending[page]
+    text = (
+        f"🧍 Заявка курьера {page + 1} из {len(pending)}\n\n"
+        f"Имя: {c.name}\n"
+        f"Телефон: {c.phone}\n"
+        f"Транспорт: {c.transport}\n"
+        f"Подана: {c.applied_at}\n"
+        f"ID: {c.courier_tg_id}"
+    )
+    return text, kb_admin_app_page(c.courier_tg_id, page, len(pending))
 
-        c.status = COURIER_REJECTED
-        c.rejected_at = now_ts()
-        c.approved_at = ""
-        COURIERS[cid] = c
 
-        if SHEETS:
-            SHEETS.upsert_courier(asdict(c))
-            SHEETS.log_event(uid, ROLE_COURIER, "COURIER_REJECTED", meta=str(cid))
+@CALLBACKS.route("admin:menu", guard=is_admin)
+async def cb_admin_menu(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    await ui_render(context, uid, "🛠 Панель администратора", reply_markup=kb_admin_menu())
 
-        await ui_render(context, uid, "❌ Заявка отклонена.")
-        await tg_retry(lambda: context.bot.send_message(
-            chat_id=cid,
-            text="К сожалению, ваша заявка отклонена."
-        ))
-        return
 
+@CALLBACKS.route("admin:orders:{flt}:{period}:{cursor}", guard=is_admin)
+async def cb_admin_orders(query, context: ContextTypes.DEFAULT_TYPE, uid: int, flt: str, period: str, cursor: str):
+    # одна страница = одна правка UI-сообщения
+    text, kb = render_admin_orders_page(flt, period, cursor)
+    await ui_render(context, uid, text, reply_markup=kb)
 
+
+@CALLBACKS.route("admin:new_orders", guard=is_admin)
+async def cb_admin_new_orders(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    # старые кнопки в истории чата
+    await cb_admin_orders(query, context, uid, "new", "all", "0")
+
+
+@CALLBACKS.route("admin:apps:{page:int}", guard=is_admin)
+async def cb_admin_apps_page(query, context: ContextTypes.DEFAULT_TYPE, uid: int, page: int):
+    text, kb = render_admin_apps_page(page)
+    await ui_render(context, uid, text, reply_markup=kb)
+
+
+@CALLBACKS.route("admin:apps", guard=is_admin)
+async def cb_admin_apps(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    await cb_admin_apps_page(query, context, uid, 0)
+
+
+@CALLBACKS.route("admin:approved", guard=is_admin)
+async def cb_admin_approved(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    approved = [c for c in COURIERS.values() if c.status == COURIER_APPROVED]
+    if not approved:
+        await ui_render(context, uid, "Нет одобренных курьеров.")
+        return
+    lines = [f"{c.name} - {c.phone} - {c.transport} (ID {c.courier_tg_id})" for c in approved]
+    await ui_render(context, uid, "\n".join(lines))
+
+
+@CALLBACKS.route("admin:approve:{cid:int}", guard=is_admin, idempotent=True)
+async def cb_admin_approve(query, context: ContextTypes.DEFAULT_TYPE, uid: int, cid: int):
+    c = COURIERS.get(cid)
+    if not c:
+        await ui_render(context, uid, "Курьер не найден.")
+        return
+
+    c.status = COURIER_APPROVED
+    c.approved_at = now_ts()
+    c.rejected_at = ""
+    c.on_shift = True
+    c.shift_changed_at = c.approved_at
+    COURIERS[cid] = c
+    ON_SHIFT.add(cid)
+    touch_courier_activity(cid)
+    reindex_courier(cid)
+
+    if SHEETS:
+        SHEETS.upsert_courier(asdict(c))
+        SHEETS.log_event(uid, ROLE_COURIER, "COURIER_APPROVED", meta=str(cid))
+
+    text, kb = render_admin_apps_page(0)
+    await ui_render(context, uid, f"✅ Курьер одобрен.\n\n{text}", reply_markup=kb)
+    await tg_retry(lambda: context.bot.send_message(
+        chat_id=cid,
+        text="✅ Вы одобрены как курьер. Новые заказы будут приходить автоматически.",
+        reply_markup=kb_courier_menu_approved(cid)
+    ))
+
+
+@CALLBACKS.route("admin:reject:{cid:int}", guard=is_admin, idempotent=True)
+async def cb_admin_reject(query, context: ContextTypes.DEFAULT_TYPE, uid: int, cid: int):
+    c = COURIERS.get(cid)
+    if not c:
+        await ui_render(context, uid, "Курьер не найден.")
+        return
+
+    c.status = COURIER_REJECTED
+    c.rejected_at = now_ts()
+    c.approved_at = ""
+    c.on_shift = False
+    COURIERS[cid] = c
+    ON_SHIFT.discard(cid)
+    reindex_courier(cid)
+
+    if SHEETS:
+        SHEETS.upsert_courier(asdict(c))
+        SHEETS.log_event(uid, ROLE_COURIER, "COURIER_REJECTED", meta=str(cid))
+
+    text, kb = render_admin_apps_page(0)
+    await ui_render(context, uid, f"❌ Заявка отклонена.\n\n{text}", reply_markup=kb)
+    await tg_retry(lambda: context.bot.send_message(
+        chat_id=cid,
+        text="К сожалению, ваша заявка отклонена."
+    ))
+
+
+# =========================
+# COURIER: CURRENT ORDERS
 # =========================
-# COURIER: CURRENT ORDERS
-# =========================
-async def show_current_orders_for_courier(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+COURIER_PAGE_SIZE = int(os.getenv("COURIER_PAGE_SIZE", "5"))
+
+
+async def show_current_orders_for_courier(context: ContextTypes.DEFAULT_TYPE, chat_id: int, cursor: str = "0"):
+    """
+    Карусель NEW-заказов: одна страница = одна правка UI-сообщения.
+    Страницы - курсором по ORDER_INDEX (новые первыми).
+    """
     if not courier_is_approved(chat_id):
-        await tg_retry(lambda: context.bot.send_message(chat_id=chat_id, text="Нет доступа."))
+        await ui_render(context, chat_id, "Нет доступа.")
         return
 
-    items = [o for o in ORDERS.values() if o.status == ORDER_NEW]
+    items, has_prev, has_next = ORDER_INDEX.page((ORDER_NEW,), lambda o: True, cursor, COURIER_PAGE_SIZE)
     if not items:
-        await tg_retry(lambda: context.bot.send_message(chat_id=chat_id, text="Сейчас нет доступных заявок."))
+        await ui_render(
+            context,
+            chat_id,
+            "📭 Сейчас нет доступных заявок.",
+            reply_markup=kb_courier_orders_page([], False, False)
+        )
         return
 
-    items.sort(key=lambda o: int(o.order_id), reverse=True)
-
-    await _send_courier_naver_warning_once(context, chat_id)
-    await tg_retry(lambda: context.bot.send_message(chat_id=chat_id, text="📋 Текущие заявки:"))
+    text = (
+        f"📋 Текущие заявки ({ORDER_INDEX.count((ORDER_NEW,))})\n"
+        "Перед принятием проверьте адреса в Naver.\n\n"
+        + "\n\n".join(render_order_card(o) for o in items)
+    )
+    await ui_render(
+        context,
+        chat_id,
+        text,
+        reply_markup=kb_courier_orders_page(items, has_prev, has_next)
+    )
 
-    for o in items[:20]:
-        try:
-            await tg_retry(lambda order=o: context.bot.send_message(
-                chat_id=chat_id,
-                text=render_order_offer_text(order),
-                reply_markup=kb_order_offer(order),
-                
-            ))
-        except BadRequest as e:
-            # чтобы не "висло" на одной битой отправке
-            log.warning("BadRequest sending current order %s to %s: %s", o.order_id, chat_id, e)
-        except Exception as e:
-            log.warning("Failed sending current order %s to %s: %s", o.order_id, chat_id, e)
 
 async def handle_picked_up(query, context, courier_id: int, order_id: str):
     async with ORDER_LOCK:
@@ -1680,6 +3212,7 @@ async def handle_picked_up(query, context, courier_id: int, order_id: str):
 
         order.status = ORDER_PICKED_UP
         ORDERS[order_id] = order
+        reindex_order(order)
 
         if SHEETS:
             SHEETS.update_order(asdict(order))
@@ -1691,6 +3224,153 @@ async def handle_picked_up(query, context, courier_id: int, order_id: str):
         "📦 Заказ у вас на руках.\nКогда доставите — нажмите кнопку ниже.",
         reply_markup=kb_order_picked_up(order.order_id)
     )
+    publish_client_status(context.bot, order.order_id)
+
+# =========================
+# CLIENT LIVE STATUS (одно сообщение на заказ)
+# =========================
+# Вместо отдельного сообщения клиенту на каждый переход - одно закрепленное
+# сообщение со статусом заказа, которое правится на месте.
+# Переходы, пришедшие пока правка ждет лимитер, схлопываются в одну правку.
+CLIENT_STATUS_PIN = os.getenv("CLIENT_STATUS_PIN", "1").strip() == "1"
+CLIENT_STATUS_MIN_INTERVAL_SEC = float(os.getenv("CLIENT_STATUS_MIN_INTERVAL_SEC", "1.0"))
+CLIENT_STATUS_KEY = "client_status_msgs"    # ключ в bot_data (переживает рестарт)
+
+# order_id -> [chat_id, message_id, fingerprint]
+CLIENT_STATUS_MSGS: Dict[str, list] = {}
+CLIENT_STATUS_DIRTY: set = set()
+CLIENT_STATUS_WORKERS: Dict[str, asyncio.Task] = {}
+CLIENT_STATUS_STATS: Dict[str, int] = {
+    "sent": 0,
+    "edited": 0,
+    "coalesced": 0,
+    "skipped": 0,
+    "failed": 0,
+}
+_CLIENT_STATUS_FINAL = (ORDER_DONE, ORDER_CANCELED)
+
+
+@cached_order_render("live_kb")
+def kb_client_live_status(order: Order) -> Optional[InlineKeyboardMarkup]:
+    if order.status == ORDER_PROBLEM:
+        return InlineKeyboardMarkup([[
+            InlineKeyboardButton(f"🗑 Удалить заказ #{order.order_id}", callback_data=f"client:delete:{order.order_id}")
+        ]])
+    if order.status == ORDER_NEW:
+        return InlineKeyboardMarkup([[
+            InlineKeyboardButton("🗑 Отозвать заказ", callback_data=f"client:cancel:{order.order_id}")
+        ]])
+    return None
+
+
+def publish_client_status(bot, order_id: str):
+    """
+    Пометить статус заказа для клиента устаревшим. Не ждет Telegram:
+    правку делает фоновый воркер (по одному на заказ).
+    """
+    order_id = str(order_id)
+    if order_id in CLIENT_STATUS_DIRTY:
+        CLIENT_STATUS_STATS["coalesced"] += 1
+        return
+    CLIENT_STATUS_DIRTY.add(order_id)
+    if order_id not in CLIENT_STATUS_WORKERS:
+        task = TASKS.spawn("client_status", _client_status_worker(bot, order_id))
+        if task:
+            CLIENT_STATUS_WORKERS[order_id] = task
+
+
+async def _client_status_worker(bot, order_id: str):
+    try:
+        while order_id in CLIENT_STATUS_DIRTY:
+            await TG_EDIT_LIMITER.wait()
+            # все, что пришло до этого момента, уйдет одной правкой
+            CLIENT_STATUS_DIRTY.discard(order_id)
+            await _client_status_apply(bot, order_id)
+            await asyncio.sleep(CLIENT_STATUS_MIN_INTERVAL_SEC)
+    finally:
+        CLIENT_STATUS_WORKERS.pop(order_id, None)
+
+
+async def _client_status_apply(bot, order_id: str):
+    order = ORDERS.get(order_id)
+    if not order:
+        CLIENT_STATUS_MSGS.pop(order_id, None)
+        return
+
+    text = render_client_status(order)
+    kb = kb_client_live_status(order)
+    fp = ui_fingerprint(text, kb)
+    final = order.status in _CLIENT_STATUS_FINAL
+
+    entry = CLIENT_STATUS_MSGS.get(order_id)
+    if entry and entry[2] == fp:
+        CLIENT_STATUS_STATS["skipped"] += 1
+        return
+
+    if entry:
+        chat_id, message_id = entry[0], entry[1]
+        try:
+            await tg_retry(lambda: bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=text,
+                reply_markup=kb
+            ))
+            CLIENT_STATUS_STATS["edited"] += 1
+            entry[2] = fp
+        except BadRequest as e:
+            # tg_retry отдает BadRequest сразу, без повторов - разбираем здесь
+            err = str(e).lower()
+            if "not modified" in err:
+                entry[2] = fp
+            elif "not found" in err or "can't be edited" in err:
+                # клиент удалил сообщение или оно старше 48 ч - пришлем новое
+                CLIENT_STATUS_MSGS.pop(order_id, None)
+                entry = None
+            else:
+                CLIENT_STATUS_STATS["failed"] += 1
+                log.warning("CLIENT STATUS EDIT FAILED | order_id=%s | %s", order_id, e)
+                return
+        except Exception as e:
+            CLIENT_STATUS_STATS["failed"] += 1
+            log.warning("CLIENT STATUS EDIT FAILED | order_id=%s | %s", order_id, e)
+            return
+
+    if entry is None:
+        if final:
+            # финал без живого сообщения - клиент и так получил итог (фото / экран отмены)
+            return
+        try:
+            msg = await tg_retry(lambda: bot.send_message(
+                chat_id=order.client_tg_id,
+                text=text,
+                reply_markup=kb
+            ))
+        except Exception as e:
+            CLIENT_STATUS_STATS["failed"] += 1
+            log.warning("CLIENT STATUS SEND FAILED | order_id=%s | %s", order_id, e)
+            return
+        CLIENT_STATUS_STATS["sent"] += 1
+        entry = [msg.chat_id, msg.message_id, fp]
+        CLIENT_STATUS_MSGS[order_id] = entry
+        if CLIENT_STATUS_PIN:
+            try:
+                await bot.pin_chat_message(
+                    chat_id=msg.chat_id,
+                    message_id=msg.message_id,
+                    disable_notification=True
+                )
+            except Exception as e:
+                log.warning("CLIENT STATUS PIN FAILED | order_id=%s | %s", order_id, e)
+
+    if final:
+        CLIENT_STATUS_MSGS.pop(order_id, None)
+        if CLIENT_STATUS_PIN:
+            try:
+                await bot.unpin_chat_message(chat_id=entry[0], message_id=entry[1])
+            except Exception as e:
+                log.warning("CLIENT STATUS UNPIN FAILED | order_id=%s | %s", order_id, e)
+
 
 # =========================
 # CLIENT: STATUS + ORDERS LIST
@@ -1701,6 +3381,27 @@ def get_client_orders(uid: int) -> List[Order]:
     return items
 
 
+RECENT_ADDR_LIMIT = 4
+
+
+def client_recent_addresses(uid: int, kind: str, limit: int = RECENT_ADDR_LIMIT) -> List[str]:
+    """
+    Последние адреса клиента (kind: pickup / drop), без повторов по нормализованному виду.
+    """
+    seen = set()
+    out: List[str] = []
+    for o in get_client_orders(uid):
+        addr = o.pickup_address_ko if kind == "pickup" else o.drop_address_ko
+        key = normalize_korean_address(addr)
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        out.append(addr.strip())
+        if len(out) >= limit:
+            break
+    return out
+
+
 def pick_active_order(uid: int) -> Optional[Order]:
     items = get_client_orders(uid)
     for o in items:
@@ -1795,6 +3496,8 @@ async def handle_take_order(query, context: ContextTypes.DEFAULT_TYPE, courier_i
         order.courier_name = prof.name if prof else ""
         order.courier_phone = prof.phone if prof else ""
         ORDERS[order_id] = order
+        reindex_order(order)
+        BUSY_COURIERS.add(courier_id)
 
         if SHEETS:
             SHEETS.update_order(asdict(order))
@@ -1805,6 +3508,18 @@ async def handle_take_order(query, context: ContextTypes.DEFAULT_TYPE, courier_i
                 order_id=order_id
             )
 
+    # офферы у остальных курьеров гасим в фоне, без второй рассылки
+    TASKS.spawn(
+        "retire_offers",
+        retire_order_offers(
+            context,
+            order,
+            "🔒 Заказ взят и больше недоступен.",
+            taker_id=courier_id,
+            taker_note="✅ Вы взяли этот заказ."
+        )
+    )
+
     # 🔑 ВОТ ЭТА СТРОКА — КРИТИЧЕСКАЯ
     context.user_data.pop(UI_MSG_ID_KEY, None)
 
@@ -1815,16 +3530,15 @@ async def handle_take_order(query, context: ContextTypes.DEFAULT_TYPE, courier_i
         render_order_taken_text(order),
         reply_markup=kb_order_taken_with_copy(order.order_id)
     )
+    publish_client_status(context.bot, order.order_id)
 
     # уведомления админам (вне UI)
-    for admin_id in ADMIN_IDS:
-        try:
-            await tg_retry(lambda aid=admin_id: context.bot.send_message(
-                chat_id=aid,
-                text=f"✅ Заказ #{order.order_id} взят курьером {order.courier_name} {order.courier_phone}".strip()
-            ))
-        except Exception as e:
-            log.warning("Admin taken notify failed: %s", e)
+    admin_notify(
+        context.bot,
+        f"✅ Заказ #{order.order_id} взят курьером {order.courier_name} {order.courier_phone}".strip(),
+        order_id=order.order_id,
+        label=f"✅ взят · {order.courier_name}".strip()
+    )
 
 
 async def handle_bad_address(query, context: ContextTypes.DEFAULT_TYPE, courier_id: int, order_id: str):
@@ -1847,6 +3561,7 @@ async def handle_bad_address(query, context: ContextTypes.DEFAULT_TYPE, courier_
         order.canceled_at = ""
         order.canceled_by = ""
         ORDERS[order_id] = order
+        reindex_order(order)
 
         if SHEETS:
             SHEETS.update_order(asdict(order))
@@ -1862,6 +3577,11 @@ async def handle_bad_address(query, context: ContextTypes.DEFAULT_TYPE, courier_
         f"⚠️ Ок, заказ #{order.order_id} помечен как проблемный..."
     )
 
+    TASKS.spawn(
+        "retire_offers",
+        retire_order_offers(context, order, "⚠️ Адрес отмечен некорректным. Заказ недоступен.")
+    )
+
     await notify_order_bad_address(context, order)
 
 
@@ -1887,6 +3607,7 @@ async def handle_in_progress_clicked(query, context: ContextTypes.DEFAULT_TYPE,
         order.in_progress_at = now_ts()
         order.status = ORDER_EN_ROUTE
         ORDERS[order_id] = order
+        reindex_order(order)
 
         if SHEETS:
             SHEETS.update_order(asdict(order))
@@ -1899,26 +3620,15 @@ async def handle_in_progress_clicked(query, context: ContextTypes.DEFAULT_TYPE,
         reply_markup=kb_order_en_route(order.order_id)
     )
 
-    try:
-        await tg_retry(lambda: context.bot.send_message(
-            chat_id=order.client_tg_id,
-            text=(
-                "🚗 Курьер выехал к вам.\n"
-                f"В пути с: {order.in_progress_at}\n"
-                f"Курьер: {order.courier_name} {order.courier_phone}"
-            ).strip()
-        ))
-    except Exception as e:
-        log.warning("Client in-progress notify failed: %s", e)
+    # клиенту - правка живого статуса вместо нового сообщения
+    publish_client_status(context.bot, order.order_id)
 
-    for admin_id in ADMIN_IDS:
-        try:
-            await tg_retry(lambda aid=admin_id: context.bot.send_message(
-                chat_id=aid,
-                text=f"🚗 Заказ #{order.order_id} - курьер в пути (с {order.in_progress_at})."
-            ))
-        except Exception as e:
-            log.warning("Admin in-progress notify failed: %s", e)
+    admin_notify(
+        context.bot,
+        f"🚗 Заказ #{order.order_id} - курьер в пути (с {order.in_progress_at}).",
+        order_id=order.order_id,
+        label="🚗 в пути"
+    )
 
 
 async def handle_done_clicked(query, context: ContextTypes.DEFAULT_TYPE, courier_id: int, order_id: str):
@@ -1941,12 +3651,14 @@ async def handle_done_clicked(query, context: ContextTypes.DEFAULT_TYPE, courier
         order.status = ORDER_DONE_PENDING
         order.done_requested_at = now_ts()
         ORDERS[order_id] = order
+        reindex_order(order)
         if SHEETS:
             SHEETS.update_order(asdict(order))
             SHEETS.log_event(courier_id, ROLE_COURIER, "DONE_CLICKED", order_id=order_id)
 
     context.user_data[COURIER_STATE_KEY] = K_AWAITING_PROOF
     context.user_data["awaiting_proof_order_id"] = order_id
+    publish_client_status(context.bot, order_id)
 
     await ui_render(
         context,
@@ -2010,6 +3722,8 @@ async def handle_proof_photo(update: Update, context: ContextTypes.DEFAULT_TYPE)
         order.completed_at = now_ts()
         order.status = ORDER_DONE
         ORDERS[order_id] = order
+        reindex_order(order)
+        refresh_courier_busy(uid)
 
         if SHEETS:
             SHEETS.update_order(asdict(order))
@@ -2035,20 +3749,19 @@ async def handle_proof_photo(update: Update, context: ContextTypes.DEFAULT_TYPE)
         ))
     except Exception as e:
         log.warning("Client proof send failed: %s", e)
+    publish_client_status(context.bot, order.order_id)
 
     # уведомляем админов
-    for admin_id in ADMIN_IDS:
-        try:
-            await tg_retry(lambda aid=admin_id: context.bot.send_photo(
-                chat_id=aid,
-                photo=file_id,
-                caption=(
-                    f"✅ Заказ #{order.order_id} завершен.\n"
-                    f"Курьер: {order.courier_name}, {order.courier_phone}"
-                )
-            ))
-        except Exception as e:
-            log.warning("Admin proof send failed: %s", e)
+    admin_notify(
+        context.bot,
+        (
+            f"✅ Заказ #{order.order_id} завершен.\n"
+            f"Курьер: {order.courier_name}, {order.courier_phone}"
+        ),
+        order_id=order.order_id,
+        label="🏁 выполнен",
+        photo=file_id
+    )
 
     context.user_data[COURIER_STATE_KEY] = K_NONE
     context.user_data.pop("awaiting_proof_order_id", None)
@@ -2071,12 +3784,14 @@ async def handle_client_cancel(query, context: ContextTypes.DEFAULT_TYPE, uid: i
         order.canceled_at = now_ts()
         order.canceled_by = "client"
         ORDERS[order_id] = order
+        reindex_order(order)
 
         if SHEETS:
             SHEETS.update_order(asdict(order))
             SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_CANCELED_BY_CLIENT", order_id=order_id)
 
     await ui_render(context, uid, "🗑 Заказ отозван.", reply_markup=kb_client_menu())
+    publish_client_status(context.bot, order_id)
     await notify_order_canceled(context, order)
 
 
@@ -2097,169 +3812,968 @@ async def handle_client_delete_problem(query, context: ContextTypes.DEFAULT_TYPE
         order.canceled_at = now_ts()
         order.canceled_by = "client_delete_problem"
         ORDERS[order_id] = order
+        reindex_order(order)
+        refresh_courier_busy(order.courier_tg_id)
 
         if SHEETS:
             SHEETS.update_order(asdict(order))
             SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_DELETED_AFTER_BADADDR", order_id=order_id)
 
     await ui_render(context, uid, "🗑 Заказ удален.", reply_markup=kb_client_menu())
+    publish_client_status(context.bot, order_id)
 
 # =========================
-# GOOGLE GEOCODE & Distance Matrix
+# PROVIDER HEALTH (circuit breakers)
 # =========================
+# closed    - провайдер работает, ошибки считаем подряд;
+# open      - после BREAKER_FAIL_THRESHOLD ошибок подряд не ходим BREAKER_OPEN_SEC;
+# half_open - пускаем один пробный запрос: успех закрывает, ошибка снова открывает.
+# health    - скользящая оценка 0..1 по последним HEALTH_WINDOW запросам (ошибки + латентность).
+BREAKER_FAIL_THRESHOLD = int(os.getenv("BREAKER_FAIL_THRESHOLD", "3"))
+BREAKER_OPEN_SEC = float(os.getenv("BREAKER_OPEN_SEC", "30"))
+HEALTH_WINDOW = int(os.getenv("HEALTH_WINDOW", "50"))
+HEALTH_SLOW_MS = float(os.getenv("HEALTH_SLOW_MS", "1500"))
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
+_PROVIDER_FAILED = object()
+
+
+class CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.state = BREAKER_CLOSED
+        self.failures_in_row = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.skipped = 0
+        self.window: deque = deque(maxlen=HEALTH_WINDOW)   # (ok, ms)
+
+    def available(self) -> bool:
+        """
+        Можно ли рассчитывать на провайдера (без резервирования пробы).
+        """
+        if self.state == BREAKER_CLOSED:
+            return True
+        if self.state == BREAKER_OPEN:
+            return time.monotonic() - self.opened_at >= BREAKER_OPEN_SEC
+        return not self.probe_in_flight
+
+    def allow(self) -> bool:
+        if self.state == BREAKER_CLOSED:
+            return True
+        if self.state == BREAKER_OPEN and time.monotonic() - self.opened_at >= BREAKER_OPEN_SEC:
+            self.state = BREAKER_HALF_OPEN
+            self.probe_in_flight = False
+            log.info("BREAKER HALF-OPEN | %s", self.name)
+        if self.state == BREAKER_HALF_OPEN and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        self.skipped += 1
+        return False
 
-import math
+    def release(self):
+        # проба отменена (hedge/дедлайн) - результата нет, даем шанс следующей
+        self.probe_in_flight = False
 
-def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    R = 6371.0  # Earth radius in km
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
+    def record(self, ok: bool, ms: float):
+        self.window.append((ok, ms))
+        self.probe_in_flight = False
 
-    a = (
-        math.sin(dphi / 2) ** 2
-        + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
-    )
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return R * c
+        if ok:
+            self.failures_in_row = 0
+            if self.state != BREAKER_CLOSED:
+                log.info("BREAKER CLOSED | %s", self.name)
+            self.state = BREAKER_CLOSED
+            return
 
-async def google_geocode(address: str) -> Optional[tuple[float, float]]:
-    if not GOOGLE_MAPS_API_KEY:
-        log.warning("GOOGLE GEOCODE SKIP: API KEY MISSING")
-        return None
+        self.failures_in_row += 1
+        if self.state == BREAKER_HALF_OPEN or self.failures_in_row >= BREAKER_FAIL_THRESHOLD:
+            if self.state != BREAKER_OPEN:
+                log.warning("BREAKER OPEN | %s | failures_in_row=%s", self.name, self.failures_in_row)
+            self.state = BREAKER_OPEN
+            self.opened_at = time.monotonic()
+
+    def health(self) -> float:
+        if not self.window:
+            return 1.0
+        ok_ms = [ms for ok, ms in self.window if ok]
+        success = len(ok_ms) / len(self.window)
+        if not ok_ms:
+            return 0.0
+        avg_ms = sum(ok_ms) / len(ok_ms)
+        speed = 1.0 if avg_ms <= HEALTH_SLOW_MS else HEALTH_SLOW_MS / avg_ms
+        return success * speed
+
+    def render_line(self) -> str:
+        return (
+            f"{self.name}: {self.state} | health {self.health():.2f} | "
+            f"ошибок подряд {self.failures_in_row} | пропущено {self.skipped}"
+        )
 
-    url = "https://maps.googleapis.com/maps/api/geocode/json"
-    params = {
-        "address": address,
-        "key": GOOGLE_MAPS_API_KEY,
-    }
 
+PROVIDER_BREAKERS: Dict[str, CircuitBreaker] = {
+    "google": CircuitBreaker("google"),
+    "naver": CircuitBreaker("naver"),
+}
+
+
+def providers_by_health(names: List[str]) -> List[str]:
+    """
+    Доступные провайдеры, лучшие первыми (при равенстве - исходный порядок).
+    """
+    alive = [n for n in names if PROVIDER_BREAKERS[n].available()]
+    return sorted(alive, key=lambda n: -PROVIDER_BREAKERS[n].health())
+
+
+async def guarded_provider_call(provider: str, factory, label: str):
+    """
+    Вызов провайдера через breaker. Возвращает результат или _PROVIDER_FAILED
+    (провайдер выключен breaker'ом или упал).
+    """
+    breaker = PROVIDER_BREAKERS[provider]
+    if not breaker.allow():
+        log.info("%s %s SKIP: breaker %s", provider.upper(), label, breaker.state)
+        return _PROVIDER_FAILED
+
+    t0 = time.monotonic()
     try:
-        r = await run_blocking(requests.get, url, params=params, timeout=5)
-        log.info("GOOGLE GEOCODE HTTP %s | %s", r.status_code, r.url)
-        r.raise_for_status()
-        data = r.json()
+        res = await factory()
+    except asyncio.CancelledError:
+        breaker.release()
+        raise
     except Exception:
-        log.exception("GOOGLE GEOCODE ERROR")
-        return None
+        breaker.record(False, (time.monotonic() - t0) * 1000)
+        log.exception("%s %s ERROR", provider.upper(), label)
+        return _PROVIDER_FAILED
 
-    if data.get("status") != "OK":
-        return None
+    breaker.record(True, (time.monotonic() - t0) * 1000)
+    return res
 
-    loc = data["results"][0]["geometry"]["location"]
-    return loc["lat"], loc["lng"]
 
-async def google_distance_km(
-    lat1: float,
-    lng1: float,
-    lat2: float,
-    lng2: float,
-) -> Optional[float]:
+# =========================
+# LOCAL CACHE (LRU in memory + SQLite on disk)
+# =========================
+CACHE_DB_PATH = os.getenv("EASYGO_CACHE_DB", "easygo_cache.sqlite3")
 
-    if not GOOGLE_MAPS_API_KEY:
-        log.warning("GOOGLE DISTANCE SKIP: API KEY MISSING")
-        return None
+GEOCODE_CACHE_SIZE = int(os.getenv("GEOCODE_CACHE_SIZE", "2000"))
+GEOCODE_CACHE_TTL_SEC = int(os.getenv("GEOCODE_CACHE_TTL_SEC", str(30 * 24 * 3600)))
+GEOCODE_NEGATIVE_TTL_SEC = int(os.getenv("GEOCODE_NEGATIVE_TTL_SEC", str(24 * 3600)))
 
-    url = "https://maps.googleapis.com/maps/api/distancematrix/json"
-    params = {
-        "origins": f"{lat1},{lng1}",
-        "destinations": f"{lat2},{lng2}",
-        "key": GOOGLE_MAPS_API_KEY,
-        "mode": "driving",
-    }
+_CACHE_MISS = object()
 
-    log.info(
-        "GOOGLE DISTANCE REQUEST | %s,%s -> %s,%s",
-        lat1, lng1, lat2, lng2
-    )
 
-    try:
-        r = await run_blocking(requests.get, url, params=params, timeout=5)
-        log.info(
-            "GOOGLE DISTANCE HTTP %s | %s",
-            r.status_code,
-            r.url
-        )
-        r.raise_for_status()
-        data = r.json()
-    except Exception:
-        log.exception("GOOGLE DISTANCE ERROR")
-        return None
+class PersistentCache:
+    """
+    Двухуровневый кэш: LRU в памяти поверх таблицы SQLite.
+    - значения хранятся как JSON;
+    - None = отрицательный результат ("адрес не найден"), у него свой, короткий TTL;
+    - get() возвращает _CACHE_MISS, если ключа нет или он протух.
+    """
 
-    if data.get("status") != "OK":
-        log.warning(
-            "GOOGLE DISTANCE FAIL | status=%s | body=%s",
-            data.get("status"),
-            data
+    def __init__(self, table: str, db_path: str, capacity: int, ttl_sec: int, negative_ttl_sec: int):
+        self.table = table
+        self.capacity = capacity
+        self.ttl_sec = ttl_sec
+        self.negative_ttl_sec = negative_ttl_sec
+        # key -> (expires_at, value)
+        self._mem: "OrderedDict[str, tuple[float, Any]]" = OrderedDict()
+        self.stats: Dict[str, int] = {
+            "mem_hit": 0,
+            "disk_hit": 0,
+            "negative_hit": 0,
+            "miss": 0,
+            "put": 0,
+            "evicted": 0,
+        }
+
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "k TEXT PRIMARY KEY, v TEXT, provider TEXT, created_at REAL, expires_at REAL)"
+        )
+        self._db.commit()
+
+    def _remember(self, key: str, expires_at: float, value: Any):
+        self._mem[key] = (expires_at, value)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.capacity:
+            self._mem.popitem(last=False)
+            self.stats["evicted"] += 1
+
+    def _count_hit(self, level: str, value: Any) -> Any:
+        self.stats[level] += 1
+        if value is None:
+            self.stats["negative_hit"] += 1
+        return value
+
+    def get(self, key: str) -> Any:
+        now = time.time()
+
+        item = self._mem.get(key)
+        if item is not None:
+            expires_at, value = item
+            if expires_at > now:
+                self._mem.move_to_end(key)
+                return self._count_hit("mem_hit", value)
+            self._mem.pop(key, None)
+
+        row = self._db.execute(
+            f"SELECT v, expires_at FROM {self.table} WHERE k = ?", (key,)
+        ).fetchone()
+        if row and row[1] > now:
+            value = json.loads(row[0])
+            self._remember(key, row[1], value)
+            return self._count_hit("disk_hit", value)
+
+        self.stats["miss"] += 1
+        return _CACHE_MISS
+
+    def put(self, key: str, value: Any, provider: str = ""):
+        now = time.time()
+        ttl = self.negative_ttl_sec if value is None else self.ttl_sec
+        expires_at = now + ttl
+        self._remember(key, expires_at, value)
+        self._db.execute(
+            f"INSERT OR REPLACE INTO {self.table} (k, v, provider, created_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+            (key, json.dumps(value), provider, now, expires_at)
+        )
+        self._db.commit()
+        self.stats["put"] += 1
+
+    def purge_expired(self) -> int:
+        now = time.time()
+        for key in [k for k, (exp, _) in self._mem.items() if exp <= now]:
+            self._mem.pop(key, None)
+        cur = self._db.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (now,))
+        self._db.commit()
+        return cur.rowcount
+
+    def rows(self) -> List[tuple[str, Any]]:
+        """
+        Все непротухшие (key, value) из таблицы - для офлайн-аналитики (матрица зон).
+        """
+        cur = self._db.execute(
+            f"SELECT k, v FROM {self.table} WHERE expires_at > ?", (time.time(),)
+        )
+        return [(k, json.loads(v)) for k, v in cur.fetchall()]
+
+    def hit_rate(self) -> float:
+        hits = self.stats["mem_hit"] + self.stats["disk_hit"]
+        total = hits + self.stats["miss"]
+        return hits / total if total else 0.0
+
+    def render_line(self, title: str) -> str:
+        st = self.stats
+        return (
+            f"{title}: hit {self.hit_rate() * 100:.0f}% | mem {st['mem_hit']} | disk {st['disk_hit']} | "
+            f"neg {st['negative_hit']} | miss {st['miss']} | в памяти {len(self._mem)}/{self.capacity}"
         )
-        return None
 
-    try:
-        el = data["rows"][0]["elements"][0]
-    except Exception:
-        log.warning("GOOGLE DISTANCE BAD STRUCTURE | body=%s", data)
-        return None
 
-    if el.get("status") != "OK":
-        log.warning(
-            "GOOGLE DISTANCE ELEMENT FAIL | status=%s | body=%s",
-            el.get("status"),
-            el
-        )
-        return None
+GEOCODE_CACHE = PersistentCache(
+    "geocode",
+    CACHE_DB_PATH,
+    GEOCODE_CACHE_SIZE,
+    GEOCODE_CACHE_TTL_SEC,
+    GEOCODE_NEGATIVE_TTL_SEC,
+)
 
-    meters = el.get("distance", {}).get("value")
-    if meters is None:
-        log.warning("GOOGLE DISTANCE NO DISTANCE FIELD | body=%s", el)
-        return None
 
-    km = meters / 1000.0
-    log.info("GOOGLE DISTANCE OK | km=%.2f", km)
-    return km
+def geocode_cache_key(provider: str, address: str) -> str:
+    return f"{provider}:{normalize_korean_address(address)}"
 
 
+async def cached_geocode(provider: str, address: str, fetch) -> Optional[tuple[float, float]]:
+    """
+    Кэш перед геокодером. fetch(address) должен:
+    - вернуть (lat, lng) или None, если адрес не найден (None тоже кэшируется);
+    - бросить исключение при сетевой/квотной ошибке (такое не кэшируем).
+    """
+    key = geocode_cache_key(provider, address)
+    hit = GEOCODE_CACHE.get(key)
+    if hit is not _CACHE_MISS:
+        return (hit[0], hit[1]) if hit else None
 
-# =========================
-# NAVER
-# =========================
+    res = await guarded_provider_call(provider, lambda: fetch(address), "GEOCODE")
+    if res is _PROVIDER_FAILED:
+        return None
 
-async def naver_geocode(address: str):
-    url = "https://naveropenapi.apigw.ntruss.com/map-geocode/v2/geocode"
-    headers = {
-        "X-NCP-APIGW-API-KEY-ID": os.getenv("NAVER_CLIENT_ID"),
-        "X-NCP-APIGW-API-KEY": os.getenv("NAVER_CLIENT_SECRET"),
-    }
-    params = {"query": address}
+    GEOCODE_CACHE.put(key, [res[0], res[1]] if res else None, provider=provider)
+    return res
+
+
+# --- маршруты: ключ - пара координат, привязанных к сетке ---
+DIST_GRID_DEG = float(os.getenv("DIST_GRID_DEG", "0.0005"))     # ~50 м
+DIST_CACHE_SIZE = int(os.getenv("DIST_CACHE_SIZE", "5000"))
+DIST_CACHE_TTL_SEC = int(os.getenv("DIST_CACHE_TTL_SEC", str(14 * 24 * 3600)))
+DIST_NEGATIVE_TTL_SEC = int(os.getenv("DIST_NEGATIVE_TTL_SEC", "3600"))
+# A->B и B->A по дорогам не всегда равны, поэтому симметрия - опционально
+DIST_CACHE_SYMMETRIC = os.getenv("DIST_CACHE_SYMMETRIC", "0").strip() == "1"
+CACHE_PURGE_EVERY_SEC = int(os.getenv("CACHE_PURGE_EVERY_SEC", "3600"))
+
+DISTANCE_CACHE = PersistentCache(
+    "distance",
+    CACHE_DB_PATH,
+    DIST_CACHE_SIZE,
+    DIST_CACHE_TTL_SEC,
+    DIST_NEGATIVE_TTL_SEC,
+)
 
-    log.info(
-        "NAVER GEOCODE REQUEST | addr='%s' | id_set=%s | secret_set=%s",
-        address,
-        bool(headers.get("X-NCP-APIGW-API-KEY-ID")),
-        bool(headers.get("X-NCP-APIGW-API-KEY")),
-    )
 
-    r = await run_blocking(requests.get, url, params=params, timeout=5)
+def _grid_point(lat: float, lng: float) -> tuple[int, int]:
+    return int(round(lat / DIST_GRID_DEG)), int(round(lng / DIST_GRID_DEG))
 
-    log.info(
-        "NAVER GEOCODE RESPONSE | status=%s | body=%s",
-        r.status_code,
-        r.text[:300],  # не больше, чтобы не заспамить
-    )
 
-    r.raise_for_status()
-    data = r.json()
+def distance_cache_key(provider: str, lat1: float, lng1: float, lat2: float, lng2: float) -> str:
+    a = _grid_point(lat1, lng1)
+    b = _grid_point(lat2, lng2)
+    if DIST_CACHE_SYMMETRIC and b < a:
+        a, b = b, a
+    return f"{provider}:{a[0]},{a[1]}|{b[0]},{b[1]}"
 
-    if not data.get("addresses"):
+
+async def cached_distance_km(provider: str, lat1: float, lng1: float, lat2: float, lng2: float, fetch) -> Optional[float]:
+    """
+    Кэш перед Distance Matrix / Directions. Контракт fetch такой же, как у cached_geocode:
+    None - маршрута нет (кэшируем коротко), исключение - ошибка провайдера (не кэшируем).
+    """
+    key = distance_cache_key(provider, lat1, lng1, lat2, lng2)
+    hit = DISTANCE_CACHE.get(key)
+    if hit is not _CACHE_MISS:
+        return hit
+
+    km = await guarded_provider_call(provider, lambda: fetch(lat1, lng1, lat2, lng2), "DISTANCE")
+    if km is _PROVIDER_FAILED:
         return None
 
-    a = data["addresses"][0]
-    return float(a["y"]), float(a["x"])  # lat, lon
+    DISTANCE_CACHE.put(key, km, provider=provider)
+    return km
 
-async def naver_route_distance_km(
-    start_lat: float,
-    start_lon: float,
-    goal_lat: float,
+
+async def cache_purge_loop():
+    while True:
+        await asyncio.sleep(CACHE_PURGE_EVERY_SEC)
+        for cache in (GEOCODE_CACHE, DISTANCE_CACHE):
+            try:
+                n = cache.purge_expired()
+            except Exception:
+                log.exception("Cache purge failed | table=%s", cache.table)
+                continue
+            if n:
+                log.info("CACHE PURGE | table=%s | removed=%s", cache.table, n)
+
+
+# =========================
+# STATE PERSISTENCE (user_data / bot_data в SQLite)
+# =========================
+# PTB после апдейтов раз в STATE_FLUSH_INTERVAL_SEC отдает в persistence только
+# тех пользователей, чьи user_data трогали. Мы помечаем их грязными и пишем
+# одной транзакцией (executemany) - по строке на пользователя, а не весь pickle целиком.
+STATE_DB_PATH = os.getenv("EASYGO_STATE_DB", "easygo_state.sqlite3")
+STATE_FLUSH_INTERVAL_SEC = float(os.getenv("STATE_FLUSH_INTERVAL_SEC", "5"))
+STATE_PERSIST_ENABLED = os.getenv("STATE_PERSIST_ENABLED", "1").strip() == "1"
+
+_STATE_DROPPED = object()
+
+
+class SqlitePersistence(BasePersistence):
+    """
+    Persistence для PTB: user_data и bot_data в SQLite.
+    - user_data: строка на пользователя (uid -> pickle), пишутся только грязные;
+    - запись идет в фоне, в executor, пачкой; pickle снимается в event loop,
+      чтобы хендлеры не меняли словари во время сериализации;
+    - chat_data / callback_data / conversations не храним (не используются).
+    """
+
+    def __init__(self, db_path: str, update_interval: float = STATE_FLUSH_INTERVAL_SEC):
+        super().__init__(
+            store_data=PersistenceInput(chat_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS user_state (uid INTEGER PRIMARY KEY, data BLOB, updated_at REAL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS bot_state (k TEXT PRIMARY KEY, data BLOB, updated_at REAL)"
+        )
+        self._db.commit()
+
+        # uid -> живой словарь user_data (или _STATE_DROPPED = удалить строку)
+        self._dirty: Dict[int, Any] = {}
+        self._bot_dirty: Optional[dict] = None
+        self._write_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        self.stats: Dict[str, float] = {
+            "users": 0,
+            "flushes": 0,
+            "rows": 0,
+            "deleted": 0,
+            "bytes": 0,
+            "errors": 0,
+            "write_sec": 0.0,
+        }
+
+    # ---- загрузка ----
+    async def get_user_data(self) -> Dict[int, dict]:
+        out: Dict[int, dict] = {}
+        for uid, blob in self._db.execute("SELECT uid, data FROM user_state"):
+            try:
+                out[int(uid)] = pickle.loads(blob)
+            except Exception:
+                log.exception("STATE LOAD FAILED | uid=%s", uid)
+        self.stats["users"] = len(out)
+        log.info("STATE LOADED | users=%s", len(out))
+        return out
+
+    async def get_bot_data(self) -> dict:
+        row = self._db.execute("SELECT data FROM bot_state WHERE k = 'bot'").fetchone()
+        if not row:
+            return {}
+        try:
+            return pickle.loads(row[0])
+        except Exception:
+            log.exception("STATE LOAD FAILED | bot_data")
+            return {}
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    # ---- пометки ----
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._dirty[user_id] = data
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._dirty[user_id] = _STATE_DROPPED
+        self._schedule_flush()
+
+    async def update_bot_data(self, data: dict) -> None:
+        self._bot_dirty = data
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    # ---- запись ----
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = TASKS.spawn("state_flush", self._flush_soon())
+
+    async def _flush_soon(self):
+        # PTB зовет update_user_data подряд для всех грязных - даем пачке собраться
+        await asyncio.sleep(0.1)
+        await self._flush_dirty()
+
+    def _snapshot(self) -> tuple[list, list, Optional[bytes]]:
+        dirty, self._dirty = self._dirty, {}
+        bot_data, self._bot_dirty = self._bot_dirty, None
+
+        rows, deletes = [], []
+        now = time.time()
+        for uid, data in dirty.items():
+            if data is _STATE_DROPPED:
+                deletes.append((uid,))
+                continue
+            try:
+                rows.append((uid, pickle.dumps(data, pickle.HIGHEST_PROTOCOL), now))
+            except Exception:
+                self.stats["errors"] += 1
+                log.exception("STATE PICKLE FAILED | uid=%s", uid)
+
+        bot_blob = None
+        if bot_data is not None:
+            try:
+                bot_blob = pickle.dumps(bot_data, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                self.stats["errors"] += 1
+                log.exception("STATE PICKLE FAILED | bot_data")
+        return rows, deletes, bot_blob
+
+    def _write(self, rows: list, deletes: list, bot_blob: Optional[bytes]):
+        t0 = time.perf_counter()
+        with self._db:
+            if rows:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO user_state (uid, data, updated_at) VALUES (?, ?, ?)", rows
+                )
+            if deletes:
+                self._db.executemany("DELETE FROM user_state WHERE uid = ?", deletes)
+            if bot_blob is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO bot_state (k, data, updated_at) VALUES ('bot', ?, ?)",
+                    (bot_blob, time.time())
+                )
+        st = self.stats
+        st["flushes"] += 1
+        st["rows"] += len(rows)
+        st["deleted"] += len(deletes)
+        st["bytes"] += sum(len(r[1]) for r in rows)
+        st["write_sec"] += time.perf_counter() - t0
+
+    async def _flush_dirty(self):
+        async with self._write_lock:
+            while self._dirty or self._bot_dirty is not None:
+                rows, deletes, bot_blob = self._snapshot()
+                try:
+                    await run_blocking(self._write, rows, deletes, bot_blob)
+                except Exception:
+                    self.stats["errors"] += 1
+                    log.exception("STATE FLUSH FAILED | rows=%s", len(rows))
+                    return
+
+    async def flush(self) -> None:
+        # остановка: дописываем все, что осталось
+        await self._flush_dirty()
+        self._db.close()
+
+    def render_line(self) -> str:
+        st = self.stats
+        per_row = st["write_sec"] / st["rows"] * 1e6 if st["rows"] else 0.0
+        return (
+            f"Состояние (SQLite): загружено {st['users']} | сбросов {st['flushes']} | "
+            f"строк {st['rows']} | удалено {st['deleted']} | {per_row:.0f} мкс/строка | "
+            f"ждут {len(self._dirty)} | ошибок {st['errors']}"
+        )
+
+
+STATE_STORE: Optional[SqlitePersistence] = (
+    SqlitePersistence(STATE_DB_PATH) if STATE_PERSIST_ENABLED else None
+)
+
+
+def benchmark_state_flush(users: int = 50000, active_share: float = 0.02) -> str:
+    """
+    Блокирующий замер (запускать через run_blocking): стоимость сброса на
+    обновленного пользователя при users пользователях, из которых active_share
+    менялись за интервал. Для сравнения - полный pickle всех user_data,
+    как делает PicklePersistence.
+    """
+    store = SqlitePersistence(":memory:")
+    base = {
+        USER_ROLE_KEY: ROLE_CLIENT,
+        CLIENT_STATE_KEY: C_DROP,
+        UI_MSG_ID_KEY: 123456,
+        UI_FP_KEY: (123456, "0" * 32),
+        "draft_order": {
+            "zone": "other",
+            "pickup_address_ko": "충청남도 아산시 둔포면 둔포중앙로161번길 25",
+            "price_krw": DEFAULT_PRICE_KRW,
+        },
+    }
+    all_data = {uid: dict(base, uid=uid) for uid in range(users)}
+
+    store._dirty = dict(all_data)
+    t0 = time.perf_counter()
+    store._write(*store._snapshot())
+    t_initial = time.perf_counter() - t0
+
+    active = max(1, int(users * active_share))
+    for uid in range(active):
+        all_data[uid][CLIENT_STATE_KEY] = C_DOOR
+        store._dirty[uid] = all_data[uid]
+    t0 = time.perf_counter()
+    store._write(*store._snapshot())
+    t_batch = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    blob = pickle.dumps(all_data, pickle.HIGHEST_PROTOCOL)
+    t_full = time.perf_counter() - t0
+    store._db.close()
+
+    return "\n".join([
+        f"💾 Сброс состояния: {users} польз., изменились {active}",
+        f"первичная запись всех: {t_initial * 1000:.0f} мс",
+        f"пачка грязных: {t_batch * 1000:.1f} мс | {t_batch / active * 1e6:.0f} мкс на пользователя",
+        f"полный pickle всех ({len(blob) // 1024} КБ): {t_full * 1000:.0f} мс | "
+        f"{t_full / active * 1e6:.0f} мкс на пользователя (без записи на диск)",
+    ])
+
+
+# =========================
+# MAP HTTP CLIENT (pooled, async)
+# =========================
+# Один httpx.AsyncClient на провайдера: keep-alive пул соединений,
+# HTTP/2 если установлен h2, свой таймаут и лимит параллельных запросов.
+MAP_HTTP2 = importlib.util.find_spec("h2") is not None
+
+
+@dataclass
+class ProviderHttpStats:
+    requests: int = 0
+    errors: int = 0
+    new_connections: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+
+
+class MapHttpClient:
+    def __init__(self, name: str, timeout_sec: float, max_concurrency: int):
+        self.name = name
+        self.timeout_sec = timeout_sec
+        self.max_concurrency = max_concurrency
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self._client: Optional[httpx.AsyncClient] = None
+        self.stats = ProviderHttpStats()
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=MAP_HTTP2,
+                timeout=self.timeout_sec,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                    keepalive_expiry=60,
+                ),
+            )
+        return self._client
+
+    async def get(self, url: str, params=None, headers=None) -> httpx.Response:
+        new_conn = False
+
+        async def trace(event_name: str, info):
+            # httpcore сообщает о каждом новом TCP-коннекте - по нему считаем reuse
+            nonlocal new_conn
+            if event_name == "connection.connect_tcp.started":
+                new_conn = True
+
+        async with self._sem:
+            t0 = time.monotonic()
+            try:
+                return await self._get_client().get(
+                    url,
+                    params=params,
+                    headers=headers,
+                    extensions={"trace": trace},
+                )
+            except Exception:
+                self.stats.errors += 1
+                raise
+            finally:
+                ms = (time.monotonic() - t0) * 1000
+                self.stats.requests += 1
+                self.stats.total_ms += ms
+                self.stats.max_ms = max(self.stats.max_ms, ms)
+                if new_conn:
+                    self.stats.new_connections += 1
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def render_line(self) -> str:
+        st = self.stats
+        reuse = (1 - st.new_connections / st.requests) * 100 if st.requests else 0.0
+        avg = st.total_ms / st.requests if st.requests else 0.0
+        return (
+            f"HTTP {self.name}{' h2' if MAP_HTTP2 else ''}: req {st.requests} | err {st.errors} | "
+            f"reuse {reuse:.0f}% | avg {avg:.0f} мс | max {st.max_ms:.0f} мс"
+        )
+
+
+MAP_HTTP: Dict[str, MapHttpClient] = {
+    "google": MapHttpClient(
+        "google",
+        float(os.getenv("GOOGLE_HTTP_TIMEOUT_SEC", "5")),
+        int(os.getenv("GOOGLE_HTTP_CONCURRENCY", "10")),
+    ),
+    "naver": MapHttpClient(
+        "naver",
+        float(os.getenv("NAVER_HTTP_TIMEOUT_SEC", "5")),
+        int(os.getenv("NAVER_HTTP_CONCURRENCY", "10")),
+    ),
+}
+
+
+# =========================
+# GOOGLE GEOCODE & Distance Matrix
+# =========================
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    R = 6371.0  # Earth radius in km
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = math.radians(lat2 - lat1)
+    dlambda = math.radians(lon2 - lon1)
+
+    a = (
+        math.sin(dphi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    )
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    return R * c
+
+
+# =========================
+# BATCH DISTANCES (один заказ x N курьеров, N x M для аналитики)
+# =========================
+EARTH_RADIUS_KM = 6371.0
+
+
+def _haversine_rows_py(points_a, points_b) -> List[List[float]]:
+    # косинусы/радианы считаем один раз на точку, а не на каждую пару
+    b = [(math.radians(lat), math.radians(lon), math.cos(math.radians(lat))) for lat, lon in points_b]
+    rows = []
+    for lat, lon in points_a:
+        p1, l1 = math.radians(lat), math.radians(lon)
+        c1 = math.cos(p1)
+        row = []
+        for p2, l2, c2 in b:
+            h = math.sin((p2 - p1) / 2) ** 2 + c1 * c2 * math.sin((l2 - l1) / 2) ** 2
+            row.append(2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1.0, h))))
+        rows.append(row)
+    return rows
+
+
+def _haversine_rows_np(points_a, points_b):
+    a = np.radians(np.asarray(points_a, dtype=np.float64).reshape(-1, 2))
+    b = np.radians(np.asarray(points_b, dtype=np.float64).reshape(-1, 2))
+    lat1, lon1 = a[:, 0:1], a[:, 1:2]
+    lat2, lon2 = b[:, 0], b[:, 1]
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+def haversine_matrix(points_a, points_b, use_numpy: bool = True):
+    """
+    Км между всеми парами [(lat, lon)] x [(lat, lon)]: m[i][j] = a[i] -> b[j].
+    С NumPy - ndarray (len(a), len(b)), без него - список списков.
+    """
+    if not len(points_a) or not len(points_b):
+        return [[] for _ in points_a]
+    if use_numpy and np is not None:
+        return _haversine_rows_np(points_a, points_b)
+    return _haversine_rows_py(points_a, points_b)
+
+
+def haversine_one_to_many(lat: float, lon: float, points) -> List[float]:
+    if not points:
+        return []
+    row = haversine_matrix([(lat, lon)], points)[0]
+    return row.tolist() if np is not None else row
+
+
+def benchmark_haversine(n: int = 1000, m: int = 1000) -> str:
+    """
+    Блокирующий замер n x m (запускать через run_blocking).
+    """
+    rnd = random.Random(42)
+    a = [(36.7 + rnd.random() * 0.3, 126.9 + rnd.random() * 0.3) for _ in range(n)]
+    b = [(36.7 + rnd.random() * 0.3, 126.9 + rnd.random() * 0.3) for _ in range(m)]
+
+    t0 = time.perf_counter()
+    for lat1, lon1 in a:
+        for lat2, lon2 in b:
+            haversine_km(lat1, lon1, lat2, lon2)
+    t_scalar = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    _haversine_rows_py(a, b)
+    t_py = time.perf_counter() - t0
+
+    lines = [
+        f"📏 Haversine {n}×{m}",
+        f"haversine_km в цикле: {t_scalar * 1000:.0f} мс",
+        f"batch (Python): {t_py * 1000:.0f} мс | x{t_scalar / t_py:.1f}",
+    ]
+    if np is not None:
+        t0 = time.perf_counter()
+        _haversine_rows_np(a, b)
+        t_np = time.perf_counter() - t0
+        lines.append(f"batch (NumPy): {t_np * 1000:.1f} мс | x{t_scalar / t_np:.0f}")
+    else:
+        lines.append("NumPy не установлен - используется Python-вариант.")
+    return "\n".join(lines)
+
+async def google_geocode(address: str) -> Optional[tuple[float, float]]:
+    if not GOOGLE_MAPS_API_KEY:
+        log.warning("GOOGLE GEOCODE SKIP: API KEY MISSING")
+        return None
+
+    return await cached_geocode("google", address, _google_geocode_fetch)
+
+
+async def _google_geocode_fetch(address: str) -> Optional[tuple[float, float]]:
+    url = "https://maps.googleapis.com/maps/api/geocode/json"
+    params = {
+        "address": address,
+        "key": GOOGLE_MAPS_API_KEY,
+    }
+
+    r = await MAP_HTTP["google"].get(url, params=params)
+    log.info("GOOGLE GEOCODE HTTP %s | %s", r.status_code, r.url)
+    r.raise_for_status()
+    data = r.json()
+
+    status = data.get("status")
+    if status == "ZERO_RESULTS":
+        return None
+    if status != "OK":
+        # OVER_QUERY_LIMIT / REQUEST_DENIED и т.п. - не "адрес не найден"
+        raise RuntimeError(f"google geocode status={status}")
+
+    loc = data["results"][0]["geometry"]["location"]
+    return loc["lat"], loc["lng"]
+
+async def google_distance_km(
+    lat1: float,
+    lng1: float,
+    lat2: float,
+    lng2: float,
+) -> Optional[float]:
+
+    if not GOOGLE_MAPS_API_KEY:
+        log.warning("GOOGLE DISTANCE SKIP: API KEY MISSING")
+        return None
+
+    return await cached_distance_km("google", lat1, lng1, lat2, lng2, _google_distance_fetch)
+
+
+async def _google_distance_fetch(
+    lat1: float,
+    lng1: float,
+    lat2: float,
+    lng2: float,
+) -> Optional[float]:
+    url = "https://maps.googleapis.com/maps/api/distancematrix/json"
+    params = {
+        "origins": f"{lat1},{lng1}",
+        "destinations": f"{lat2},{lng2}",
+        "key": GOOGLE_MAPS_API_KEY,
+        "mode": "driving",
+    }
+
+    log.info(
+        "GOOGLE DISTANCE REQUEST | %s,%s -> %s,%s",
+        lat1, lng1, lat2, lng2
+    )
+
+    r = await MAP_HTTP["google"].get(url, params=params)
+    log.info(
+        "GOOGLE DISTANCE HTTP %s | %s",
+        r.status_code,
+        r.url
+    )
+    r.raise_for_status()
+    data = r.json()
+
+    if data.get("status") != "OK":
+        raise RuntimeError(f"google distance status={data.get('status')}")
+
+    try:
+        el = data["rows"][0]["elements"][0]
+    except Exception:
+        raise RuntimeError(f"google distance bad structure: {data}")
+
+    if el.get("status") != "OK":
+        # NOT_FOUND / ZERO_RESULTS - маршрута нет, это валидный ответ
+        log.warning(
+            "GOOGLE DISTANCE ELEMENT FAIL | status=%s | body=%s",
+            el.get("status"),
+            el
+        )
+        return None
+
+    meters = el.get("distance", {}).get("value")
+    if meters is None:
+        log.warning("GOOGLE DISTANCE NO DISTANCE FIELD | body=%s", el)
+        return None
+
+    km = meters / 1000.0
+    log.info("GOOGLE DISTANCE OK | km=%.2f", km)
+    return km
+
+
+
+# =========================
+# NAVER
+# =========================
+
+async def naver_geocode(address: str) -> Optional[tuple[float, float]]:
+    return await cached_geocode("naver", address, _naver_geocode_fetch)
+
+
+async def _naver_geocode_fetch(address: str) -> Optional[tuple[float, float]]:
+    url = "https://naveropenapi.apigw.ntruss.com/map-geocode/v2/geocode"
+    headers = {
+        "X-NCP-APIGW-API-KEY-ID": os.getenv("NAVER_CLIENT_ID"),
+        "X-NCP-APIGW-API-KEY": os.getenv("NAVER_CLIENT_SECRET"),
+    }
+    params = {"query": address}
+
+    log.info(
+        "NAVER GEOCODE REQUEST | addr='%s' | id_set=%s | secret_set=%s",
+        address,
+        bool(headers.get("X-NCP-APIGW-API-KEY-ID")),
+        bool(headers.get("X-NCP-APIGW-API-KEY")),
+    )
+
+    r = await MAP_HTTP["naver"].get(url, params=params, headers=headers)
+
+    log.info(
+        "NAVER GEOCODE RESPONSE | status=%s | body=%s",
+        r.status_code,
+        r.text[:300],  # не больше, чтобы не заспамить
+    )
+
+    r.raise_for_status()
+    data = r.json()
+
+    if not data.get("addresses"):
+        return None
+
+    a = data["addresses"][0]
+    return float(a["y"]), float(a["x"])  # lat, lon
+
+async def naver_route_distance_km(
+    start_lat: float,
+    start_lon: float,
+    goal_lat: float,
+    goal_lon: float,
+) -> Optional[float]:
+    if not os.getenv("NAVER_CLIENT_ID") or not os.getenv("NAVER_CLIENT_SECRET"):
+        log.warning("NAVER ROUTE SKIP: missing API keys")
+        return None
+
+    return await cached_distance_km("naver", start_lat, start_lon, goal_lat, goal_lon, _naver_route_fetch)
+
+
+async def _naver_route_fetch(
+    start_lat: float,
+    start_lon: float,
+    goal_lat: float,
     goal_lon: float,
 ) -> Optional[float]:
     """
@@ -2268,93 +4782,1254 @@ async def naver_route_distance_km(
     """
     url = "https://naveropenapi.apigw.ntruss.com/map-direction/v1/driving"
 
-    headers = {
-        "X-NCP-APIGW-API-KEY-ID": os.getenv("NAVER_CLIENT_ID"),
-        "X-NCP-APIGW-API-KEY": os.getenv("NAVER_CLIENT_SECRET"),
-    }
+    headers = {
+        "X-NCP-APIGW-API-KEY-ID": os.getenv("NAVER_CLIENT_ID"),
+        "X-NCP-APIGW-API-KEY": os.getenv("NAVER_CLIENT_SECRET"),
+    }
+
+    log.info(
+        "NAVER ROUTE REQUEST | start=%s,%s | goal=%s,%s",
+        start_lat,
+        start_lon,
+        goal_lat,
+        goal_lon,
+    )
+
+    params = {
+        "start": f"{start_lon},{start_lat}",
+        "goal": f"{goal_lon},{goal_lat}",
+        "option": "traoptimal",
+    }
+
+    r = await MAP_HTTP["naver"].get(url, params=params, headers=headers)
+
+    log.info(
+        "NAVER ROUTE RESPONSE | status=%s | body=%s",
+        r.status_code,
+        r.text[:300],
+    )
+
+    r.raise_for_status()
+    data = r.json()
+
+    route = data.get("route") or {}
+    arr = route.get("traoptimal") or []
+    if not arr:
+        log.warning("NAVER ROUTE EMPTY")
+        return None
+
+    summary = (arr[0] or {}).get("summary") or {}
+    dist_m = summary.get("distance")
+    if dist_m is None:
+        log.warning("NAVER ROUTE NO DISTANCE FIELD")
+        return None
+
+    return float(dist_m) / 1000.0
+
+# =========================
+# OFFLINE GAZETTEER (Dunpo / Asan / Sinchang)
+# =========================
+# Локальная таблица адресов с координатами: адрес -> (lat, lon).
+# Источник - CSV (GAZETTEER_CSV), импортируется при старте, если файл новее импорта.
+# Поддерживаемые колонки:
+#   адрес:       road_address / jibun_address / 도로명주소 / 지번주소 / address
+#   координаты:  lat + lon (WGS84) / 위도 + 경도, либо x + y в UTM-K (EPSG:5179),
+#                как в выгрузках juso.go.kr ("위치정보요약DB")
+# Поиск: точный ключ -> самый длинный префикс (адрес + лишние детали) -> fuzzy
+# по адресам с теми же номерами (номер дома fuzzy не исправляем).
+GAZETTEER_DB_PATH = os.getenv("GAZETTEER_DB", "easygo_gazetteer.sqlite3")
+GAZETTEER_CSV = os.getenv("GAZETTEER_CSV", "").strip()
+GAZETTEER_FUZZY_CUTOFF = float(os.getenv("GAZETTEER_FUZZY_CUTOFF", "0.88"))
+GAZETTEER_FUZZY_MAX_CANDIDATES = 2000
+
+_ADDR_COLUMNS = ("road_address", "jibun_address", "address", "도로명주소", "지번주소", "주소")
+_LAT_COLUMNS = ("lat", "latitude", "위도")
+_LON_COLUMNS = ("lon", "lng", "longitude", "경도")
+_X_COLUMNS = ("x", "x좌표", "utmk_x")
+_Y_COLUMNS = ("y", "y좌표", "utmk_y")
+
+_re_digits = re.compile(r"\d+(?:-\d+)?")
+
+
+# версия ключей в базе: поднимать при любом изменении gazetteer_key / normalize_korean_address,
+# иначе база, собранная старыми ключами, не переимпортируется и lookup'и мимо
+GAZETTEER_KEY_VERSION = "2"
+
+
+def gazetteer_key(address: str) -> str:
+    return normalize_korean_address(address)
+
+
+def _number_signature(key: str) -> str:
+    return ",".join(_re_digits.findall(key))
+
+
+# --- UTM-K (EPSG:5179, GRS80, TM 38N/127.5E, k=0.9996, FE=1e6, FN=2e6) -> WGS84 ---
+_UTMK_A = 6378137.0
+_UTMK_F = 1 / 298.257222101
+_UTMK_K0 = 0.9996
+_UTMK_LAT0 = math.radians(38.0)
+_UTMK_LON0 = math.radians(127.5)
+_UTMK_FE = 1000000.0
+_UTMK_FN = 2000000.0
+_UTMK_E2 = _UTMK_F * (2 - _UTMK_F)
+_UTMK_EP2 = _UTMK_E2 / (1 - _UTMK_E2)
+
+
+def _tm_meridian_arc(phi: float) -> float:
+    e2 = _UTMK_E2
+    e4 = e2 * e2
+    e6 = e4 * e2
+    return _UTMK_A * (
+        (1 - e2 / 4 - 3 * e4 / 64 - 5 * e6 / 256) * phi
+        - (3 * e2 / 8 + 3 * e4 / 32 + 45 * e6 / 1024) * math.sin(2 * phi)
+        + (15 * e4 / 256 + 45 * e6 / 1024) * math.sin(4 * phi)
+        - (35 * e6 / 3072) * math.sin(6 * phi)
+    )
+
+
+def utmk_to_wgs84(x: float, y: float) -> tuple[float, float]:
+    """
+    Обратная поперечная проекция Меркатора (Snyder), точность - сантиметры.
+    """
+    e2 = _UTMK_E2
+    e4 = e2 * e2
+    e6 = e4 * e2
+    ep2 = _UTMK_EP2
+
+    m = _tm_meridian_arc(_UTMK_LAT0) + (y - _UTMK_FN) / _UTMK_K0
+    mu = m / (_UTMK_A * (1 - e2 / 4 - 3 * e4 / 64 - 5 * e6 / 256))
+    e1 = (1 - math.sqrt(1 - e2)) / (1 + math.sqrt(1 - e2))
+    phi1 = (
+        mu
+        + (3 * e1 / 2 - 27 * e1 ** 3 / 32) * math.sin(2 * mu)
+        + (21 * e1 ** 2 / 16 - 55 * e1 ** 4 / 32) * math.sin(4 * mu)
+        + (151 * e1 ** 3 / 96) * math.sin(6 * mu)
+        + (1097 * e1 ** 4 / 512) * math.sin(8 * mu)
+    )
+
+    sin1 = math.sin(phi1)
+    cos1 = math.cos(phi1)
+    tan1 = math.tan(phi1)
+    c1 = ep2 * cos1 * cos1
+    t1 = tan1 * tan1
+    n1 = _UTMK_A / math.sqrt(1 - e2 * sin1 * sin1)
+    r1 = _UTMK_A * (1 - e2) / (1 - e2 * sin1 * sin1) ** 1.5
+    d = (x - _UTMK_FE) / (n1 * _UTMK_K0)
+
+    lat = phi1 - (n1 * tan1 / r1) * (
+        d * d / 2
+        - (5 + 3 * t1 + 10 * c1 - 4 * c1 * c1 - 9 * ep2) * d ** 4 / 24
+        + (61 + 90 * t1 + 298 * c1 + 45 * t1 * t1 - 252 * ep2 - 3 * c1 * c1) * d ** 6 / 720
+    )
+    lon = _UTMK_LON0 + (
+        d
+        - (1 + 2 * t1 + c1) * d ** 3 / 6
+        + (5 - 2 * c1 + 28 * t1 - 3 * c1 * c1 + 8 * ep2 + 24 * t1 * t1) * d ** 5 / 120
+    ) / cos1
+    return math.degrees(lat), math.degrees(lon)
+
+
+def _pick_column(header: List[str], names) -> Optional[int]:
+    low = [h.strip().lower() for h in header]
+    for n in names:
+        if n in low:
+            return low.index(n)
+    return None
+
+
+class Gazetteer:
+    def __init__(self, db_path: str):
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS gazetteer (k TEXT PRIMARY KEY, address TEXT, lat REAL, lon REAL)"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS gazetteer_meta (k TEXT PRIMARY KEY, v TEXT)")
+        self._db.commit()
+
+        self._exact: Dict[str, tuple[float, float]] = {}
+        self._by_numbers: Dict[str, List[str]] = {}
+        self.stats: Dict[str, int] = {"exact": 0, "prefix": 0, "fuzzy": 0, "miss": 0}
+        self._lat_us: deque = deque(maxlen=1000)
+
+    def __len__(self) -> int:
+        return len(self._exact)
+
+    def _index(self, key: str, lat: float, lon: float):
+        if key not in self._exact:
+            self._by_numbers.setdefault(_number_signature(key), []).append(key)
+        self._exact[key] = (lat, lon)
+
+    def load_index(self):
+        self._exact.clear()
+        self._by_numbers.clear()
+        for k, lat, lon in self._db.execute("SELECT k, lat, lon FROM gazetteer"):
+            self._index(k, lat, lon)
+        log.info("GAZETTEER READY | entries=%s", len(self._exact))
+
+    def _meta(self, k: str) -> str:
+        row = self._db.execute("SELECT v FROM gazetteer_meta WHERE k = ?", (k,)).fetchone()
+        return row[0] if row else ""
+
+    def needs_import(self, path: str) -> bool:
+        try:
+            mtime = str(int(os.path.getmtime(path)))
+        except OSError:
+            log.warning("GAZETTEER CSV NOT FOUND | %s", path)
+            return False
+        if self._meta("key_version") != GAZETTEER_KEY_VERSION:
+            return True
+        return self._meta(f"mtime:{path}") != mtime
+
+    def import_csv(self, path: str) -> int:
+        """
+        Блокирующий импорт (запускать через run_blocking).
+        """
+        raw = open(path, "rb").read()
+        try:
+            text = raw.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            text = raw.decode("cp949")   # выгрузки juso.go.kr
+
+        first = text.split("\n", 1)[0]
+        delim = max(",|\t", key=first.count)
+        reader = csv.reader(text.splitlines(), delimiter=delim)
+        header = next(reader, [])
+
+        addr_cols = [i for i in (_pick_column(header, (n,)) for n in _ADDR_COLUMNS) if i is not None]
+        lat_i = _pick_column(header, _LAT_COLUMNS)
+        lon_i = _pick_column(header, _LON_COLUMNS)
+        x_i = _pick_column(header, _X_COLUMNS)
+        y_i = _pick_column(header, _Y_COLUMNS)
+        use_utmk = lat_i is None or lon_i is None
+        if not addr_cols or (use_utmk and (x_i is None or y_i is None)):
+            raise ValueError(f"gazetteer csv: unsupported header {header}")
+
+        rows = []
+        for r in reader:
+            try:
+                if use_utmk:
+                    lat, lon = utmk_to_wgs84(float(r[x_i]), float(r[y_i]))
+                else:
+                    lat, lon = float(r[lat_i]), float(r[lon_i])
+            except (ValueError, IndexError):
+                continue
+            for i in addr_cols:
+                addr = r[i].strip() if i < len(r) else ""
+                if addr:
+                    rows.append((gazetteer_key(addr), addr, lat, lon))
+
+        self._db.execute("DELETE FROM gazetteer")
+        self._db.executemany(
+            "INSERT OR REPLACE INTO gazetteer (k, address, lat, lon) VALUES (?, ?, ?, ?)", rows
+        )
+        self._db.execute(
+            "INSERT OR REPLACE INTO gazetteer_meta (k, v) VALUES (?, ?)",
+            (f"mtime:{path}", str(int(os.path.getmtime(path))))
+        )
+        self._db.execute(
+            "INSERT OR REPLACE INTO gazetteer_meta (k, v) VALUES ('key_version', ?)",
+            (GAZETTEER_KEY_VERSION,)
+        )
+        self._db.commit()
+        return len(rows)
+
+    def _lookup(self, key: str) -> Optional[tuple[str, tuple[float, float]]]:
+        hit = self._exact.get(key)
+        if hit:
+            return "exact", hit
+
+        # адрес + лишние детали ("... 123 2층 편의점"): самый длинный известный префикс
+        tokens = key.split(" ")
+        for n in range(len(tokens) - 1, 1, -1):
+            hit = self._exact.get(" ".join(tokens[:n]))
+            if hit:
+                return "prefix", hit
+
+        # опечатки в названии - только среди адресов с теми же номерами
+        sig = _number_signature(key)
+        if not sig:
+            return None
+        candidates = self._by_numbers.get(sig, [])[:GAZETTEER_FUZZY_MAX_CANDIDATES]
+        best = difflib.get_close_matches(key, candidates, n=1, cutoff=GAZETTEER_FUZZY_CUTOFF)
+        if best:
+            return "fuzzy", self._exact[best[0]]
+        return None
+
+    def lookup(self, address: str) -> Optional[tuple[float, float]]:
+        if not self._exact:
+            return None
+        t0 = time.perf_counter()
+        res = self._lookup(gazetteer_key(address))
+        self._lat_us.append((time.perf_counter() - t0) * 1e6)
+        if res is None:
+            self.stats["miss"] += 1
+            return None
+        self.stats[res[0]] += 1
+        return res[1]
+
+    def latency_us(self) -> tuple[float, float]:
+        if not self._lat_us:
+            return 0.0, 0.0
+        xs = sorted(self._lat_us)
+        return xs[len(xs) // 2], xs[min(len(xs) - 1, int(len(xs) * 0.95))]
+
+    def benchmark(self, n: int = 1000) -> str:
+        """
+        Замер на реальных ключах: точные, с "хвостом" (префикс) и с опечаткой (fuzzy).
+        Счетчики и окно латентности боевых запросов не трогаем.
+        Блокирующий (запускать через run_blocking).
+        """
+        if not self._exact:
+            return "Газеттир пуст."
+        keys = random.sample(list(self._exact), min(n, len(self._exact)))
+        cases = {
+            "exact": keys,
+            "prefix": [f"{k} 2층" for k in keys],
+            "fuzzy": [k[:2] + k[3:] if len(k) > 4 else k for k in keys],
+        }
+        lines = [f"🧪 Газеттир: {len(self._exact)} адресов, {len(keys)} запросов на случай"]
+        for name, qs in cases.items():
+            found = 0
+            t0 = time.perf_counter()
+            for q in qs:
+                if self._lookup(gazetteer_key(q)):
+                    found += 1
+            dt = time.perf_counter() - t0
+            lines.append(f"{name}: {dt / len(qs) * 1e6:.1f} мкс/запрос | найдено {found}/{len(qs)}")
+        return "\n".join(lines)
+
+    def render_line(self) -> str:
+        st = self.stats
+        p50, p95 = self.latency_us()
+        return (
+            f"Газеттир ({len(self._exact)}): exact {st['exact']} | prefix {st['prefix']} | "
+            f"fuzzy {st['fuzzy']} | miss {st['miss']} | p50 {p50:.0f} мкс | p95 {p95:.0f} мкс"
+        )
+
+
+GAZETTEER = Gazetteer(GAZETTEER_DB_PATH)
+
+
+async def init_gazetteer():
+    if GAZETTEER_CSV and GAZETTEER.needs_import(GAZETTEER_CSV):
+        try:
+            n = await run_blocking(GAZETTEER.import_csv, GAZETTEER_CSV)
+            log.info("GAZETTEER IMPORTED | %s | rows=%s", GAZETTEER_CSV, n)
+        except Exception:
+            log.exception("GAZETTEER IMPORT FAILED | %s", GAZETTEER_CSV)
+    GAZETTEER.load_index()
+
+
+async def geocode_address(address: str) -> Optional[tuple[float, float]]:
+    """
+    Координаты адреса: сначала локальный газеттир, внешний геокодер - только при промахе.
+    """
+    coords, _ = await hedged_geocode(address)
+    return coords
+
+
+# =========================
+# ZONE PRICING (полигоны районов + матрица цен зона -> зона)
+# =========================
+# ZONES_FILE - GeoJSON FeatureCollection (Polygon / MultiPolygon),
+#   id зоны = properties.zone_id (или properties.name).
+# ZONE_MATRIX_FILE - {"<from>|<to>": {"km": ..., "n": ...}},
+#   строится командой /zones_rebuild из накопленного кэша маршрутов.
+# Если обе точки попали в зоны и пара есть в матрице - км без запроса маршрута,
+# цена считается по текущему PRICE_PER_KM_KRW (смена тарифа не требует пересборки).
+ZONES_FILE = os.getenv("ZONES_FILE", "").strip()
+ZONE_MATRIX_FILE = os.getenv("ZONE_MATRIX_FILE", "zone_matrix.json")
+ZONE_CELL_DEG = 0.01                                                # ~1 км
+ZONE_MATRIX_MIN_SAMPLES = int(os.getenv("ZONE_MATRIX_MIN_SAMPLES", "3"))
+
+
+def _point_in_ring(lat: float, lon: float, ring: List[List[float]]) -> bool:
+    # ray casting, кольцо GeoJSON: [[lon, lat], ...]
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        xi, yi = ring[i][0], ring[i][1]
+        xj, yj = ring[j][0], ring[j][1]
+        if (yi > lat) != (yj > lat) and lon < (xj - xi) * (lat - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+class ZoneIndex:
+    """
+    Полигоны зон + сетка bbox: в ячейке - только зоны, чей bbox ее задевает,
+    поэтому точный point-in-polygon проверяется для 1-2 кандидатов.
+    """
+
+    def __init__(self):
+        self.polygons: Dict[str, List[List[List[List[float]]]]] = {}   # zone -> [polygon [ring]]
+        self._cells: Dict[tuple[int, int], List[str]] = {}
+        self.matrix: Dict[str, Dict[str, Any]] = {}
+        self.stats: Dict[str, int] = {"matrix_hit": 0, "pair_miss": 0, "outside": 0}
+
+    def _cell(self, lat: float, lon: float) -> tuple[int, int]:
+        return int(math.floor(lat / ZONE_CELL_DEG)), int(math.floor(lon / ZONE_CELL_DEG))
+
+    def load_zones(self, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            geo = json.load(f)
+
+        self.polygons.clear()
+        self._cells.clear()
+        for feat in geo.get("features", []):
+            props = feat.get("properties") or {}
+            zone = str(props.get("zone_id") or props.get("name") or "").strip()
+            geom = feat.get("geometry") or {}
+            if not zone or geom.get("type") not in ("Polygon", "MultiPolygon"):
+                continue
+            polys = [geom["coordinates"]] if geom["type"] == "Polygon" else geom["coordinates"]
+            self.polygons.setdefault(zone, []).extend(polys)
+
+            for poly in polys:
+                lons = [pt[0] for pt in poly[0]]
+                lats = [pt[1] for pt in poly[0]]
+                c0 = self._cell(min(lats), min(lons))
+                c1 = self._cell(max(lats), max(lons))
+                for cy in range(c0[0], c1[0] + 1):
+                    for cx in range(c0[1], c1[1] + 1):
+                        bucket = self._cells.setdefault((cy, cx), [])
+                        if zone not in bucket:
+                            bucket.append(zone)
+
+        log.info("ZONES READY | zones=%s | cells=%s", len(self.polygons), len(self._cells))
+
+    def load_matrix(self, path: str):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.matrix = json.load(f)
+        except FileNotFoundError:
+            self.matrix = {}
+        log.info("ZONE MATRIX READY | pairs=%s", len(self.matrix))
+
+    def locate(self, lat: float, lon: float) -> Optional[str]:
+        for zone in self._cells.get(self._cell(lat, lon), ()):
+            for poly in self.polygons[zone]:
+                # внешнее кольцо и без попадания в "дырки"
+                if _point_in_ring(lat, lon, poly[0]) and not any(
+                    _point_in_ring(lat, lon, hole) for hole in poly[1:]
+                ):
+                    return zone
+        return None
+
+    def quote(self, a: tuple[float, float], b: tuple[float, float]) -> Optional[Dict[str, Any]]:
+        za = self.locate(a[0], a[1])
+        zb = self.locate(b[0], b[1])
+        if not za or not zb:
+            self.stats["outside"] += 1
+            return None
+        cell = self.matrix.get(f"{za}|{zb}")
+        if not cell:
+            self.stats["pair_miss"] += 1
+            return None
+        self.stats["matrix_hit"] += 1
+        return cell
+
+    def build_matrix(self, samples: List[tuple[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """
+        samples - строки кэша маршрутов ("provider:lat,lng|lat,lng" -> km).
+        Для пары зон берем медиану км (устойчиво к редким объездам).
+        """
+        per_pair: Dict[str, List[float]] = {}
+        for key, km in samples:
+            if km is None:
+                continue
+            try:
+                a, b = key.split(":", 1)[1].split("|")
+                la, ga = (int(v) * DIST_GRID_DEG for v in a.split(","))
+                lb, gb = (int(v) * DIST_GRID_DEG for v in b.split(","))
+            except (ValueError, IndexError):
+                continue
+            za = self.locate(la, ga)
+            zb = self.locate(lb, gb)
+            if za and zb:
+                per_pair.setdefault(f"{za}|{zb}", []).append(float(km))
+
+        matrix = {}
+        for pair, kms in per_pair.items():
+            if len(kms) < ZONE_MATRIX_MIN_SAMPLES:
+                continue
+            kms.sort()
+            km = kms[len(kms) // 2]
+            matrix[pair] = {"km": round(km, 2), "n": len(kms)}
+        return matrix
+
+    def render_line(self) -> str:
+        st = self.stats
+        return (
+            f"Зоны ({len(self.polygons)}, пар в матрице {len(self.matrix)}): "
+            f"по матрице {st['matrix_hit']} | пары нет {st['pair_miss']} | вне зон {st['outside']}"
+        )
+
+
+ZONES = ZoneIndex()
+
+
+async def init_zones():
+    if not ZONES_FILE:
+        return
+    try:
+        await run_blocking(ZONES.load_zones, ZONES_FILE)
+        await run_blocking(ZONES.load_matrix, ZONE_MATRIX_FILE)
+    except Exception:
+        log.exception("ZONES LOAD FAILED | %s", ZONES_FILE)
+
+
+async def rebuild_zone_matrix() -> int:
+    samples = DISTANCE_CACHE.rows()
+    matrix = await run_blocking(ZONES.build_matrix, samples)
+
+    def save():
+        tmp = ZONE_MATRIX_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(matrix, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, ZONE_MATRIX_FILE)
+
+    await run_blocking(save)
+    ZONES.matrix = matrix
+    log.info("ZONE MATRIX REBUILT | samples=%s | pairs=%s", len(samples), len(matrix))
+    return len(matrix)
+
+
+# =========================
+# PRICE QUOTE PIPELINE
+# =========================
+# - оба адреса геокодируем параллельно;
+# - если Google не ответил за HEDGE_AFTER_SEC, параллельно спрашиваем Naver (hedge),
+#   берем первый непустой ответ;
+# - на весь расчет - общий дедлайн QUOTE_DEADLINE_SEC: что успели, то и используем
+#   (нет маршрута - haversine * 1.5).
+QUOTE_DEADLINE_SEC = float(os.getenv("QUOTE_DEADLINE_SEC", "6"))
+HEDGE_AFTER_SEC = float(os.getenv("HEDGE_AFTER_SEC", "0.8"))
+HAVERSINE_ROAD_FACTOR = 1.5
+
+QUOTE_SOURCE_RU = {
+    "google": "маршрут Google",
+    "naver": "маршрут Naver",
+    "haversine_adjusted": "по прямой × 1.5",
+    "zone_matrix": "тариф по зонам",
+}
+
+
+@dataclass
+class PriceQuote:
+    price_krw: int
+    km: float
+    source: str
+
+
+def naver_keys_set() -> bool:
+    return bool(os.getenv("NAVER_CLIENT_ID") and os.getenv("NAVER_CLIENT_SECRET"))
+
+
+def round_krw_1000(value: int) -> int:
+    return int(math.ceil(value / 1000.0) * 1000)
+
+
+async def hedged_call(calls, hedge_after: float):
+    """
+    calls: [(source, coroutine_factory)] в порядке приоритета.
+    Следующий провайдер стартует, если текущие молчат hedge_after секунд
+    или вернули None. Возвращает (result, source) первого непустого ответа.
+    """
+    queue = list(calls)
+    names: Dict[asyncio.Future, str] = {}
+    pending: set = set()
+
+    def launch() -> bool:
+        if not queue:
+            return False
+        source, factory = queue.pop(0)
+        t = asyncio.ensure_future(factory())
+        names[t] = source
+        pending.add(t)
+        return True
+
+    launch()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=hedge_after, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # основной провайдер тормозит - подстраховываемся следующим
+                launch()
+                continue
+            for t in done:
+                pending.discard(t)
+                if t.cancelled() or t.exception() is not None:
+                    continue
+                res = t.result()
+                if res is not None:
+                    return res, names[t]
+            if not pending:
+                launch()
+    finally:
+        for t in pending:
+            t.cancel()
+
+    return None, ""
+
+
+def _quote_providers() -> List[str]:
+    # открытые breaker'ы пропускаем сразу, без ожидания таймаута
+    names = ["google"]
+    if naver_keys_set():
+        names.append("naver")
+    return providers_by_health(names)
+
+
+async def hedged_geocode(address: str):
+    hit = GAZETTEER.lookup(address)
+    if hit:
+        return hit, "gazetteer"
+
+    fns = {"google": google_geocode, "naver": naver_geocode}
+    calls = [(n, lambda f=fns[n]: f(address)) for n in _quote_providers()]
+    return await hedged_call(calls, HEDGE_AFTER_SEC)
+
+
+async def hedged_distance_km(a: tuple[float, float], b: tuple[float, float]):
+    fns = {"google": google_distance_km, "naver": naver_route_distance_km}
+    calls = [(n, lambda f=fns[n]: f(a[0], a[1], b[0], b[1])) for n in _quote_providers()]
+    return await hedged_call(calls, HEDGE_AFTER_SEC)
+
+
+async def quote_route_price(pickup_addr: str, drop_addr: str, deadline: float = QUOTE_DEADLINE_SEC) -> Optional[PriceQuote]:
+    got: Dict[str, Any] = {}
+    t0 = time.monotonic()
+
+    async def pipeline():
+        (a, sa), (b, sb) = await asyncio.gather(
+            hedged_geocode(pickup_addr),
+            hedged_geocode(drop_addr),
+        )
+        got["a"], got["b"] = a, b
+        log.info("QUOTE GEOCODE | pickup=%s (%s) | drop=%s (%s)", a, sa, b, sb)
+        if not a or not b:
+            return
+        cell = ZONES.quote(a, b)
+        if cell:
+            got["km"], got["source"] = cell["km"], "zone_matrix"
+            return
+        km, source = await hedged_distance_km(a, b)
+        if km is not None:
+            got["km"], got["source"] = km, source
+
+    try:
+        await asyncio.wait_for(pipeline(), timeout=deadline)
+    except asyncio.TimeoutError:
+        log.warning("QUOTE DEADLINE | %.1fs | have=%s", deadline, sorted(got))
+
+    a, b = got.get("a"), got.get("b")
+    if not a or not b:
+        log.warning("PRICE CALC FAIL | geocode failed | a=%s b=%s", a, b)
+        return None
+
+    km = got.get("km")
+    source = got.get("source", "")
+    if km is None:
+        km = haversine_km(a[0], a[1], b[0], b[1]) * HAVERSINE_ROAD_FACTOR
+        source = "haversine_adjusted"
+
+    log.info(
+        "DISTANCE RESULT | km=%.2f | source=%s | %.0f ms",
+        km,
+        source,
+        (time.monotonic() - t0) * 1000
+    )
+
+    raw_price = int(round(km * PRICE_PER_KM_KRW))
+    price = round_krw_1000(raw_price)
+    log.info("PRICE FINAL | raw=%s | rounded=%s", raw_price, price)
+    return PriceQuote(price_krw=price, km=km, source=source)
+
+
+async def calc_recommended_price_krw(pickup_addr: str, drop_addr: str) -> Optional[int]:
+    q = await quote_route_price(pickup_addr, drop_addr)
+    return q.price_krw if q else None
+
+
+# =========================
+# SPECULATIVE QUOTE (считаем цену, пока клиент заполняет остальные шаги)
+# =========================
+# - адрес забора принят -> фоном геокодируем его (прогрев кэша);
+# - адрес доставки принят -> фоном полный расчет, результат в draft_order["spec_quote"];
+# - на шаге цены берем готовое (или дожидаемся задачи), иначе считаем как раньше;
+# - черновик сброшен / адрес изменен -> задачи отменяются.
+SPEC_TASKS: Dict[int, Dict[str, asyncio.Task]] = {}
+SPEC_STATS: Dict[str, int] = {"ready": 0, "waited": 0, "miss": 0, "canceled": 0}
+
+
+def cancel_speculative_quote(uid: int):
+    for task in SPEC_TASKS.pop(uid, {}).values():
+        if not task.done():
+            task.cancel()
+            SPEC_STATS["canceled"] += 1
+
+
+def start_speculative_pickup(uid: int, d: Dict[str, Any]):
+    cancel_speculative_quote(uid)
+    d.pop("spec_quote", None)
+    if d.get("zone") == "dunpo":
+        return   # фиксированная цена, маршрут не нужен
+
+    task = TASKS.spawn("spec_geocode", hedged_geocode(d.get("pickup_address_ko", "")))
+    if task:
+        SPEC_TASKS[uid] = {"pickup": task}
+
+
+def start_speculative_quote(uid: int, d: Dict[str, Any]):
+    if d.get("zone") == "dunpo":
+        return
+
+    pickup = d.get("pickup_address_ko", "")
+    drop = d.get("drop_address_ko", "")
+    tasks = SPEC_TASKS.setdefault(uid, {})
+    old = tasks.pop("quote", None)
+    if old and not old.done():
+        old.cancel()
+        SPEC_STATS["canceled"] += 1
+    d.pop("spec_quote", None)
+    geo = tasks.get("pickup")
+
+    async def run():
+        # забор уже геокодируется - ждем его, чтобы взять из кэша, а не спрашивать второй раз
+        if geo and not geo.done():
+            await asyncio.wait({geo})
+        q = await quote_route_price(pickup, drop)
+        if q:
+            d["spec_quote"] = {"pickup": pickup, "drop": drop, **asdict(q)}
+
+    task = TASKS.spawn("spec_quote", run())
+    if task:
+        tasks["quote"] = task
+
+
+async def take_speculative_quote(uid: int, d: Dict[str, Any], pickup: str, drop: str) -> Optional[PriceQuote]:
+    spec = d.get("spec_quote")
+    task = SPEC_TASKS.get(uid, {}).get("quote")
+    if spec:
+        SPEC_STATS["ready"] += 1
+    elif task:
+        # у задачи свой дедлайн QUOTE_DEADLINE_SEC, она к этому моменту уже частично отработала
+        await asyncio.wait({task}, timeout=QUOTE_DEADLINE_SEC)
+        spec = d.get("spec_quote")
+        if spec:
+            SPEC_STATS["waited"] += 1
+    # досчитала сама (не отменена и не по таймауту ожидания) - результат окончательный
+    finished = task is not None and task.done() and not task.cancelled()
+    cancel_speculative_quote(uid)
+
+    if spec and spec["pickup"] == pickup and spec["drop"] == drop:
+        return PriceQuote(price_krw=spec["price_krw"], km=spec["km"], source=spec["source"])
+    if finished and not spec:
+        # расчет по этим же адресам уже был и не удался - второй раз не ждем
+        SPEC_STATS["miss"] += 1
+        return None
+
+    SPEC_STATS["miss"] += 1
+    return await quote_route_price(pickup, drop)
+
+
+# =========================
+# WIZARD FSM (мастер заказа клиента + анкета курьера)
+# =========================
+# Шаги описаны таблицей WIZARD: state -> подсказка, клавиатура, разбор ввода, поле, следующий шаг.
+# - текстовый ввод: wizard_submit() (один dict-lookup по текущему состоянию);
+# - кнопки: обработчики callback'ов вызывают wizard_enter() со следующим шагом;
+# - в user_data лежит (state, unix ts) входа в шаг -> время на шаге (воронка, /funnel)
+#   и сборка брошенных черновиков (WIZARD_TIMEOUT_SEC без движения).
+WIZ_ENTERED_KEY = "wizard_entered"
+WIZARD_TIMEOUT_SEC = int(os.getenv("WIZARD_TIMEOUT_SEC", str(2 * 3600)))
+WIZARD_GC_EVERY_SEC = int(os.getenv("WIZARD_GC_EVERY_SEC", "300"))
+
+WIZ_FLOW_CLIENT = "client"
+WIZ_FLOW_COURIER = "courier"
+# flow -> (ключ состояния в user_data, "нет состояния", роль для log_event)
+WIZARD_FLOWS = {
+    WIZ_FLOW_CLIENT: (CLIENT_STATE_KEY, C_NONE, ROLE_CLIENT),
+    WIZ_FLOW_COURIER: (COURIER_STATE_KEY, K_NONE, ROLE_COURIER),
+}
+# что удалить из user_data, если анкету/черновик бросили
+WIZARD_DRAFT_KEYS = {
+    WIZ_FLOW_CLIENT: ("draft_order", "recent_addresses"),
+    WIZ_FLOW_COURIER: ("apply_name", "apply_phone", "apply_transport", "apply_username"),
+}
+
+
+@dataclass
+class WizardStep:
+    state: str
+    flow: str
+    prompt: Any                 # str или fn(store) -> str
+    keyboard: Any = None        # fn() -> InlineKeyboardMarkup
+    render: Any = None          # async fn(context, chat_id, uid, store) - свой рендер вместо prompt
+    field: str = ""             # куда положить разобранный ввод (draft_order / user_data)
+    parse: Any = None           # fn(text) -> значение или None (неверный ввод); None = шаг только на кнопках
+    error: str = ""             # ответ на неверный ввод (по умолчанию - prompt)
+    next: Any = None            # следующий state или async fn(context, uid, store) -> state
+    event: str = ""             # SHEETS.log_event после принятого ввода
+
+
+@dataclass
+class WizardStepStats:
+    entered: int = 0
+    passed: int = 0
+    canceled: int = 0
+    abandoned: int = 0
+    dwell_sec: deque = field(default_factory=lambda: deque(maxlen=500))
+
+
+WIZARD: Dict[str, WizardStep] = {}
+WIZARD_STATS: Dict[str, WizardStepStats] = {}
+
+
+def wizard_step(state: str, flow: str, prompt: Any, **kwargs):
+    WIZARD[state] = WizardStep(state, flow, prompt, **kwargs)
+    WIZARD_STATS.setdefault(state, WizardStepStats())
+
+
+def _wizard_store(context: ContextTypes.DEFAULT_TYPE, flow: str) -> Dict[str, Any]:
+    if flow == WIZ_FLOW_CLIENT:
+        return context.user_data.setdefault("draft_order", {})
+    return context.user_data
+
+
+def _wizard_leave(user_data: Dict[str, Any], outcome: str):
+    entered = user_data.pop(WIZ_ENTERED_KEY, None)
+    if not entered or entered[0] not in WIZARD_STATS:
+        return
+    st = WIZARD_STATS[entered[0]]
+    setattr(st, outcome, getattr(st, outcome) + 1)
+    if outcome == "passed":
+        st.dwell_sec.append(time.time() - entered[1])
+
+
+async def wizard_enter(context: ContextTypes.DEFAULT_TYPE, chat_id: int, uid: int, state: str):
+    step = WIZARD[state]
+    key, _, _ = WIZARD_FLOWS[step.flow]
+
+    _wizard_leave(context.user_data, "passed")
+    context.user_data[key] = state
+    context.user_data[WIZ_ENTERED_KEY] = (state, time.time())
+    WIZARD_STATS[state].entered += 1
+
+    store = _wizard_store(context, step.flow)
+    if step.render:
+        await step.render(context, chat_id, uid, store)
+        return
+
+    text = step.prompt(store) if callable(step.prompt) else step.prompt
+    await ui_render(
+        context,
+        chat_id,
+        text,
+        reply_markup=step.keyboard() if step.keyboard else None
+    )
+
+
+def wizard_finish(context: ContextTypes.DEFAULT_TYPE, outcome: str = "passed"):
+    """
+    Мастер закончен (заказ создан / анкета отправлена) или отменен пользователем.
+    Состояние сбрасывает вызывающий код, здесь - только учет времени шага.
+    """
+    _wizard_leave(context.user_data, outcome)
+
+
+async def wizard_submit(context: ContextTypes.DEFAULT_TYPE, chat_id: int, uid: int, state: str, text: str) -> bool:
+    """
+    Текстовый ввод на шаге state. False - шаг не ждет текста (только кнопки / неизвестен).
+    """
+    step = WIZARD.get(state)
+    if not step or step.parse is None:
+        return False
+
+    value = step.parse(text)
+    if value is None:
+        await ui_render(context, chat_id, step.error or step.prompt)
+        return True
+
+    key, none_state, role = WIZARD_FLOWS[step.flow]
+    store = _wizard_store(context, step.flow)
+    store[step.field] = value
+
+    if step.event and SHEETS:
+        SHEETS.log_event(uid, role, step.event)
+
+    nxt = step.next
+    if callable(nxt):
+        nxt = await nxt(context, uid, store)
+
+    if nxt == none_state:
+        wizard_finish(context)
+        context.user_data[key] = none_state
+        return True
+
+    await wizard_enter(context, chat_id, uid, nxt)
+    return True
+
+
+def wizard_gc(user_data: Dict[str, Any], uid: int, cutoff: float) -> bool:
+    entered = user_data.get(WIZ_ENTERED_KEY)
+    if not entered or entered[1] > cutoff:
+        return False
+
+    step = WIZARD.get(entered[0])
+    if not step:
+        user_data.pop(WIZ_ENTERED_KEY, None)
+        return False
+
+    key, none_state, _ = WIZARD_FLOWS[step.flow]
+    if user_data.get(key) != entered[0]:
+        # мастер уже закрыт другим путем (сброс роли, /start) - метка устарела
+        user_data.pop(WIZ_ENTERED_KEY, None)
+        return False
+
+    _wizard_leave(user_data, "abandoned")
+    user_data[key] = none_state
+    for k in WIZARD_DRAFT_KEYS[step.flow]:
+        user_data.pop(k, None)
+    if step.flow == WIZ_FLOW_CLIENT:
+        cancel_speculative_quote(uid)
+    log.info("WIZARD GC | uid=%s | state=%s | idle=%.0fs", uid, entered[0], time.time() - entered[1])
+    return True
 
-    log.info(
-        "NAVER ROUTE REQUEST | start=%s,%s | goal=%s,%s | id_set=%s | secret_set=%s",
-        start_lat,
-        start_lon,
-        goal_lat,
-        goal_lon,
-        bool(headers.get("X-NCP-APIGW-API-KEY-ID")),
-        bool(headers.get("X-NCP-APIGW-API-KEY")),
+
+async def wizard_gc_loop(app: Application):
+    while True:
+        await asyncio.sleep(WIZARD_GC_EVERY_SEC)
+        cutoff = time.time() - WIZARD_TIMEOUT_SEC
+        dropped = []
+        for uid, user_data in list(app.user_data.items()):
+            if wizard_gc(user_data, uid, cutoff):
+                dropped.append(uid)
+        if dropped:
+            # PTB сохраняет user_data только тех, кого трогали апдейты - помечаем сами,
+            # иначе после рестарта брошенные черновики вернутся из SQLite
+            app.mark_data_for_update_persistence(user_ids=dropped)
+            log.info("WIZARD GC | dropped=%s", len(dropped))
+
+
+def render_funnel_text() -> str:
+    lines = [
+        "🧭 Воронка (шаг: вошли / прошли / отмена / брошено | время на шаге p50 / p95)",
+        "",
+    ]
+    for state, step in WIZARD.items():
+        st = WIZARD_STATS[state]
+        xs = sorted(st.dwell_sec)
+        p50 = xs[len(xs) // 2] if xs else 0.0
+        p95 = xs[min(len(xs) - 1, int(len(xs) * 0.95))] if xs else 0.0
+        lines.append(
+            f"{state}: {st.entered} / {st.passed} / {st.canceled} / {st.abandoned} | "
+            f"{p50:.0f} с / {p95:.0f} с"
+        )
+    lines.append(f"\nЧерновики без движения дольше {WIZARD_TIMEOUT_SEC // 60} мин удаляются.")
+    return "\n".join(lines)
+
+
+# ---- разбор ввода ----
+def _parse_nonempty(text: str) -> Optional[str]:
+    return text or None
+
+
+def _parse_any(text: str) -> str:
+    return text
+
+
+def _parse_korean_address(text: str) -> Optional[str]:
+    return text if is_korean_address(text) else None
+
+
+def _parse_transport(text: str) -> Optional[str]:
+    t = text.lower()
+    return "car" if "маш" in t else "scooter" if "скут" in t else None
+
+
+# ---- переходы с логикой ----
+_ADDR_PROMPTS = {
+    "pickup": "📍 Укажите адрес забора.\nАдрес нужно написать текстом и на корейском языке.",
+    "drop": "Укажите адрес доставки. Адрес нужно написать текстом на корейском языке.",
+}
+
+
+async def prompt_client_address(context: ContextTypes.DEFAULT_TYPE, chat_id: int, uid: int, kind: str):
+    addrs = client_recent_addresses(uid, kind)
+    context.user_data.setdefault("recent_addresses", {})[kind] = addrs
+
+    text = _ADDR_PROMPTS[kind]
+    if addrs:
+        text += "\n\nИли выберите из недавних:"
+
+    await ui_render(context, chat_id, text, reply_markup=kb_recent_addresses(kind, addrs))
+
+
+async def _after_pickup(context: ContextTypes.DEFAULT_TYPE, uid: int, d: Dict[str, Any]) -> str:
+    start_speculative_pickup(uid, d)
+    return C_DROP
+
+
+async def _after_drop(context: ContextTypes.DEFAULT_TYPE, uid: int, d: Dict[str, Any]) -> str:
+    start_speculative_quote(uid, d)
+    log.info(f"ROUTE CHECK from='{d.get('pickup_address_ko')}' to='{d.get('drop_address_ko')}'")
+    return C_DOOR
+
+
+async def _after_client_phone(context: ContextTypes.DEFAULT_TYPE, uid: int, d: Dict[str, Any]) -> str:
+    d["recipient_contact_text"] = f"{d.get('client_name')} · {d.get('client_phone')}"
+
+    # ✅ если Dunpo - цена фикс сразу
+    if d.get("zone") == "dunpo":
+        d["price_krw"] = DEFAULT_PRICE_KRW
+        return C_CONFIRM
+
+    # ✅ если other - считаем рекомендованную и предлагаем выбор
+    quote = await take_speculative_quote(uid, d, d.get("pickup_address_ko", ""), d.get("drop_address_ko", ""))
+    if quote:
+        d["recommended_price_krw"] = quote.price_krw
+        d["recommended_km"] = quote.km
+        d["recommended_source"] = quote.source
+        return C_PRICE_RECOMMEND
+
+    # fallback - если не смогли посчитать маршрут
+    d.pop("recommended_price_krw", None)
+    return C_PRICE_FINAL
+
+
+async def _after_courier_transport(context: ContextTypes.DEFAULT_TYPE, uid: int, ud: Dict[str, Any]) -> str:
+    name = ud.pop("apply_name", "")
+    phone = ud.pop("apply_phone", "")
+    transport = ud.pop("apply_transport", "")
+
+    prof = CourierProfile(
+        courier_tg_id=uid,
+        username=ud.pop("apply_username", ""),
+        name=name,
+        phone=phone,
+        transport=transport,
+        status=COURIER_PENDING,
+        applied_at=now_ts(),
     )
+    COURIERS[uid] = prof
 
-    if not headers["X-NCP-APIGW-API-KEY-ID"] or not headers["X-NCP-APIGW-API-KEY"]:
-        log.warning("NAVER ROUTE SKIP: missing API keys")
-        return None
+    if SHEETS:
+        SHEETS.upsert_courier(asdict(prof))
+        SHEETS.log_event(uid, ROLE_COURIER, "COURIER_APPLY_SUBMIT")
 
-    params = {
-        "start": f"{start_lon},{start_lat}",
-        "goal": f"{goal_lon},{goal_lat}",
-        "option": "traoptimal",
-    }
+    await ui_render(
+        context,
+        uid,
+        "✅ Заявка отправлена.\nОжидайте одобрения администратора."
+    )
 
-    r = await run_blocking(requests.get, url, params=params, timeout=5)
+    admin_notify(
+        context.bot,
+        (
+            "🧍 Заявка курьера\n\n"
+            f"Имя: {name}\n"
+            f"Телефон: {phone}\n"
+            f"Транспорт: {transport}\n"
+            f"ID: {uid}"
+        ),
+        critical=True,
+        reply_markup=kb_admin_app_decision(uid)
+    )
+    return K_NONE
 
-    log.info(
-        "NAVER ROUTE RESPONSE | status=%s | body=%s",
-        r.status_code,
-        r.text[:300],
+
+def _price_recommend_prompt(d: Dict[str, Any]) -> str:
+    source = d.get("recommended_source", "")
+    return (
+        f"💰 Рекомендованная цена: {d.get('recommended_price_krw')} вон\n"
+        f"(расчет: {PRICE_PER_KM_KRW} вон за км, "
+        f"{float(d.get('recommended_km') or 0):.1f} км, {QUOTE_SOURCE_RU.get(source, source)})\n\n"
+        "Принять эту цену или ввести свою?"
     )
 
-    r.raise_for_status()
-    data = r.json()
 
-    route = data.get("route") or {}
-    arr = route.get("traoptimal") or []
-    if not arr:
-        log.warning("NAVER ROUTE EMPTY")
-        return None
+def _price_final_prompt(d: Dict[str, Any]) -> str:
+    if not d.get("recommended_price_krw"):
+        return "💰 Не удалось рассчитать маршрут. Укажите цену вручную (в вонах)."
+    return "Введите цену вручную (в вонах). Например: 12000"
 
-    summary = (arr[0] or {}).get("summary") or {}
-    dist_m = summary.get("distance")
-    if dist_m is None:
-        log.warning("NAVER ROUTE NO DISTANCE FIELD")
-        return None
 
-    try:
-        return float(dist_m) / 1000.0
-    except Exception as e:
-        log.warning("NAVER ROUTE DIST PARSE ERROR: %s", e)
-        return None
+# ---- таблица шагов (в порядке воронки) ----
+wizard_step(C_PRICE_ZONE, WIZ_FLOW_CLIENT, "Выберите зону доставки:", keyboard=kb_client_price_choice)
+wizard_step(
+    C_PICKUP, WIZ_FLOW_CLIENT, _ADDR_PROMPTS["pickup"],
+    render=lambda context, chat_id, uid, d: prompt_client_address(context, chat_id, uid, "pickup"),
+    field="pickup_address_ko", parse=_parse_korean_address,
+    error="📍 Адрес забора должен быть на корейском языке.\nПожалуйста, попробуйте еще раз.",
+    next=_after_pickup, event="ORDER_STEP_PICKUP",
+)
+wizard_step(
+    C_DROP, WIZ_FLOW_CLIENT, _ADDR_PROMPTS["drop"],
+    render=lambda context, chat_id, uid, d: prompt_client_address(context, chat_id, uid, "drop"),
+    field="drop_address_ko", parse=_parse_korean_address,
+    error="Пожалуйста, укажите адрес на корейском языке. Это нужно для навигатора.",
+    next=_after_drop, event="ORDER_STEP_DROP",
+)
+wizard_step(
+    C_DOOR, WIZ_FLOW_CLIENT,
+    "🔒 Если нужен код подъезда или домофона, напишите его.\nЕсли кода нет, нажмите кнопку ниже.",
+    keyboard=kb_door_code, field="door_code", parse=_parse_any,
+    next=C_TYPE, event="ORDER_STEP_DOOR_TEXT",
+)
+wizard_step(C_TYPE, WIZ_FLOW_CLIENT, "Выберите тип доставки.", keyboard=kb_delivery_type)
+wizard_step(
+    C_TYPE_OTHER, WIZ_FLOW_CLIENT, "Коротко опишите, что нужно доставить.",
+    field="delivery_type_other_text", parse=_parse_nonempty,
+    next=C_TIME, event="ORDER_STEP_TYPE_OTHER_TEXT",
+)
+wizard_step(C_TIME, WIZ_FLOW_CLIENT, "Когда нужна доставка?", keyboard=kb_delivery_time)
+wizard_step(
+    C_TIME_CUSTOM, WIZ_FLOW_CLIENT, "Напишите желаемое время доставки.",
+    field="delivery_time_text", parse=_parse_nonempty,
+    next=C_CLIENT_NAME, event="ORDER_STEP_TIME_CUSTOM_TEXT",
+)
+wizard_step(
+    C_CLIENT_NAME, WIZ_FLOW_CLIENT, "Введите ваше имя.",
+    field="client_name", parse=_parse_nonempty, next=C_CLIENT_PHONE,
+)
+wizard_step(
+    C_CLIENT_PHONE, WIZ_FLOW_CLIENT, "Введите номер телефона.",
+    field="client_phone", parse=_parse_nonempty, next=_after_client_phone,
+)
+wizard_step(C_PRICE_RECOMMEND, WIZ_FLOW_CLIENT, _price_recommend_prompt, keyboard=kb_client_price_recommend)
+wizard_step(
+    C_PRICE_FINAL, WIZ_FLOW_CLIENT, _price_final_prompt,
+    field="price_krw", parse=parse_price_krw,
+    error="Введите сумму числом (1000–300000). Например: 12000",
+    next=C_CONFIRM,
+)
+wizard_step(C_CONFIRM, WIZ_FLOW_CLIENT, render_order_summary_for_confirm, keyboard=kb_confirm_order)
 
-async def calc_recommended_price_krw(pickup_addr: str, drop_addr: str) -> Optional[int]:
-    a = await google_geocode(pickup_addr)
-    b = await google_geocode(drop_addr)
-    if not a or not b:
-        log.warning("PRICE CALC FAIL | geocode failed | a=%s b=%s", a, b)
-        return None
+wizard_step(
+    K_APPLY_NAME, WIZ_FLOW_COURIER, "Введите ваше имя.",
+    field="apply_name", parse=_parse_nonempty, next=K_APPLY_PHONE,
+)
+wizard_step(
+    K_APPLY_PHONE, WIZ_FLOW_COURIER, "Введите номер телефона.",
+    field="apply_phone", parse=_parse_nonempty, next=K_APPLY_TRANSPORT,
+)
+wizard_step(
+    K_APPLY_TRANSPORT, WIZ_FLOW_COURIER, "Транспорт: Машина или Скутер?",
+    field="apply_transport", parse=_parse_transport, error="Ответьте, машина или скутер.",
+    next=_after_courier_transport,
+)
 
-    lat1, lng1 = a
-    lat2, lng2 = b
 
-    km = await google_distance_km(lat1, lng1, lat2, lng2)
+# =========================
+# FLOOD PROTECTION (token bucket на пользователя)
+# =========================
+# TypeHandler в группе -1 - срабатывает до on_message / on_callback.
+# У каждого пользователя ведро на FLOOD_BURST токенов, пополняется FLOOD_RATE_PER_SEC
+# в секунду; нажатие/сообщение стоит токен. Пустое ведро - апдейт дальше не идет
+# (ApplicationHandlerStop): ни Sheets, ни сканов ORDERS.
+# Админы не ограничиваются; edited_message (live location курьеров) не считаем.
+FLOOD_BURST = float(os.getenv("FLOOD_BURST", "8"))
+FLOOD_RATE_PER_SEC = float(os.getenv("FLOOD_RATE_PER_SEC", "1.0"))
+FLOOD_SWEEP_EVERY = 5000    # раз в столько апдейтов выкидываем полные (простаивающие) ведра
+FLOOD_TOP_KEEP = 100        # сколько самых частых нарушителей помнить между чистками
+
+# uid -> [токены, monotonic последнего пополнения, предупреждали ли в этой серии]
+FLOOD_BUCKETS: Dict[int, list] = {}
+FLOOD_THROTTLED_BY_USER: Counter = Counter()
+FLOOD_STATS: Dict[str, int] = {
+    "passed": 0,
+    "throttled_cb": 0,
+    "throttled_msg": 0,
+}
 
-    source = "google"
 
-    if km is None:
-        base_km = haversine_km(lat1, lng1, lat2, lng2)
-        km = base_km * 1.5
-        source = "haversine_adjusted"
+def flood_take(uid: int) -> bool:
+    """
+    Списать токен. False - ведро пустое, апдейт нужно отбросить.
+    """
+    now = time.monotonic()
+    b = FLOOD_BUCKETS.get(uid)
+    if b is None:
+        b = FLOOD_BUCKETS[uid] = [FLOOD_BURST, now, False]
+    else:
+        b[0] = min(FLOOD_BURST, b[0] + (now - b[1]) * FLOOD_RATE_PER_SEC)
+        b[1] = now
 
-    log.info(
-        "DISTANCE RESULT | km=%.2f | source=%s",
-        km,
-        source
+    if b[0] >= 1.0:
+        b[0] -= 1.0
+        b[2] = False
+        return True
+    return False
+
+
+def flood_sweep():
+    now = time.monotonic()
+    full_after = FLOOD_BURST / FLOOD_RATE_PER_SEC if FLOOD_RATE_PER_SEC > 0 else float("inf")
+    stale = [uid for uid, b in FLOOD_BUCKETS.items() if now - b[1] >= full_after]
+    for uid in stale:
+        FLOOD_BUCKETS.pop(uid, None)
+
+    if len(FLOOD_THROTTLED_BY_USER) > FLOOD_TOP_KEEP:
+        top = FLOOD_THROTTLED_BY_USER.most_common(FLOOD_TOP_KEEP)
+        FLOOD_THROTTLED_BY_USER.clear()
+        FLOOD_THROTTLED_BY_USER.update(dict(top))
+
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if FLOOD_RATE_PER_SEC <= 0:
+        return
+    user = update.effective_user
+    if not user or is_admin(user.id):
+        return
+    query = update.callback_query
+    if not query and not update.message:
+        return
+
+    if flood_take(user.id):
+        FLOOD_STATS["passed"] += 1
+        if FLOOD_STATS["passed"] % FLOOD_SWEEP_EVERY == 0:
+            flood_sweep()
+        return
+
+    FLOOD_THROTTLED_BY_USER[user.id] += 1
+    bucket = FLOOD_BUCKETS[user.id]
+    warn = not bucket[2]
+    bucket[2] = True
+
+    if query:
+        FLOOD_STATS["throttled_cb"] += 1
+        # на query отвечать надо в любом случае, иначе кнопка "крутится"
+        try:
+            await query.answer("⏳ Слишком часто. Подождите пару секунд." if warn else None)
+        except Exception:
+            pass
+    else:
+        FLOOD_STATS["throttled_msg"] += 1
+        if warn:
+            log.info("FLOOD THROTTLED | uid=%s", user.id)
+            try:
+                await update.message.reply_text("⏳ Слишком часто. Подождите пару секунд.")
+            except Exception:
+                pass
+    raise ApplicationHandlerStop
+
+
+def render_flood_line() -> str:
+    st = FLOOD_STATS
+    top = FLOOD_THROTTLED_BY_USER.most_common(3)
+    top_text = ", ".join(f"{uid}: {n}" for uid, n in top) or "-"
+    return (
+        f"Флуд-контроль ({FLOOD_BURST:g} / {FLOOD_RATE_PER_SEC:g} в с): пропущено {st['passed']} | "
+        f"погашено кнопок {st['throttled_cb']} | сообщений {st['throttled_msg']} | "
+        f"нарушителей (до {FLOOD_TOP_KEEP}) {len(FLOOD_THROTTLED_BY_USER)} | топ {top_text}"
     )
-    def round_krw_1000(value: int) -> int:
-        return int(math.ceil(value / 1000.0) * 1000)
 
-    raw_price = int(round(km * PRICE_PER_KM_KRW))
-    price = round_krw_1000(raw_price)
-    log.info("PRICE FINAL | raw=%s | rounded=%s", raw_price, price)
-    return price
 
-    
 # =========================
 # MAIN CALLBACK HANDLER
 # =========================
@@ -2362,6 +6037,7 @@ async def calc_recommended_price_krw(pickup_addr: str, drop_addr: str) -> Option
 async def handle_hard_reset(query, context: ContextTypes.DEFAULT_TYPE):
     uid = query.from_user.id
 
+    cancel_speculative_quote(uid)
     context.user_data.clear()
     context.user_data.pop(UI_MSG_ID_KEY, None)
     context.user_data[CLIENT_STATE_KEY] = C_NONE
@@ -2382,716 +6058,772 @@ async def handle_hard_reset(query, context: ContextTypes.DEFAULT_TYPE):
     # иначе — обычный старт
     await render_home_root(context, uid)
 
-async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    
-    query = update.callback_query
-    if not query:
-        return
 
+async def render_active_order_screen(query, context: ContextTypes.DEFAULT_TYPE, order: Order):
+    """
+    Экран активного заказа курьера: карточка + кнопка следующего шага по статусу.
+    """
     uid = query.from_user.id
-    data = query.data or ""
-    
-    # 🔁 СМЕНА РОЛИ — должна работать ВСЕГДА
-    if data == "role:reset":
-        context.user_data.clear()
-        context.user_data.pop(UI_MSG_ID_KEY, None)
 
-        context.user_data[USER_ROLE_KEY] = ROLE_UNKNOWN
-        context.user_data[CLIENT_STATE_KEY] = C_NONE
-        context.user_data[COURIER_STATE_KEY] = K_NONE
-        context.user_data.pop("draft_order", None)
-        context.user_data.pop("awaiting_proof_order_id", None)
+    if order.status == ORDER_TAKEN:
+        kb = kb_order_taken(order.order_id)
+    elif order.status == ORDER_EN_ROUTE:
+        kb = kb_order_en_route(order.order_id)
+    elif order.status == ORDER_PICKED_UP:
+        kb = kb_order_picked_up(order.order_id)
+    else:
+        kb = None
+
+    await ui_render(
+        context,
+        uid,
+        render_order_taken_text(order),
+        reply_markup=kb
+    )
 
-        if SHEETS:
-            SHEETS.log_event(uid, ROLE_UNKNOWN, "ROLE_RESET")
 
-        await render_home_root(context, uid)
+async def show_courier_dashboard(context: ContextTypes.DEFAULT_TYPE, uid: int):
+    prof = COURIERS.get(uid)
+    if not prof:
+        await ui_render(
+            context,
+            uid,
+            "Чтобы получать заказы, нужно стать курьером.",
+            reply_markup=kb_courier_menu_not_applied()
+        )
         return
-    
-    # 📋 COPY HANDLER — СРАЗУ ПОСЛЕ data
-    if data.startswith("copy:"):
-        _, what, order_id = data.split(":", 2)
-        order = ORDERS.get(order_id)
 
-        if not order or order.courier_tg_id != uid:
-            await query.answer("Нет доступа")
-            return
+    if prof.status == COURIER_PENDING:
+        await ui_render(
+            context,
+            uid,
+            "Заявка отправлена.\nОжидайте одобрения администратора.",
+            reply_markup=kb_courier_menu_pending()
+        )
+        return
+
+    if prof.status == COURIER_APPROVED:
+        active = get_active_order_for_courier(uid)
+        active_line = f"\nАктивный заказ: #{active.order_id}" if active else ""
+        await ui_render(
+            context,
+            uid,
+            f"✅ Вы одобрены как курьер.{active_line}\nНовые заказы будут приходить автоматически.",
+            reply_markup=kb_courier_menu_approved(uid)
+        )
+        return
+
+    await ui_render(
+        context,
+        uid,
+        "Ваша заявка отклонена.",
+        reply_markup=kb_courier_menu_not_applied()
+    )
+
+
+# ---- маршруты callback-кнопок ----
+
+@CALLBACKS.route("role:reset", stage=CB_STAGE_ALWAYS)
+async def cb_role_reset(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    cancel_speculative_quote(uid)
+    context.user_data.clear()
+    context.user_data.pop(UI_MSG_ID_KEY, None)
+
+    context.user_data[USER_ROLE_KEY] = ROLE_UNKNOWN
+    context.user_data[CLIENT_STATE_KEY] = C_NONE
+    context.user_data[COURIER_STATE_KEY] = K_NONE
+    context.user_data.pop("draft_order", None)
+    context.user_data.pop("awaiting_proof_order_id", None)
+
+    if SHEETS:
+        SHEETS.log_event(uid, ROLE_UNKNOWN, "ROLE_RESET")
+
+    await render_home_root(context, uid)
 
-        if what == "pickup":
-            text = order.pickup_address_ko
-        elif what == "drop":
-            text = order.drop_address_ko
-        elif what == "phone":
-            text = order.recipient_contact_text
-        else:
-            return
 
-        await context.bot.send_message(chat_id=uid, text=text)
+@CALLBACKS.route("client:photo:{order_id}", stage=CB_STAGE_PRE_SESSION, answer=False)
+async def cb_client_photo(query, context: ContextTypes.DEFAULT_TYPE, uid: int, order_id: str):
+    order = ORDERS.get(order_id)
+
+    if not order or order.client_tg_id != uid:
+        await query.answer("Фото недоступно", show_alert=True)
         return
-        
-    if context.user_data.get(START_LOCK_KEY):
+
+    if not order.proof_image_file_id:
+        await query.answer("Фото еще нет", show_alert=True)
         return
 
-    if context.user_data.get(UI_RESET_KEY):
-        await query.answer("Обновление…")
+    await query.answer()
+    await tg_retry(lambda: context.bot.send_photo(
+        chat_id=uid,
+        photo=order.proof_image_file_id,
+        caption=f"📦 Заказ #{order.order_id}\nФото доставки"
+    ))
+
+
+@CALLBACKS.route("skip:{order_id}", stage=CB_STAGE_PRE_SESSION)
+async def cb_skip_order(query, context: ContextTypes.DEFAULT_TYPE, uid: int, order_id: str):
+    if SHEETS:
+        SHEETS.log_event(uid, ROLE_COURIER, "ORDER_SKIPPED", order_id=order_id)
+    await ui_render(context, uid, "Заказ пропущен.")
+
+
+@CALLBACKS.route("courier:dashboard")
+async def cb_courier_dashboard(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    await show_courier_dashboard(context, uid)
+
+
+@CALLBACKS.route("home:start")
+async def cb_home_start(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    await ui_render(
+        context,
+        uid,
+        "📍 Где вы находитесь?",
+        reply_markup=kb_location()
+    )
+
+
+@CALLBACKS.route("home:rules")
+async def cb_home_rules(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    await ui_render(
+        context,
+        uid,
+        text_rules(),
+        reply_markup=kb_back_home()
+    )
+
+
+@CALLBACKS.route("home:client")
+async def cb_home_client(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    await ui_render(
+        context,
+        uid,
+        text_how_client(),
+        reply_markup=kb_back_home()
+    )
+
+
+@CALLBACKS.route("home:courier")
+async def cb_home_courier(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    await ui_render(
+        context,
+        uid,
+        text_how_courier(),
+        reply_markup=kb_back_home()
+    )
+
+
+@CALLBACKS.route("home:back")
+async def cb_home_back(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    await render_home_root(context, uid)
+
+
+@CALLBACKS.route("info:rules")
+async def cb_info_rules(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    await ui_render(context, uid, text_rules(), reply_markup=kb_back_to_start())
+
+
+@CALLBACKS.route("info:client")
+async def cb_info_client(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    await ui_render(context, uid, text_how_client(), reply_markup=kb_back_to_start())
+
+
+@CALLBACKS.route("info:courier")
+async def cb_info_courier(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    await ui_render(context, uid, text_how_courier(), reply_markup=kb_back_to_start())
+
+
+@CALLBACKS.route("info:back")
+async def cb_info_back(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    await render_home_root(context, uid)
+
+
+@CALLBACKS.route("courier:orders")
+async def cb_courier_orders(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    # если есть активный заказ — показываем только его
+    active = get_active_order_for_courier(uid)
+    if active:
+        context.user_data.pop(UI_MSG_ID_KEY, None)
+        await render_active_order_screen(query, context, active)
         return
 
-    try:
-        await query.answer()
-    except Exception:
-        pass
+    # иначе — показываем список заявок
+    await show_current_orders_for_courier(context, uid)
 
-    uid = query.from_user.id
-    uname = query.from_user.username or ""
-    current_role = context.user_data.get(USER_ROLE_KEY, ROLE_UNKNOWN)
-    data = query.data or ""
 
-    # 📷 Фото доставки по кнопке (история заказов)
-    if data.startswith("client:photo:"):
-        order_id = data.split(":", 2)[2]
-        order = ORDERS.get(order_id)
+@CALLBACKS.route("start:go")
+async def cb_start_go(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    await ui_render(
+        context,
+        uid,
+        "📍 Где вы находитесь?",
+        reply_markup=kb_location()
+    )
 
-        if not order or order.client_tg_id != uid:
-            await query.answer("Фото недоступно", show_alert=True)
-            return
 
-        if not order.proof_image_file_id:
-            await query.answer("Фото еще нет", show_alert=True)
-            return
+@CALLBACKS.route("loc:{loc}")
+async def cb_pick_location(query, context: ContextTypes.DEFAULT_TYPE, uid: int, loc: str):
+    context.user_data[USER_LOCATION_KEY] = loc
+    if SHEETS:
+        SHEETS.log_event(uid, context.user_data.get(USER_ROLE_KEY, ROLE_UNKNOWN), "LOCATION_PICKED", meta=loc)
 
-        await tg_retry(lambda: context.bot.send_photo(
-            chat_id=uid,
-            photo=order.proof_image_file_id,
-            caption=f"📦 Заказ #{order.order_id}\nФото доставки"
-        ))
+    if loc != LOC_DUNPO:
+        await ui_render(
+            context,
+            uid,
+            "Пока доставка работает только в Дунпо.\n\nВыберите 'Дунпо', чтобы продолжить.",
+            reply_markup=kb_location()
+        )
         return
 
+    await ui_render(context, uid, "👤 Кто вы?", reply_markup=kb_role())
 
-    # ===== COURIER ACTIONS — MUST BE BEFORE CLIENT FSM CHECK =====
 
-    if data.startswith("take:"):
-        order_id = data.split(":", 1)[1]
-        await handle_take_order(query, context, uid, order_id)
-        return
+@CALLBACKS.route("client:menu")
+async def cb_client_menu(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    await ui_render(
+        context,
+        uid,
+        "🏠 Меню клиента:",
+        reply_markup=kb_client_menu()
+    )
 
-    if data.startswith("badaddr:"):
-        order_id = data.split(":", 1)[1]
-        await handle_bad_address(query, context, uid, order_id)
-        return
 
-    if data.startswith("skip:"):
-        order_id = data.split(":", 1)[1]
-        if SHEETS:
-            SHEETS.log_event(uid, ROLE_COURIER, "ORDER_SKIPPED", order_id=order_id)
-        await ui_render(context, uid, "Заказ пропущен.")
-        return
+@CALLBACKS.route("role:client")
+async def cb_role_client(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    context.user_data[USER_ROLE_KEY] = ROLE_CLIENT
+    context.user_data[CLIENT_STATE_KEY] = C_NONE
+    cancel_speculative_quote(uid)
+    context.user_data.pop("draft_order", None)
+    if SHEETS:
+        SHEETS.log_event(uid, ROLE_CLIENT, "ROLE_PICKED")
+    await ui_render(
+        context,
+        uid,
+        "Что вы хотите сделать?",
+        reply_markup=kb_client_menu()
+    )
 
-    if data.startswith("progress:"):
-        order_id = data.split(":", 1)[1]
-        await handle_in_progress_clicked(query, context, uid, order_id)
-        return
 
-    if data.startswith("picked:"):
-        order_id = data.split(":", 1)[1]
-        await handle_picked_up(query, context, uid, order_id)
+@CALLBACKS.route("courier:orders:{cursor}")
+async def cb_courier_orders_page(query, context: ContextTypes.DEFAULT_TYPE, uid: int, cursor: str):
+    if get_active_order_for_courier(uid):
+        await cb_courier_orders(query, context, uid)
         return
+    await show_current_orders_for_courier(context, uid, cursor)
 
-    if data.startswith("done:"):
-        order_id = data.split(":", 1)[1]
-        await handle_done_clicked(query, context, uid, order_id)
-        return
 
+@CALLBACKS.route("courier_refresh")
+async def cb_courier_refresh(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    await show_current_orders_for_courier(context, uid)
 
-    if CLIENT_STATE_KEY not in context.user_data:
-        await query.answer("Сессия обновлена. Нажмите /start", show_alert=False)
-        return
 
-    # фильтр выполненных заказов курьера
-    done = [
-        o for o in ORDERS.values()
-        if o.status == ORDER_DONE and o.courier_tg_id == uid and o.completed_at
-    ]
-    # ===== HOME SCREENS =====
+@CALLBACKS.route("courier:stats")
+async def cb_courier_stats(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    text = build_courier_stats_text(uid)
+    await ui_render(
+        context,
+        uid,
+        text,
+        reply_markup=kb_courier_menu_approved(uid)
+    )
 
-    if data == "courier:dashboard":
-        await show_courier_dashboard(context, uid)
-        return
 
-    if data == "home:start":
+@CALLBACKS.route("client:status:open")
+async def cb_client_status(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    o = pick_active_order(uid)
+    if not o:
         await ui_render(
             context,
             uid,
-            "📍 Где вы находитесь?",
-            reply_markup=kb_location()
+            "У вас пока нет заказов.",
+            reply_markup=kb_client_menu()
         )
         return
+    can_cancel = (o.status == ORDER_NEW)
+    await ui_render(
+        context,
+        uid,
+        render_client_status(o),
+        reply_markup=kb_client_status(o, can_cancel)
+    )
 
-    if data == "home:rules":
-        await ui_render(
-            context,
-            uid,
-            text_rules(),
-            reply_markup=kb_back_home()
-        )
-        return
 
-    if data == "home:client":
-        await ui_render(
-            context,
-            uid,
-            text_how_client(),
-            reply_markup=kb_back_home()
-        )
-        return
+@CALLBACKS.route("client:orders_today")
+async def cb_client_orders_today(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    items = get_client_orders(uid)
+    filtered = filter_orders_by_period(items, "today")
 
-    if data == "home:courier":
+    if not filtered:
         await ui_render(
             context,
             uid,
-            text_how_courier(),
-            reply_markup=kb_back_home()
+            "За сегодня у вас пока нет заказов.",
+            reply_markup=kb_client_menu()
         )
         return
 
-    if data == "home:back":
-        await render_home_root(context, uid)
-        return
-    
-   
-    if data == "info:rules":
-        await ui_render(context, uid, text_rules(), reply_markup=kb_back_to_start())
-        return
+    buttons = []
+    for o in filtered:
+        if o.status == ORDER_DONE and o.proof_image_file_id:
+            buttons.append([InlineKeyboardButton(
+                f"📷 Фото доставки #{o.order_id}",
+                callback_data=f"client:photo:{o.order_id}"
+            )])
 
-    if data == "info:client":
-        await ui_render(context, uid, text_how_client(), reply_markup=kb_back_to_start())
-        return
+    buttons.append([InlineKeyboardButton("🏠 Меню", callback_data="client:menu")])
 
-    if data == "info:courier":
-        await ui_render(context, uid, text_how_courier(), reply_markup=kb_back_to_start())
-        return
+    # показываем список заказов
+    await ui_render(
+        context,
+        uid,
+        render_orders_list(filtered),
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
 
-    if data == "info:back":
-        await render_home_root(context, uid)
-        return
 
+@CALLBACKS.route("client:orders:open")
+async def cb_client_orders_open(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    await ui_render(
+        context,
+        uid,
+        "Выберите период:",
+        reply_markup=kb_client_orders_filters()
+    )
 
-    if data == "courier:orders":
-        # если есть активный заказ — показываем только его
-        active = get_active_order_for_courier(uid)
-        if active:
-            context.user_data.pop(UI_MSG_ID_KEY, None)
-            await render_active_order_screen(query, context, active)
-            return
 
-        # иначе — показываем список заявок
-        await show_current_orders_for_courier(context, uid)
-        return
+@CALLBACKS.route("client:orders:{period}")
+async def cb_client_orders_period(query, context: ContextTypes.DEFAULT_TYPE, uid: int, period: str):
+    items = get_client_orders(uid)
+    filtered = filter_orders_by_period(
+        items,
+        period if period in ("today", "week", "month") else "month"
+    )
 
-    if data == "start:go":
-        await ui_render(
-            context,
-            uid,
-            "📍 Где вы находитесь?",
-            reply_markup=kb_location()
-        )
-        return
-    
-    
+    text = render_orders_list(filtered)
+    if not text.strip():
+        text = "Нет данных."
+    await ui_render(context, uid, text)
 
-    if data.startswith("loc:"):
-        loc = data.split(":", 1)[1]
-        context.user_data[USER_LOCATION_KEY] = loc
-        if SHEETS:
-            SHEETS.log_event(uid, current_role, "LOCATION_PICKED", meta=loc)
 
-        if loc != LOC_DUNPO:
-            await ui_render(
-                context,
-                uid,
-                "Пока доставка работает только в Дунпо.\n\nВыберите 'Дунпо', чтобы продолжить.",
-                reply_markup=kb_location()
-            )
-            return
+@CALLBACKS.route("client:new_order")
+async def cb_client_new_order(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    context.user_data.pop(UI_MSG_ID_KEY, None)
+    cancel_speculative_quote(uid)
+    context.user_data["draft_order"] = {}
+    context.user_data[CLIENT_STATE_KEY] = C_PRICE_ZONE
 
-        await ui_render(context, uid, "👤 Кто вы?", reply_markup=kb_role())
-        return
+    if SHEETS:
+        SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_START_PRICE_ZONE")
 
-    
+    await wizard_enter(context, uid, uid, C_PRICE_ZONE)
 
-    if data == "reset:hard":
-        await handle_hard_reset(query, context)
-        return
 
-    if data == "client:menu":
-        await ui_render(
-            context,
-            uid,
-            "🏠 Меню клиента:",
-            reply_markup=kb_client_menu()
-        )
+@CALLBACKS.route("client:price:local")
+async def cb_client_price_local(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    if context.user_data.get(CLIENT_STATE_KEY) != C_PRICE_ZONE:
         return
 
-    if data == "role:client":
-        context.user_data[USER_ROLE_KEY] = ROLE_CLIENT
-        context.user_data[CLIENT_STATE_KEY] = C_NONE
-        context.user_data.pop("draft_order", None)
-        if SHEETS:
-            SHEETS.log_event(uid, ROLE_CLIENT, "ROLE_PICKED")
-        await ui_render(
-            context,
-            uid,
-            "Что вы хотите сделать?",
-            reply_markup=kb_client_menu()
-        )
+    d = context.user_data.get("draft_order", {})
+    d["zone"] = "dunpo"
+    d["price_krw"] = DEFAULT_PRICE_KRW
+    context.user_data["draft_order"] = d
+
+    await wizard_enter(context, uid, uid, C_PICKUP)
+
+
+@CALLBACKS.route("client:price:custom")
+async def cb_client_price_custom(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    if context.user_data.get(CLIENT_STATE_KEY) != C_PRICE_ZONE:
         return
 
-    if data == "role:courier":
-        context.user_data[USER_ROLE_KEY] = ROLE_COURIER
-        context.user_data[COURIER_STATE_KEY] = K_NONE
-        if SHEETS:
-            SHEETS.log_event(uid, ROLE_COURIER, "ROLE_PICKED")
+    d = context.user_data.get("draft_order", {})
+    d["zone"] = "other"
+    context.user_data["draft_order"] = d
 
-        prof = COURIERS.get(uid)
-        if not prof:
-            await ui_render(
-                context,
-                uid,
-                "Чтобы получать заказы, нужно стать курьером.",
-                reply_markup=kb_courier_menu_not_applied()
-            )
-            return
+    await wizard_enter(context, uid, uid, C_PICKUP)
 
-        if prof.status == COURIER_PENDING:
-            await ui_render(
-                context,
-                uid,
-                "Заявка отправлена.\nОжидайте одобрения администратора.",
-                reply_markup=kb_courier_menu_pending()
-            )
-            return
 
-        if prof.status == COURIER_APPROVED:
-            active = get_active_order_for_courier(uid)
-            active_line = f"\nАктивный заказ: #{active.order_id}" if active else ""
-            await ui_render(
-                context,
-                uid,
-                f"✅ Вы одобрены как курьер.{active_line}\nНовые заказы будут приходить автоматически.",
-                reply_markup=kb_courier_menu_approved(uid)
-            )
-            return
+@CALLBACKS.route("client:price:accept_recommended")
+async def cb_client_price_accept(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    if context.user_data.get(CLIENT_STATE_KEY) != C_PRICE_RECOMMEND:
+        return
 
-        await ui_render(
-            context,
-            uid,
-            "Ваша заявка отклонена.",
-            reply_markup=kb_courier_menu_not_applied()
-        )
+    d = context.user_data.get("draft_order", {})
+    rec = int(d.get("recommended_price_krw") or 0)
+    if rec <= 0:
+        # если вдруг пропало - уходим на ручной ввод
+        await wizard_enter(context, uid, uid, C_PRICE_FINAL)
         return
 
-    # 🔄 ОБНОВЛЕНИЕ ЭКРАНА КУРЬЕРА
-    if data == "courier_refresh":
-        await show_current_orders_for_courier(context, uid)
+    d["price_krw"] = rec
+    context.user_data["draft_order"] = d
+    await wizard_enter(context, uid, uid, C_CONFIRM)
+
+
+@CALLBACKS.route("client:price:manual")
+async def cb_client_price_manual(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    if context.user_data.get(CLIENT_STATE_KEY) != C_PRICE_RECOMMEND:
         return
 
-    if data == "courier:stats":
-        text = build_courier_stats_text(uid)
-        await ui_render(
-            context,
-            uid,
-            text,
-            reply_markup=kb_courier_menu_approved(uid)
-        )
+    await wizard_enter(context, uid, uid, C_PRICE_FINAL)
+
+
+@CALLBACKS.route("client:door_none")
+async def cb_client_door_none(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    if context.user_data.get(CLIENT_STATE_KEY) != C_DOOR:
         return
 
-    if data == "courier:active_order":
-        active = get_active_order_for_courier(uid)
-        if not active:
-            await ui_render(
-                context,
-                uid,
-                "Сейчас у вас нет активного заказа.",
-                reply_markup=kb_courier_menu_approved(uid)
-            )
-            return
+    d = context.user_data.get("draft_order", {})
+    d["door_code"] = ""
+    context.user_data["draft_order"] = d
+    if SHEETS:
+        SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_STEP_DOOR_NONE")
+    await wizard_enter(context, uid, uid, C_TYPE)
 
-        if active.status == ORDER_TAKEN:
-            kb = kb_order_taken(active.order_id)
-        elif active.status == ORDER_EN_ROUTE:
-            kb = kb_order_en_route(active.order_id)
-        elif active.status == ORDER_PICKED_UP:
-            kb = kb_order_picked_up(active.order_id)
-        else:
-            kb = None
 
-        await ui_render(
-            context,
-            uid,
-            render_order_taken_text(active),
-            reply_markup=kb
-        )
+@CALLBACKS.route("client:type:{delivery_type}")
+async def cb_client_type(query, context: ContextTypes.DEFAULT_TYPE, uid: int, delivery_type: str):
+    if context.user_data.get(CLIENT_STATE_KEY) != C_TYPE:
         return
 
-    if data == "client:status:open":
-        o = pick_active_order(uid)
-        if not o:
-            await ui_render(
-                context,
-                uid,
-                "У вас пока нет заказов.",
-                reply_markup=kb_client_menu()
-            )
-            return
-        can_cancel = (o.status == ORDER_NEW)
-        await ui_render(
-            context,
-            uid,
-            render_client_status(o),
-            reply_markup=kb_client_status(o, can_cancel)
-        )
+    d = context.user_data.get("draft_order", {})
+    d["delivery_type"] = delivery_type
+    context.user_data["draft_order"] = d
+
+    if delivery_type == "other":
+        if SHEETS:
+            SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_STEP_TYPE_OTHER")
+
+        await wizard_enter(context, uid, uid, C_TYPE_OTHER)
         return
-      
-    if data == "client:orders_today":
-        items = get_client_orders(uid)
-        filtered = filter_orders_by_period(items, "today")
 
-        if not filtered:
-            await ui_render(
-                context,
-                uid,
-                "За сегодня у вас пока нет заказов.",
-                reply_markup=kb_client_menu()
-            )
-            return
+    # обычные типы доставки
+    if SHEETS:
+        SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_STEP_TYPE", meta=delivery_type)
 
-        buttons = []
-        for o in filtered:
-            if o.status == ORDER_DONE and o.proof_image_file_id:
-                buttons.append([InlineKeyboardButton(
-                    f"📷 Фото доставки #{o.order_id}",
-                    callback_data=f"client:photo:{o.order_id}"
-                )])
+    await wizard_enter(context, uid, uid, C_TIME)
 
-        buttons.append([InlineKeyboardButton("🏠 Меню", callback_data="client:menu")])
 
-        # показываем список заказов
-        await ui_render(
-            context,
-            uid,
-            render_orders_list(filtered),
-            reply_markup=InlineKeyboardMarkup(buttons)
-        )
+@CALLBACKS.route("client:time:{t}")
+async def cb_client_time(query, context: ContextTypes.DEFAULT_TYPE, uid: int, t: str):
+    if context.user_data.get(CLIENT_STATE_KEY) != C_TIME:
         return
 
-    if data.startswith("client:cancel:"):
-        order_id = data.split(":", 2)[2]
-        await handle_client_cancel(query, context, uid, order_id)
-        return
+    d = context.user_data.get("draft_order", {})
 
-    if data.startswith("client:delete:"):
-        order_id = data.split(":", 2)[2]
-        await handle_client_delete_problem(query, context, uid, order_id)
-        return
+    if t in ("now", "today"):
+        d["delivery_time_type"] = t
+        d["delivery_time_text"] = ""
+        context.user_data["draft_order"] = d
 
-    if data == "client:orders:open":
-        await ui_render(
-            context,
-            uid,
-            "Выберите период:",
-            reply_markup=kb_client_orders_filters()
-        )
+        if SHEETS:
+            SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_STEP_TIME", meta=t)
+
+        await wizard_enter(context, uid, uid, C_CLIENT_NAME)
         return
 
-    if data.startswith("client:orders:"):
-        period = data.split(":")[-1]
-        items = get_client_orders(uid)
-        filtered = filter_orders_by_period(
-            items,
-            period if period in ("today", "week", "month") else "month"
-        )
+    d["delivery_time_type"] = "custom"
+    context.user_data["draft_order"] = d
+    await wizard_enter(context, uid, uid, C_TIME_CUSTOM)
 
-        text = render_orders_list(filtered)
-        if not text.strip():
-            text = "Нет данных."
-        await ui_render(context, uid, text)
-        
-    if data == "client:new_order":
+
+@CALLBACKS.route("client:confirm:{ans}", idempotent=True)
+async def cb_client_confirm(query, context: ContextTypes.DEFAULT_TYPE, uid: int, ans: str):
+    if context.user_data.get(CLIENT_STATE_KEY) != C_CONFIRM:
+        return
+
+    # ---- CANCEL ----
+    if ans == "no":
+        wizard_finish(context, "canceled")
+        context.user_data[CLIENT_STATE_KEY] = C_NONE
+        cancel_speculative_quote(uid)
+        context.user_data.pop("draft_order", None)
         context.user_data.pop(UI_MSG_ID_KEY, None)
-        context.user_data["draft_order"] = {}
-        context.user_data[CLIENT_STATE_KEY] = C_PRICE_ZONE
 
         if SHEETS:
-            SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_START_PRICE_ZONE")
+            SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_CANCEL_BEFORE_CREATE")
 
         await ui_render(
             context,
             uid,
-            "Выберите зону доставки:",
-            reply_markup=kb_client_price_choice()
+            "❌ Заказ отменен.",
+            reply_markup=kb_client_menu()
         )
         return
 
-    if data == "client:price:local":
-        if context.user_data.get(CLIENT_STATE_KEY) != C_PRICE_ZONE:
-            return
+    # ---- CONFIRM ----
+    d = context.user_data.get("draft_order", {})
 
-        d = context.user_data.get("draft_order", {})
-        d["zone"] = "dunpo"
+    # 🔒 страховка для Dunpo
+    if d.get("zone") == "dunpo" and not d.get("price_krw"):
         d["price_krw"] = DEFAULT_PRICE_KRW
         context.user_data["draft_order"] = d
 
-        context.user_data[CLIENT_STATE_KEY] = C_PICKUP
-
-        await ui_render(
-            context,
-            uid,
-            "📍 Укажите адрес забора.\nАдрес нужно написать текстом и на корейском языке."
-        )
-        return
-        
-    if data == "client:price:custom":
-        if context.user_data.get(CLIENT_STATE_KEY) != C_PRICE_ZONE:
-            return
-
-        d = context.user_data.get("draft_order", {})
-        d["zone"] = "other"
-        context.user_data["draft_order"] = d
 
-        context.user_data[CLIENT_STATE_KEY] = C_PICKUP
+    price = int(d.get("price_krw") or 0)
+    if price <= 0:
+        wizard_finish(context, "canceled")
+        context.user_data[CLIENT_STATE_KEY] = C_NONE
+        cancel_speculative_quote(uid)
+        context.user_data.pop("draft_order", None)
+        context.user_data.pop(UI_MSG_ID_KEY, None)
 
         await ui_render(
             context,
             uid,
-            "📍 Укажите адрес забора.\nАдрес нужно написать текстом и на корейском языке."
+            "Не указана цена. Начните заново.",
+            reply_markup=kb_client_menu()
         )
         return
 
-    if data == "client:price:accept_recommended":
-        if context.user_data.get(CLIENT_STATE_KEY) != C_PRICE_RECOMMEND:
-            return
-
-        d = context.user_data.get("draft_order", {})
-        rec = int(d.get("recommended_price_krw") or 0)
-        if rec <= 0:
-            # если вдруг пропало - уходим на ручной ввод
-            context.user_data[CLIENT_STATE_KEY] = C_PRICE_FINAL
-            await ui_render(context, uid, "Введите цену вручную (в вонах).")
-            return
-
-        d["price_krw"] = rec
-        context.user_data["draft_order"] = d
-        context.user_data[CLIENT_STATE_KEY] = C_CONFIRM
+    if not d.get("pickup_address_ko") or not d.get("drop_address_ko") or not d.get("recipient_contact_text"):
+        wizard_finish(context, "canceled")
+        context.user_data[CLIENT_STATE_KEY] = C_NONE
+        cancel_speculative_quote(uid)
+        context.user_data.pop("draft_order", None)
+        context.user_data.pop(UI_MSG_ID_KEY, None)
 
         await ui_render(
             context,
             uid,
-            render_order_summary_for_confirm(d),
-            reply_markup=kb_confirm_order()
+            "Не хватает данных. Начните заново.",
+            reply_markup=kb_client_menu()
         )
         return
 
-    if data == "client:price:manual":
-        if context.user_data.get(CLIENT_STATE_KEY) != C_PRICE_RECOMMEND:
-            return
-
-        context.user_data[CLIENT_STATE_KEY] = C_PRICE_FINAL
-        await ui_render(context, uid, "Введите цену вручную (в вонах). Например: 12000")
-        return
-
-
-
-    if data == "client:door_none":
-        if context.user_data.get(CLIENT_STATE_KEY) != C_DOOR:
-            return
-
-        d = context.user_data.get("draft_order", {})
-        d["door_code"] = ""
-        context.user_data["draft_order"] = d
-        context.user_data[CLIENT_STATE_KEY] = C_TYPE
-        if SHEETS:
-            SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_STEP_DOOR_NONE")
-        await ui_render(context, uid, "Выберите тип доставки.", reply_markup=kb_delivery_type())
-        return
+    order_id = SHEETS.next_order_id() if SHEETS else str(int(datetime.now().timestamp()))
+    order = Order(
+        order_id=order_id,
+        created_at=now_ts(),
+        location=LOC_DUNPO,
+        price_krw=price,
+        status=ORDER_NEW,
 
-    if data.startswith("client:type:"):
-        if context.user_data.get(CLIENT_STATE_KEY) != C_TYPE:
-            return
+        client_tg_id=uid,
+        client_username=query.from_user.username or "",
+        recipient_contact_text=d.get("recipient_contact_text", ""),
 
-        delivery_type = data.split(":")[-1]
+        pickup_address_ko=d.get("pickup_address_ko", ""),
+        drop_address_ko=d.get("drop_address_ko", ""),
+        door_code=d.get("door_code", ""),
 
-        d = context.user_data.get("draft_order", {})
-        d["delivery_type"] = delivery_type
-        context.user_data["draft_order"] = d
-        
-        if delivery_type == "other":
-            context.user_data[CLIENT_STATE_KEY] = C_TYPE_OTHER
+        delivery_type=d.get("delivery_type", ""),
+        delivery_type_other_text=d.get("delivery_type_other_text", ""),
 
-            if SHEETS:
-                SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_STEP_TYPE_OTHER")
+        delivery_time_type=d.get("delivery_time_type", ""),
+        delivery_time_text=d.get("delivery_time_text", ""),
+    )
 
-            await ui_render(
-                context,
-                uid,
-                "Коротко опишите, что нужно доставить."
-            )
-            return
+    ORDERS[order_id] = order
+    reindex_order(order)
 
-        # обычные типы доставки
-        context.user_data[CLIENT_STATE_KEY] = C_TIME
+    if SHEETS:
+        SHEETS.insert_order(asdict(order))
+        SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_CONFIRMED", order_id=order_id)
 
-        if SHEETS:
-            SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_STEP_TYPE", meta=delivery_type)
+    # ---- CLEAN EXIT ----
+    wizard_finish(context)
+    context.user_data[CLIENT_STATE_KEY] = C_NONE
+    cancel_speculative_quote(uid)
+    context.user_data.pop("draft_order", None)
+    context.user_data.pop(UI_MSG_ID_KEY, None)
 
-        await ui_render(
-            context,
-            update.effective_chat.id,
-            "Когда нужна доставка?",
-            reply_markup=kb_delivery_time()
-        )
-        return
-    if data.startswith("client:time:"):
-        if context.user_data.get(CLIENT_STATE_KEY) != C_TIME:
-            return
+    await ui_render(
+        context,
+        uid,
+        "✅ Заказ принят.\nКурьер свяжется с вами напрямую.\n"
+        "Статус заказа - в закрепленном сообщении, оно обновляется само."
+    )
+    publish_client_status(context.bot, order.order_id)
+    TASKS.spawn("notify_new_order", notify_new_order(context, order))
 
-        t = data.split(":")[-1]
-        d = context.user_data.get("draft_order", {})
 
-        if t in ("now", "today"):
-            d["delivery_time_type"] = t
-            d["delivery_time_text"] = ""
-            context.user_data["draft_order"] = d
+@CALLBACKS.route("courier:apply")
+async def cb_courier_apply(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    context.user_data["apply_username"] = query.from_user.username or ""
+    if SHEETS:
+        SHEETS.log_event(uid, ROLE_COURIER, "COURIER_APPLY_START")
+    await wizard_enter(context, uid, uid, K_APPLY_NAME)
 
-            context.user_data[CLIENT_STATE_KEY] = C_CLIENT_NAME
 
-            if SHEETS:
-                SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_STEP_TIME", meta=t)
+@CALLBACKS.route("copy:{what}:{order_id}", stage=CB_STAGE_ALWAYS)
+async def cb_copy(query, context: ContextTypes.DEFAULT_TYPE, uid: int, what: str, order_id: str):
+    order = ORDERS.get(order_id)
 
-            await ui_render(context, uid, "Введите ваше имя.")
-            return
+    if not order or order.courier_tg_id != uid:
+        await query.answer("Нет доступа")
+        return
 
-        d["delivery_time_type"] = "custom"
-        context.user_data["draft_order"] = d
-        context.user_data[CLIENT_STATE_KEY] = C_TIME_CUSTOM
-        await ui_render(context, uid, "Напишите желаемое время доставки.")
+    if what == "pickup":
+        text = order.pickup_address_ko
+    elif what == "drop":
+        text = order.drop_address_ko
+    elif what == "phone":
+        text = order.recipient_contact_text
+    else:
         return
 
-    if data.startswith("client:confirm:"):
-        if context.user_data.get(CLIENT_STATE_KEY) != C_CONFIRM:
-            return
+    await context.bot.send_message(chat_id=uid, text=text)
 
-        ans = data.split(":")[-1]
 
-        # ---- CANCEL ----
-        if ans == "no":
-            context.user_data[CLIENT_STATE_KEY] = C_NONE
-            context.user_data.pop("draft_order", None)
-            context.user_data.pop(UI_MSG_ID_KEY, None)
+@CALLBACKS.route("reset:hard")
+async def cb_reset_hard(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    await handle_hard_reset(query, context)
 
-            if SHEETS:
-                SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_CANCEL_BEFORE_CREATE")
 
-            await ui_render(
-                context,
-                uid,
-                "❌ Заказ отменен.",
-                reply_markup=kb_client_menu()
-            )
-            return
+@CALLBACKS.route("role:courier")
+async def cb_role_courier(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    context.user_data[USER_ROLE_KEY] = ROLE_COURIER
+    context.user_data[COURIER_STATE_KEY] = K_NONE
+    if SHEETS:
+        SHEETS.log_event(uid, ROLE_COURIER, "ROLE_PICKED")
 
-        # ---- CONFIRM ----
-        d = context.user_data.get("draft_order", {})
-        
-        # 🔒 страховка для Dunpo
-        if d.get("zone") == "dunpo" and not d.get("price_krw"):
-            d["price_krw"] = DEFAULT_PRICE_KRW
-            context.user_data["draft_order"] = d
+    await show_courier_dashboard(context, uid)
 
 
-        price = int(d.get("price_krw") or 0)
-        if price <= 0:
-            context.user_data[CLIENT_STATE_KEY] = C_NONE
-            context.user_data.pop("draft_order", None)
-            context.user_data.pop(UI_MSG_ID_KEY, None)
+@CALLBACKS.route("courier:shift:{mode}", guard=courier_is_approved)
+async def cb_courier_shift(query, context: ContextTypes.DEFAULT_TYPE, uid: int, mode: str):
+    if mode not in ("on", "off"):
+        return
+    on = mode == "on"
+    set_courier_shift(uid, on)
+    await ui_render(
+        context,
+        uid,
+        (
+            "🟢 Смена начата. Новые заказы будут приходить автоматически."
+            if on else
+            "⚪ Смена завершена. Новые заказы приходить не будут."
+        ),
+        reply_markup=kb_courier_menu_approved(uid)
+    )
 
-            await ui_render(
-                context,
-                uid,
-                "Не указана цена. Начните заново.",
-                reply_markup=kb_client_menu()
-            )
-            return
 
-        if not d.get("pickup_address_ko") or not d.get("drop_address_ko") or not d.get("recipient_contact_text"):
-            context.user_data[CLIENT_STATE_KEY] = C_NONE
-            context.user_data.pop("draft_order", None)
-            context.user_data.pop(UI_MSG_ID_KEY, None)
+@CALLBACKS.route("courier:location", guard=courier_is_approved)
+async def cb_courier_location(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    prof = COURIERS.get(uid)
+    home_line = (
+        f"Домашняя зона: {prof.home_lat:.5f}, {prof.home_lon:.5f}"
+        if prof and (prof.home_lat or prof.home_lon)
+        else "Домашняя зона не задана."
+    )
+    await ui_render(
+        context,
+        uid,
+        (
+            "📍 Геопозиция курьера\n\n"
+            f"{home_line}\n\n"
+            "Отправьте геопозицию через 📎 → Геопозиция:\n"
+            "— обычная точка сохранится как домашняя зона;\n"
+            "— трансляция (live location) - текущее положение на смене.\n\n"
+            "Новые заказы сначала получают ближайшие курьеры."
+        ),
+        reply_markup=kb_courier_menu_approved(uid)
+    )
 
-            await ui_render(
-                context,
-                uid,
-                "Не хватает данных. Начните заново.",
-                reply_markup=kb_client_menu()
-            )
-            return
 
-        order_id = SHEETS.next_order_id() if SHEETS else str(int(datetime.now().timestamp()))
-        order = Order(
-            order_id=order_id,
-            created_at=now_ts(),
-            location=LOC_DUNPO,
-            price_krw=price,
-            status=ORDER_NEW,
+@CALLBACKS.route("courier:active_order")
+async def cb_courier_active_order(query, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    active = get_active_order_for_courier(uid)
+    if not active:
+        await ui_render(
+            context,
+            uid,
+            "Сейчас у вас нет активного заказа.",
+            reply_markup=kb_courier_menu_approved(uid)
+        )
+        return
 
-            client_tg_id=uid,
-            client_username=uname,
-            recipient_contact_text=d.get("recipient_contact_text", ""),
+    await render_active_order_screen(query, context, active)
 
-            pickup_address_ko=d.get("pickup_address_ko", ""),
-            drop_address_ko=d.get("drop_address_ko", ""),
-            door_code=d.get("door_code", ""),
 
-            delivery_type=d.get("delivery_type", ""),
-            delivery_type_other_text=d.get("delivery_type_other_text", ""),
+@CALLBACKS.route("client:addr:{kind}:{idx:int}")
+async def cb_client_recent_address(query, context: ContextTypes.DEFAULT_TYPE, uid: int, kind: str, idx: int):
+    expected = C_PICKUP if kind == "pickup" else C_DROP
+    if context.user_data.get(CLIENT_STATE_KEY) != expected:
+        return
 
-            delivery_time_type=d.get("delivery_time_type", ""),
-            delivery_time_text=d.get("delivery_time_text", ""),
-        )
+    addrs = context.user_data.get("recent_addresses", {}).get(kind, [])
+    if not 0 <= idx < len(addrs):
+        return
 
-        ORDERS[order_id] = order
+    await wizard_submit(context, uid, uid, expected, addrs[idx])
 
-        if SHEETS:
-            SHEETS.insert_order(asdict(order))
-            SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_CONFIRMED", order_id=order_id)
 
-        # ---- CLEAN EXIT ----
-        context.user_data[CLIENT_STATE_KEY] = C_NONE
-        context.user_data.pop("draft_order", None)
-        context.user_data.pop(UI_MSG_ID_KEY, None)
+# кнопки, у которых уже есть отдельные обработчики с сигнатурой (query, context, uid, order_id)
+CALLBACKS.add("take:{order_id}", handle_take_order, stage=CB_STAGE_PRE_SESSION, idempotent=True)
+CALLBACKS.add("badaddr:{order_id}", handle_bad_address, stage=CB_STAGE_PRE_SESSION, idempotent=True)
+CALLBACKS.add("progress:{order_id}", handle_in_progress_clicked, stage=CB_STAGE_PRE_SESSION, idempotent=True)
+CALLBACKS.add("picked:{order_id}", handle_picked_up, stage=CB_STAGE_PRE_SESSION, idempotent=True)
+CALLBACKS.add("done:{order_id}", handle_done_clicked, stage=CB_STAGE_PRE_SESSION, idempotent=True)
+CALLBACKS.add("client:cancel:{order_id}", handle_client_cancel, idempotent=True)
+CALLBACKS.add("client:delete:{order_id}", handle_client_delete_problem, idempotent=True)
 
-        await ui_render(
-            context,
-            uid,
-            "✅ Заказ принят.\nКурьер свяжется с вами напрямую."
-        )
-        asyncio.create_task(
-            notify_new_order(context, order)
-        )
+
+async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if not query:
         return
 
-    if data == "courier:apply":
-        context.user_data[COURIER_STATE_KEY] = K_APPLY_NAME
-        if SHEETS:
-            SHEETS.log_event(uid, ROLE_COURIER, "COURIER_APPLY_START")
-        await ui_render(context, uid, "Введите ваше имя.")
+    uid = query.from_user.id
+    data = query.data or ""
+    touch_courier_activity(uid)
+
+    hit = CALLBACKS.match(data)
+    if hit is None:
+        CALLBACKS.unrouted += 1
+        log.info("CALLBACK UNROUTED | uid=%s | data=%s", uid, data)
+        try:
+            await query.answer()
+        except Exception:
+            pass
         return
+    route, args = hit
 
-    if data.startswith("admin:"):
-        if not is_admin(uid):
-            await ui_render(context, uid, "Нет доступа.")
+    # смена роли / копирование - работают ВСЕГДА, остальное ждет /start и сброс UI
+    if route.stage != CB_STAGE_ALWAYS:
+        if context.user_data.get(START_LOCK_KEY):
+            return
+
+        if context.user_data.get(UI_RESET_KEY):
+            await query.answer("Обновление…")
+            return
+
+        if route.stage == CB_STAGE_SESSION and CLIENT_STATE_KEY not in context.user_data:
+            await query.answer("Сессия обновлена. Нажмите /start", show_alert=False)
+            return
+
+    # двойное нажатие: отвечаем из кэша, до локов и Sheets
+    idem_key = None
+    if route.idempotent:
+        idem_key = (uid, query.message.message_id if query.message else 0, data)
+        cached = CALLBACKS.duplicate(route, idem_key)
+        if cached is not None:
+            log.info("CALLBACK DUPLICATE | uid=%s | data=%s", uid, data)
+            try:
+                await query.answer(cached)
+            except Exception:
+                pass
             return
-        await handle_admin_callbacks(query, context, data)
+
+    if route.stage != CB_STAGE_ALWAYS and route.answer:
+        try:
+            await query.answer()
+        except Exception:
+            pass
+
+    if idem_key is None:
+        await CALLBACKS.dispatch(route, args, query, context, uid)
         return
 
+    ok = False
+    try:
+        await CALLBACKS.dispatch(route, args, query, context, uid)
+        ok = True
+    finally:
+        CALLBACKS.settle(idem_key, ok)
+
 
 # =========================
 # MESSAGE HANDLER
@@ -3114,8 +6846,8 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     init_user_defaults(context)
 
     uid = update.effective_user.id
-    uname = update.effective_user.username or ""
     text = (update.message.text or "").strip()
+    touch_courier_activity(uid)
 
     if context.user_data.get(COURIER_STATE_KEY) == K_AWAITING_PROOF:
         if update.message.photo:
@@ -3134,6 +6866,7 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # защитный сброс: если draft_order есть, но FSM выключен - чистим, чтобы не оживал флоу
     if S_client == C_NONE and "draft_order" in context.user_data:
+        cancel_speculative_quote(uid)
         context.user_data.pop("draft_order", None)
         context.user_data.pop(UI_MSG_ID_KEY, None)
 
@@ -3142,111 +6875,12 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     courier_state = context.user_data.get(COURIER_STATE_KEY, K_NONE)
 
     if courier_state != K_NONE and context.user_data.get(USER_ROLE_KEY) == ROLE_COURIER:
-        # courier FSM
-        
-        prof = COURIERS.get(uid)
-
-        if courier_state == K_APPLY_NAME:
-            if not text:
-                await ui_render(
-                    context,
-                    update.effective_chat.id,
-                    "Введите ваше имя."
-                )
-                return
-            context.user_data["apply_name"] = text
-            context.user_data[COURIER_STATE_KEY] = K_APPLY_PHONE
-            await ui_render(
-                context,
-                update.effective_chat.id,
-                "Введите номер телефона."
-            )
-            return
-
-        if courier_state == K_APPLY_PHONE:
-            if not text:
-                await ui_render(
-                    context,
-                    update.effective_chat.id,
-                    "Введите номер телефона."
-                )
-                return
-            context.user_data["apply_phone"] = text
-            context.user_data[COURIER_STATE_KEY] = K_APPLY_TRANSPORT
-            await ui_render(
-                context,
-                update.effective_chat.id,
-                "Транспорт: Машина или Скутер?"
-            )
-            return
-
-        if courier_state == K_APPLY_TRANSPORT:
-            if not text:
-                await ui_render(
-                    context,
-                    update.effective_chat.id,
-                    "Ответьте, машина или скутер."
-                )
-                return
-            t = text.lower()
-            transport = "car" if "маш" in t else "scooter" if "скут" in t else ""
-            if not transport:
-                await ui_render(
-                    context,
-                    update.effective_chat.id,
-                    "Ответьте, машина или скутер."
-                )
-                return
-
-            name = context.user_data.get("apply_name", "")
-            phone = context.user_data.get("apply_phone", "")
-
-            prof = CourierProfile(
-                courier_tg_id=uid,
-                username=uname,
-                name=name,
-                phone=phone,
-                transport=transport,
-                status=COURIER_PENDING,
-                applied_at=now_ts(),
-            )
-            COURIERS[uid] = prof
-
-            if SHEETS:
-                SHEETS.upsert_courier(asdict(prof))
-                SHEETS.log_event(uid, ROLE_COURIER, "COURIER_APPLY_SUBMIT")
-
-            context.user_data[COURIER_STATE_KEY] = K_NONE
-            context.user_data.pop("apply_name", None)
-            context.user_data.pop("apply_phone", None)
-
-            await ui_render(
-                context,
-                update.effective_chat.id,
-                "✅ Заявка отправлена.\nОжидайте одобрения администратора."
-            )
-
-            for admin_id in ADMIN_IDS:
-                try:
-                    text_admin = (
-                        "🧍 Заявка курьера\n\n"
-                        f"Имя: {name}\n"
-                        f"Телефон: {phone}\n"
-                        f"Транспорт: {transport}\n"
-                        f"ID: {uid}"
-                    )
-                    await tg_retry(lambda aid=admin_id, tmsg=text_admin: context.bot.send_message(
-                        chat_id=aid,
-                        text=tmsg,
-                        reply_markup=kb_admin_app_decision(uid)
-                    ))
-                except Exception as e:
-                    log.warning("Admin app notify failed: %s", e)
-
+        # courier FSM (анкета) - по таблице WIZARD
+        if await wizard_submit(context, update.effective_chat.id, uid, courier_state, text):
             return
 
-        
-        elif prof and prof.status == COURIER_PENDING:
+        prof = COURIERS.get(uid)
+        if prof and prof.status == COURIER_PENDING:
             await ui_render(
                     context,
                     update.effective_chat.id,
@@ -3260,219 +6894,62 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
         return
 
-    
-    
-    if S_client != C_NONE:
-
-        if S_client == C_CLIENT_NAME:
-            if not text:
-                await ui_render(context, uid, "Введите ваше имя.")
-                return
-
-            d = context.user_data.get("draft_order", {})
-            d["client_name"] = text
-            context.user_data["draft_order"] = d
-
-            context.user_data[CLIENT_STATE_KEY] = C_CLIENT_PHONE
-            await ui_render(context, uid, "Введите номер телефона.")
-            return
-
-            
-        if S_client == C_CLIENT_PHONE:
-            if not text:
-                await ui_render(context, uid, "Введите номер телефона.")
-                return
-
-            d = context.user_data.get("draft_order", {})
-            d["client_phone"] = text
-            d["recipient_contact_text"] = f"{d.get('client_name')} · {text}"
-
-            # ✅ если Dunpo - цена фикс сразу
-            if d.get("zone") == "dunpo":
-                d["price_krw"] = DEFAULT_PRICE_KRW
-                context.user_data["draft_order"] = d
-                context.user_data[CLIENT_STATE_KEY] = C_CONFIRM
-
-                await ui_render(
-                    context,
-                    uid,
-                    render_order_summary_for_confirm(d),
-                    reply_markup=kb_confirm_order()
-                )
-                return
-
-            # ✅ если other - считаем рекомендованную и предлагаем выбор
-            pickup = d.get("pickup_address_ko", "")
-            dropoff = d.get("drop_address_ko", "")
-
-            recommended = await calc_recommended_price_krw(pickup, dropoff)
-            if recommended:
-                d["recommended_price_krw"] = recommended
-                context.user_data["draft_order"] = d
-                context.user_data[CLIENT_STATE_KEY] = C_PRICE_RECOMMEND
-
-                await ui_render(
-                    context,
-                    uid,
-                    (
-                        f"💰 Рекомендованная цена: {recommended} вон\n"
-                        f"(расчет: {PRICE_PER_KM_KRW} вон за км)\n\n"
-                        "Принять эту цену или ввести свою?"
-                    ),
-                    reply_markup=kb_client_price_recommend()
-                )
-                return
-
-            # fallback - если не смогли посчитать маршрут
-            context.user_data["draft_order"] = d
-            context.user_data[CLIENT_STATE_KEY] = C_PRICE_FINAL
-            await ui_render(
-                context,
-                uid,
-                "💰 Не удалось рассчитать маршрут. Укажите цену вручную (в вонах)."
-            )
-            return
-
-        d = context.user_data.get("draft_order", {})
-        
-        if S_client == C_PRICE_FINAL:
-            price = parse_price_krw(text)
-            
-            if price is None:
-                await ui_render(
-                    context,
-                    uid,
-                    "Введите сумму числом (1000–300000). Например: 12000"
-                )
-                return
-
-            d["price_krw"] = price
-            context.user_data["draft_order"] = d
-
-            context.user_data[CLIENT_STATE_KEY] = C_CONFIRM
-
-            await ui_render(
-                context,
-                uid,
-                render_order_summary_for_confirm(d),
-                reply_markup=kb_confirm_order()
-            )
-            return
-
-        if S_client == C_PICKUP:
-            if not is_korean_address(text):
-                await ui_render(
-                    context,
-                    update.effective_chat.id,
-                    "📍 Адрес забора должен быть на корейском языке.\nПожалуйста, попробуйте еще раз."
-                )
-                return
-
-            d["pickup_address_ko"] = text
-            context.user_data["draft_order"] = d   # ОБЯЗАТЕЛЬНО
-            context.user_data[CLIENT_STATE_KEY] = C_DROP
-
-            if SHEETS:
-                SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_STEP_PICKUP")
-
-            await ui_render(
-                context,
-                update.effective_chat.id,
-                "Укажите адрес доставки. Адрес нужно написать текстом на корейском языке."
-            )
-            return
-
-        if S_client == C_DROP:
-            if not is_korean_address(text):
-                await ui_render(
-                    context,
-                    update.effective_chat.id,
-                    "Пожалуйста, укажите адрес на корейском языке. Это нужно для навигатора."
-                )
-                return
-
-            d["drop_address_ko"] = text
-            context.user_data["draft_order"] = d
+    # FSM клиента (мастер заказа) - по таблице WIZARD
+    if S_client != C_NONE and await wizard_submit(context, update.effective_chat.id, uid, S_client, text):
+        return
 
-            pickup = d.get("pickup_address_ko")
-            dropoff = d.get("drop_address_ko")
+    # если мы здесь — просто игнорируем
+    log.info("MESSAGE IGNORED (no active FSM)")
+    return
 
-            log.info(f"ROUTE CHECK from='{pickup}' to='{dropoff}'")
 
-            context.user_data[CLIENT_STATE_KEY] = C_DOOR
+# =========================
+# COURIER LOCATION
+# =========================
+async def on_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.effective_message
+    if not update.effective_user or not msg or not msg.location:
+        return
 
-            if SHEETS:
-                SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_STEP_DROP")
+    uid = update.effective_user.id
+    if not courier_is_approved(uid):
+        return
+    touch_courier_activity(uid)
 
-            await ui_render(
-                context,
-                update.effective_chat.id,
-                "🔒 Если нужен код подъезда или домофона, напишите его.\nЕсли кода нет, нажмите кнопку ниже.",
-                reply_markup=kb_door_code()
-            )
-            return
+    loc = msg.location
+    # live location приходит первым сообщением с live_period, дальше - edited_message
+    is_live = bool(loc.live_period) or update.edited_message is not None
 
-        if S_client == C_DOOR:
-            d["door_code"] = text
-            context.user_data["draft_order"] = d
-            context.user_data[CLIENT_STATE_KEY] = C_TYPE
+    if is_live:
+        first = uid not in COURIER_LIVE_POS
+        COURIER_LIVE_POS[uid] = (loc.latitude, loc.longitude, time.monotonic())
+        reindex_courier(uid)
+        if first and update.message:
             if SHEETS:
-                SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_STEP_DOOR_TEXT")
+                SHEETS.log_event(uid, ROLE_COURIER, "COURIER_LIVE_LOCATION_ON")
             await ui_render(
                 context,
                 update.effective_chat.id,
-                "Выберите тип доставки.",
-                reply_markup=kb_delivery_type()
-            )
-            return
-
-        
-        if S_client == C_TYPE_OTHER:
-            if not text:
-                await ui_render(
-                    context,
-                    update.effective_chat.id,
-                    "Коротко опишите, что нужно доставить."
-                )
-                return
-            d["delivery_type_other_text"] = text
-            context.user_data["draft_order"] = d
-            context.user_data[CLIENT_STATE_KEY] = C_TIME
-            if SHEETS:
-                SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_STEP_TYPE_OTHER_TEXT")
-            await ui_render(
-                    context,
-                    update.effective_chat.id,
-                    "Когда нужна доставка?",
-                    reply_markup=kb_delivery_time()
+                "📡 Трансляция геопозиции получена.\nБлижайшие заказы будут приходить вам первыми.",
+                reply_markup=kb_courier_menu_approved(uid)
             )
-            return
-
-        if S_client == C_TIME_CUSTOM:
-            if not text:
-                await ui_render(
-                    context,
-                    update.effective_chat.id,
-                    "Напишите желаемое время доставки."
-                )
-                return
-
-            d = context.user_data.get("draft_order", {})
-            d["delivery_time_type"] = "custom"
-            d["delivery_time_text"] = text
-            context.user_data["draft_order"] = d
+        return
 
-            context.user_data[CLIENT_STATE_KEY] = C_CLIENT_NAME
+    prof = COURIERS[uid]
+    prof.home_lat = loc.latitude
+    prof.home_lon = loc.longitude
+    reindex_courier(uid)
 
-            if SHEETS:
-                SHEETS.log_event(uid, ROLE_CLIENT, "ORDER_STEP_TIME_CUSTOM_TEXT")
+    if SHEETS:
+        SHEETS.upsert_courier(asdict(prof))
+        SHEETS.log_event(uid, ROLE_COURIER, "COURIER_HOME_ZONE_SET", meta=f"{loc.latitude},{loc.longitude}")
 
-            await ui_render(context, uid, "Введите ваше имя.")
-            return
-        
-    # если мы здесь — просто игнорируем
-    log.info("MESSAGE IGNORED (no active FSM)")
-    return
+    await ui_render(
+        context,
+        update.effective_chat.id,
+        "📍 Домашняя зона сохранена.",
+        reply_markup=kb_courier_menu_approved(uid)
+    )
 
 
 # =========================
@@ -3481,6 +6958,10 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def on_startup(app: Application):
     global SHEETS
 
+    # живые статусы клиентов: тот же словарь лежит в bot_data и сохраняется вместе с ним
+    CLIENT_STATUS_MSGS.update(app.bot_data.get(CLIENT_STATUS_KEY, {}))
+    app.bot_data[CLIENT_STATUS_KEY] = CLIENT_STATUS_MSGS
+
     try:
         # --- Sheets init ---
         service = build_sheets_service()
@@ -3490,6 +6971,7 @@ async def on_startup(app: Application):
 
         # --- Load couriers ---
         COURIERS.clear()
+        GEO_INDEX.clear()
         for c in SHEETS.load_all_couriers():
             try:
                 cid = int(str(c.get("courier_tg_id", "")).strip())
@@ -3506,7 +6988,13 @@ async def on_startup(app: Application):
                 applied_at=c.get("applied_at", ""),
                 approved_at=c.get("approved_at", ""),
                 rejected_at=c.get("rejected_at", ""),
+                home_lat=_parse_float(c.get("home_lat", "")),
+                home_lon=_parse_float(c.get("home_lon", "")),
+                # пустая колонка (старые записи) = на смене
+                on_shift=(c.get("on_shift", "") or "1").strip() != "0",
+                shift_changed_at=c.get("shift_changed_at", ""),
             )
+            reindex_courier(cid)
 
         # --- Load orders ---
         ORDERS.clear()
@@ -3565,9 +7053,19 @@ async def on_startup(app: Application):
                 canceled_by=o.get("canceled_by", ""),
             )
 
+        rebuild_courier_sets()
+        ORDER_INDEX.rebuild(ORDERS)
+        await init_gazetteer()
+        await init_zones()
+        TASKS.spawn("shift_autooff", shift_autooff_loop(app), daemon=True)
+        TASKS.spawn("cache_purge", cache_purge_loop(), daemon=True)
+        TASKS.spawn("wizard_gc", wizard_gc_loop(app), daemon=True)
+        if ADMIN_NOTIFY_MODE == ADMIN_MODE_DIGEST:
+            TASKS.spawn("admin_digest", admin_digest_loop(app), daemon=True)
+
         log.info(
-            "Sheets ready. Last order id: %s | couriers: %s | orders: %s",
-            SHEETS.last_order_num, len(COURIERS), len(ORDERS)
+            "Sheets ready. Last order id: %s | couriers: %s | orders: %s | on shift: %s",
+            SHEETS.last_order_num, len(COURIERS), len(ORDERS), len(ON_SHIFT)
         )
 
     except Exception:
@@ -3575,9 +7073,22 @@ async def on_startup(app: Application):
         raise
     
     
+async def on_stop(app: Application):
+    # бот еще может отправлять сообщения - дорассылаем то, что в полете
+    try:
+        await flush_admin_digest(app.bot)
+    except Exception:
+        log.exception("Admin digest flush on stop failed")
+    await TASKS.shutdown(TASKS_SHUTDOWN_TIMEOUT_SEC)
+
+    for client in MAP_HTTP.values():
+        await client.aclose()
+
+
 async def cmd_go(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
 
+    cancel_speculative_quote(uid)
     context.user_data.clear()
     context.user_data.pop(UI_MSG_ID_KEY, None)
     init_user_defaults(context)
@@ -3591,20 +7102,45 @@ async def cmd_go(update: Update, context: ContextTypes.DEFAULT_TYPE):
 def main():
     print("=== MAIN ENTERED ===", flush=True)
     
-    app = Application.builder().token(BOT_TOKEN).post_init(on_startup).build()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+    )
+    if STATE_STORE:
+        # user_data (роль, шаг мастера, id UI-сообщения) переживает рестарт
+        builder = builder.persistence(STATE_STORE)
+    app = builder.build()
 
     # handlers — ДО запуска
-    app.add_handler(CommandHandler("start", start_cmd))
-    app.add_handler(CommandHandler("admin", admin_cmd))
-    app.add_handler(CommandHandler("go", cmd_go))
-    app.add_handler(CommandHandler("restart", restart_cmd))
-    app.add_handler(CommandHandler("clear", clear_cmd))
+    # флуд-контроль - раньше всех остальных (группа -1)
+    app.add_handler(TypeHandler(Update, flood_guard), group=-1)
+    # edited_message включен ради live location: команды и текст из
+    # отредактированных сообщений не обрабатываем, только on_location
+    new_msg = filters.UpdateType.MESSAGE
+    app.add_handler(CommandHandler("start", start_cmd, filters=new_msg))
+    app.add_handler(CommandHandler("admin", admin_cmd, filters=new_msg))
+    app.add_handler(CommandHandler("tasks", tasks_cmd, filters=new_msg))
+    app.add_handler(CommandHandler("routes", routes_cmd, filters=new_msg))
+    app.add_handler(CommandHandler("funnel", funnel_cmd, filters=new_msg))
+    app.add_handler(CommandHandler("metrics", metrics_cmd, filters=new_msg))
+    app.add_handler(CommandHandler("gazbench", gazbench_cmd, filters=new_msg))
+    app.add_handler(CommandHandler("statebench", statebench_cmd, filters=new_msg))
+    app.add_handler(CommandHandler("distbench", distbench_cmd, filters=new_msg))
+    app.add_handler(CommandHandler("normstats", normstats_cmd, filters=new_msg))
+    app.add_handler(CommandHandler("zones_rebuild", zones_rebuild_cmd, filters=new_msg))
+    app.add_handler(CommandHandler("go", cmd_go, filters=new_msg))
+    app.add_handler(CommandHandler("restart", restart_cmd, filters=new_msg))
+    app.add_handler(CommandHandler("clear", clear_cmd, filters=new_msg))
     app.add_handler(CallbackQueryHandler(on_callback))
-    app.add_handler(MessageHandler(filters.TEXT | filters.PHOTO, on_message))
+    app.add_handler(MessageHandler(filters.LOCATION, on_location))
+    app.add_handler(MessageHandler((filters.TEXT | filters.PHOTO) & new_msg, on_message))
 
     log.info("Bot starting...")
     app.run_polling(
-        allowed_updates=["message", "callback_query"],
+        # edited_message - обновления live location курьеров
+        allowed_updates=["message", "edited_message", "callback_query"],
         drop_pending_updates=True
     )
 